@@ -1,39 +1,202 @@
 #!/usr/bin/env python
 import os
+import sys
 import bz2
 import copy
 import csv
 import re
 #import xml.etree.ElementTree as ET
 import xml.etree.cElementTree as ET
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import pprint
 import json
-import codecs
+import resource
+import multiprocessing
+import shutil
+import gzip
+import struct
+import time
+import zlib
+import threading
+import Queue
+import array
+import bisect
+import math
+import mmap
+import random
+import itertools
+import cPickle as pickle
+import io
+import collections
+import hashlib
+import heapq
+import traceback
+import cProfile
+import pstats
+from contextlib import contextmanager
+from xml.sax.saxutils import quoteattr
+
+MB = 1024 * 1024
+# Buffer size for writing and reading back the json output
+OUTPUT_BUFFER_SIZE = 4 * MB
+COMPRESSED_EXTS = ('.bz2', '.gz', '.zip')
+PBF_EXT = '.pbf'
 
 # Utility functions to find and uncompress files, find MongoDB instances etc.
 def find_file(data_dir, fname):
+    """Compressed extracts are read as streams by open_osm(), so they are
+    no longer uncompressed onto the disk. An uncompressed copy left over
+    from earlier runs is still preferred, since it can be parsed in
+    parallel chunks."""
     fullPath = os.path.join(data_dir, fname)
     fileRoot, fileExt = os.path.splitext(fullPath)
-    if fileExt == '.zip':
-        if not os.path.exists(fileRoot):
-            from zipfile import ZipFile
-            with ZipFile(fullPath, 'r') as myzip:
-                #myzip.extractall()
-                myzip.extract(fileRoot)
-        fname = fileRoot
-    elif fileExt == '.bz2':
-        if not os.path.exists(fileRoot):
-            from bz2 import BZ2File
-            with BZ2File(fullPath, 'r') as mybzip:
-                with open(fileRoot, 'w') as ofile:
-                    for line in mybzip:
-                        ofile.write(line)
+    if fileExt in COMPRESSED_EXTS and os.path.exists(fileRoot):
         fname = fileRoot
     else:
         fname = fullPath
     return fname
 
+def is_compressed(fname):
+    return os.path.splitext(fname)[1] in COMPRESSED_EXTS
+
+def is_pbf(fname):
+    return os.path.splitext(fname)[1] == PBF_EXT
+
+def osm_basename(fname):
+    """Name of the osm file without directory and compression extension"""
+    fname = os.path.basename(fname)
+    if is_compressed(fname) or is_pbf(fname):
+        fname = os.path.splitext(fname)[0]
+    return fname
+
+def open_osm(fname, processes=1):
+    """Open an osm file, or a .bz2, .gz or .zip extract of one, as a
+    stream of uncompressed xml"""
+    fileExt = os.path.splitext(fname)[1]
+    if fileExt == '.bz2':
+        if is_multistream_bz2(fname):
+            return BZ2StreamReader(fname, processes)
+        return bz2.BZ2File(fname, 'rb')
+    elif fileExt == '.gz':
+        return gzip.open(fname, 'rb')
+    elif fileExt == '.zip':
+        from zipfile import ZipFile
+        myzip = ZipFile(fname, 'r')
+        names = myzip.namelist()
+        member = osm_basename(fname)
+        if member not in names:
+            osm_names = [name for name in names if name.endswith('.osm')]
+            member = osm_names[0] if osm_names else names[0]
+        # The member keeps its own handle on the archive file
+        return myzip.open(member)
+    return open(fname, 'rb')
+
+"""Read bz2 extracts in parallel:
+
+Extracts compressed with pbzip2 or lbzip2 are a sequence of independent
+bz2 streams, each starting at a byte aligned 'BZh' header followed by
+the block magic. Such files are cut into segments at stream headers,
+and the segments are decompressed by a pool of worker processes, pbzip2
+style. Only a small window of segments is in flight at any time, which
+bounds the memory used to feed the parser. A plain single stream file
+has no byte aligned block boundaries, and is decompressed serially.
+"""
+BZ2_STREAM_RE = re.compile(r'BZh[1-9]1AY&SY')
+BZ2_SEGMENT_SIZE = MB
+
+def is_multistream_bz2(fname, probe_size=4 * MB):
+    with open(fname, 'rb') as bzfile:
+        head = bzfile.read(probe_size)
+    return BZ2_STREAM_RE.search(head, 1) is not None
+
+def iter_bz2_segments(fname, segment_size=BZ2_SEGMENT_SIZE):
+    """Yield the compressed file in pieces of whole bz2 streams"""
+    with open(fname, 'rb') as bzfile:
+        buf = ''
+        while True:
+            block = bzfile.read(segment_size)
+            if not block:
+                break
+            buf += block
+            if len(buf) < segment_size:
+                continue
+            starts = [m.start() for m in BZ2_STREAM_RE.finditer(buf, 1)]
+            if starts:
+                yield buf[:starts[-1]]
+                buf = buf[starts[-1]:]
+        if buf:
+            yield buf
+
+def decompress_bz2(data):
+    """Decompress a segment of one or more whole bz2 streams"""
+    out = []
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        out.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+        if not data:
+            # Past the end of a stream the decompressor raises EOFError;
+            # otherwise the segment was cut in the middle of a stream
+            try:
+                decompressor.decompress('')
+            except EOFError:
+                break
+            raise IOError("Truncated bz2 stream")
+    return ''.join(out)
+
+class BZ2StreamReader(object):
+    """File like object reading multi-stream bz2 files, decompressing
+    up to window segments ahead on a pool of worker processes"""
+    def __init__(self, fname, processes=1, window=None):
+        self.pool = None
+        if processes > 1:
+            self.pool = multiprocessing.Pool(processes)
+        self.window = window or 2 * processes
+        self.blocks = self.iter_blocks(fname)
+        self.buf = ''
+        self.pos = 0
+
+    def iter_blocks(self, fname):
+        segments = iter_bz2_segments(fname)
+        if self.pool is None:
+            for segment in segments:
+                yield decompress_bz2(segment)
+            return
+        pending = []
+        for segment in segments:
+            pending.append(self.pool.apply_async(decompress_bz2, (segment,)))
+            if len(pending) >= self.window:
+                yield pending.pop(0).get()
+        while pending:
+            yield pending.pop(0).get()
+
+    def read(self, size=-1):
+        data = []
+        while size != 0:
+            if self.pos >= len(self.buf):
+                self.buf = next(self.blocks, '')
+                self.pos = 0
+                if not self.buf:
+                    break
+            end = len(self.buf)
+            if size > 0:
+                end = min(end, self.pos + size)
+                size -= end - self.pos
+            data.append(self.buf[self.pos:end])
+            self.pos = end
+        return ''.join(data)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 # Get a MongoDb instance
 def get_mongodb(db_name):
     # For local use
@@ -42,39 +205,415 @@ def get_mongodb(db_name):
     db = client[db_name]
     return db
 
-
-import xml.etree.ElementTree as ET  # Use cElementTree or lxml if too slow
-
 OSM_FILE = "osm_file.osm"  # Replace this with your osm file
 
 ############################################################################
-# Create a smaller sample of the osm file
+# Stream the osm file one top level element at a time
 ############################################################################
 
-def sample_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag
+def iter_elements(osm_file, tags=None, with_root=True):
+    """Yield each top level element (node, way, relation, bounds ...) of
+    the osm file once it is complete, together with its <tag> and <nd>
+    children. If tags is given, only elements of those types are yielded.
 
-    Reference:
-    http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
+    An element is freed as soon as the caller asks for the next one, so
+    memory use does not grow with the size of the file. Callers must not
+    hold on to elements (or their children) across iterations.
+
+    The root <osm> element is yielded last, with its children removed,
+    unless with_root is False.
     """
     context = ET.iterparse(osm_file, events=('start', 'end'))
     _, root = next(context)
+    depth = 1
     for event, elem in context:
-        if event == 'end' and elem.tag in tags:
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth > 1:
+            continue
+        if elem is root and not with_root:
+            break
+        if tags is None or elem.tag in tags:
             yield elem
-            root.clear()
+        if elem is not root:
+            elem.clear()
+        del root[:]
+
+"""Expat parser backend:
+
+Building ElementTree elements for every node, way and tag costs more
+than the audits themselves. iter_expat_elements() drives the expat
+parser directly, and collects each top level element into an OSMRecord
+holding its tag name, attributes and children. Records offer the parts
+of the Element interface the auditors and shape_element() use (tag,
+attrib, iter() and iteration over the children), so the two backends
+can be swapped freely. XML_PARSER selects the backend used for xml
+files; 'etree' goes back to iterparse().
+"""
+XML_PARSER = 'expat'
+EXPAT_BLOCK_SIZE = 64 * 1024
+
+class OSMChild(object):
+    """Second level element, like <tag> or <nd>"""
+    __slots__ = ('tag', 'attrib')
+
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+
+    def __iter__(self):
+        return iter(())
+
+    def iter(self, tag=None):
+        if tag is None or self.tag == tag:
+            yield self
+
+class OSMRecord(OSMChild):
+    """Top level element with its children"""
+    __slots__ = ('children',)
+
+    def __init__(self, tag, attrib):
+        OSMChild.__init__(self, tag, attrib)
+        self.children = []
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+    def iter(self, tag=None):
+        if tag is None or self.tag == tag:
+            yield self
+        for child in self.children:
+            if tag is None or child.tag == tag:
+                yield child
+
+    def append(self, child):
+        self.children.append(child)
+
+def add_child(elem, tag, attrib):
+    """Add a child element to an Element or OSMRecord"""
+    if isinstance(elem, OSMRecord):
+        child = OSMChild(tag, attrib)
+        elem.append(child)
+        return child
+    return ET.SubElement(elem, tag, attrib)
+
+def fix_text(text):
+    # Like ElementTree, keep ascii strings as str and decode the rest
+    try:
+        text.decode('ascii')
+        return text
+    except UnicodeDecodeError:
+        return text.decode('utf-8')
+
+HIGH_BYTE_RE = re.compile(r'[\x80-\xff]')
+
+def iter_expat_elements(osm_file, tags=None, with_root=True):
+    """Yield each top level element of the osm file as an OSMRecord,
+    like iter_elements() does with ElementTree elements"""
+    import xml.parsers.expat
+    parser = xml.parsers.expat.ParserCreate()
+    # Get utf-8 encoded str rather than unicode for all strings, and only
+    # decode them while the input has any non ascii bytes
+    parser.returns_unicode = False
+    non_ascii = [False, False]
+    depth = [0]
+    stack = []
+    done = []
+
+    def start_element(name, attrib):
+        if non_ascii[0] or non_ascii[1]:
+            for attr, value in attrib.iteritems():
+                attrib[attr] = fix_text(value)
+        depth[0] += 1
+        if depth[0] == 3:
+            stack[-1].children.append(OSMChild(name, attrib))
+        else:
+            stack.append(OSMRecord(name, attrib))
+
+    def end_element(name):
+        depth[0] -= 1
+        if depth[0] == 1:
+            record = stack.pop()
+            if tags is None or name in tags:
+                done.append(record)
+        elif depth[0] == 0 and with_root:
+            if tags is None or name in tags:
+                done.append(stack.pop())
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    while True:
+        block = osm_file.read(EXPAT_BLOCK_SIZE)
+        # An element can start in the previous block
+        non_ascii[0] = non_ascii[1]
+        non_ascii[1] = HIGH_BYTE_RE.search(block) is not None
+        parser.Parse(block, not block)
+        for record in done:
+            yield record
+        del done[:]
+        if not block:
+            break
+
+XML_PARSERS = {
+    'expat': iter_expat_elements,
+    'etree': iter_elements,
+}
+
+def benchmark_parsers(fname, parsers=('etree', 'expat')):
+    """Time each xml parser backend on the same file, first parsing
+    only, then with the audits and the reshape"""
+    size = os.path.getsize(fname)
+    for parser in parsers:
+        count = 0
+        start = time.time()
+        with open_osm(fname) as osm_file:
+            for element in iter_xml_elements(osm_file, parser=parser):
+                count += 1
+        parse_time = time.time() - start
+        print "{:6s} parse: {:.2f} s, {:.0f} elements/s, {:.1f} MB/s".format(
+            parser, parse_time, count / parse_time, size / parse_time / MB)
+
+        auditors = [TagAuditor(), KeyAuditor(), UserAuditor(), 
+                    AddressAuditor(False), Reshaper()]
+        start = time.time()
+        for auditor in auditors:
+            auditor.start(fname)
+        with open_osm(fname) as osm_file:
+            for element in iter_xml_elements(osm_file, parser=parser):
+                for auditor in auditors:
+                    auditor.process(element)
+        for auditor in auditors:
+            auditor.finish()
+        audit_time = time.time() - start
+        print "{:6s} audit and reshape: {:.2f} s, {:.0f} elements/s".format(
+            parser, audit_time, count / audit_time)
+
+def iter_xml_elements(osm_file, with_root=True, parser=None):
+    return XML_PARSERS[parser or XML_PARSER](osm_file, with_root=with_root)
+
+def iter_file_elements(fname, osm_file, parser=None):
+    """Top level elements of an opened xml or pbf file"""
+    if is_pbf(fname):
+        return iter_pbf_elements(osm_file)
+    return iter_xml_elements(osm_file, parser=parser)
+
+############################################################################
+# Create a smaller sample of the osm file
+############################################################################
+
+"""
+sample_osm() writes a sample of the top level elements of an osm file,
+reproducibly for a given seed. The modes are:
+
+- 'ratio': keep each element with probability ratio
+- 'stratified': like 'ratio', with a ratio for each element type, as in
+  {'node': 0.01, 'way': 0.1, 'relation': 1.0}
+- 'reservoir': keep exactly size elements, each equally likely
+
+In ratio mode an uncompressed xml file can be sampled by seeking
+instead of parsing it all: random byte offsets are drawn, and each one
+resyncs on the boundaries of the element it falls into.
+
+With keep_refs, the nodes referenced by sampled ways are added too, so
+that the sample has no dangling refs. They are found in a second pass,
+which stops at the first way. The sample is then held in memory, and
+written in the usual order: nodes, ways and relations, each by id.
+"""
+SAMPLE_TYPES = ('node', 'way', 'relation')
+SAMPLE_PROBE_SIZE = 4 * MB
+SAMPLE_BLOCK_SIZE = 8 * 1024
+ELEMENT_START_RE = re.compile(r'<(?:node|way|relation)\b')
+ELEMENT_ID_RE = re.compile(r'\sid="(-?\d+)"')
+ND_REF_RE = re.compile(r'<nd\s+ref="(-?\d+)"')
+
+def element_xml(elem):
+    """Serialize an element read by either parser backend"""
+    def attrs(attrib):
+        return ''.join(' {}={}'.format(key, quoteattr(value)) 
+                       for key, value in attrib.iteritems())
+    children = list(elem)
+    if not children:
+        xml = ' <{}{}/>\n'.format(elem.tag, attrs(elem.attrib))
+    else:
+        xml = ' <{}{}>\n{} </{}>\n'.format(
+            elem.tag, attrs(elem.attrib), 
+            ''.join('  <{}{}/>\n'.format(child.tag, attrs(child.attrib))
+                    for child in children), elem.tag)
+    return xml.encode('utf-8') if isinstance(xml, unicode) else xml
+
+def read_element_at(osm_file, start, block_size=SAMPLE_BLOCK_SIZE):
+    """Raw xml of the top level element starting at offset start"""
+    osm_file.seek(start)
+    buf = ''
+    while True:
+        block = osm_file.read(block_size)
+        buf += block
+        tag = re.match(r'<(\w+)', buf).group(1)
+        gt = buf.find('>')
+        if gt >= 0:
+            if buf[gt - 1] == '/':
+                return tag, buf[:gt + 1]
+            end = buf.find('</' + tag + '>', gt)
+            if end >= 0:
+                return tag, buf[:end + len(tag) + 3]
+        if not block:
+            raise IOError("Unterminated element at offset {}".format(start))
+
+def find_element_around(osm_file, offset, block_size=SAMPLE_BLOCK_SIZE):
+    """Offset of the last top level element start at or before offset,
+    or None if there is none"""
+    end = offset + len('<relation')
+    while end > 0:
+        start = max(0, end - block_size)
+        osm_file.seek(start)
+        buf = osm_file.read(end - start)
+        hit = max(buf.rfind(elem_start, 0, offset - start + len(elem_start))
+                  for elem_start in ELEMENT_STARTS)
+        if hit >= 0:
+            return start + hit
+        # Keep enough overlap for a start straddling the blocks
+        end = start + len('<relation')
+        if start == 0:
+            break
+    return None
 
-def sample_elements(infname, sample_fname):
+def iter_seek_sample(fname, ratio, rand):
+    """Yield (type, id, xml) of elements at random offsets of the file.
+
+    An offset picks the element whose span, from its start to the next
+    element start, it falls into. That favours large elements, so the
+    first offset into an element decides it once for all the offsets
+    into it: the element is kept with probability ratio / the chance
+    that any offset falls into its span. Enough offsets are drawn that
+    this chance is at least ratio for the smallest span at the start of
+    the file, min_size. A span further on shorter than that is always
+    kept, so such elements are slightly undersampled."""
+    size = os.path.getsize(fname)
+    with open(fname, 'rb') as osm_file:
+        head = osm_file.read(SAMPLE_PROBE_SIZE)
+        starts = sorted(m.start() for m in ELEMENT_START_RE.finditer(head))
+        gaps = [b - a for a, b in zip(starts[:-1], starts[1:])]
+        min_size = min(gaps) if gaps else size
+        if min_size >= size:
+            nsamples = 1
+        else:
+            nsamples = int(math.ceil(math.log1p(-ratio) / 
+                                     math.log1p(-float(min_size) / size)))
+        offsets = sorted(rand.randrange(size) for i in xrange(nsamples))
+        last_start = None
+        for offset in offsets:
+            start = find_element_around(osm_file, offset)
+            if start is None or start == last_start:
+                # Offsets into the same element share its decision
+                continue
+            last_start = start
+            tag, xml = read_element_at(osm_file, start)
+            end = find_element_start(osm_file, start + len(xml),
+                                     SAMPLE_BLOCK_SIZE)
+            span = (size if end is None else end) - start
+            if span >= size:
+                hit = 1.0
+            else:
+                hit = -math.expm1(nsamples * math.log1p(-float(span) / size))
+            if rand.random() * hit >= ratio:
+                continue
+            yield tag, int(ELEMENT_ID_RE.search(xml).group(1)), ' ' + xml + '\n'
+
+def test_seek_sample(data_dir, elements=100000, ratio=0.1, seed=0):
+    fname = os.path.join(data_dir, "seektest.osm")
+    generate_osm(fname, elements, seed=seed)
+    counts = defaultdict(int)
+    for tag, elem_id, xml in iter_seek_sample(fname, ratio, 
+                                              random.Random(seed)):
+        counts[tag] += 1
+    os.remove(fname)
+    nways = int(elements * 0.1)
+    # Nodes and ways differ in size, but are sampled alike
+    for tag, total in (('node', elements - nways), ('way', nways)):
+        expected = ratio * total
+        print "Seek sample of {}s: {} of {} expected".format(
+            tag, counts[tag], expected)
+        assert abs(counts[tag] - expected) < 4 * math.sqrt(expected)
+
+def iter_parse_sample(fname, mode, ratio, size, rand):
+    """Yield (type, id, xml) of the sampled elements, parsing the file"""
+    ratios = ratio if isinstance(ratio, dict) else {}
+    reservoir = []
+    with open_osm(fname) as osm_file:
+        elements = (elem for elem in iter_file_elements(fname, osm_file)
+                    if elem.tag in SAMPLE_TYPES)
+        for i, elem in enumerate(elements):
+            if mode == 'reservoir':
+                # Algorithm R: the i-th element replaces a random one
+                # with probability size / (i + 1)
+                j = i if i < size else rand.randint(0, i)
+                if j < size:
+                    item = (elem.tag, int(elem.attrib['id']), 
+                            element_xml(elem))
+                    if i < size:
+                        reservoir.append(item)
+                    else:
+                        reservoir[j] = item
+                continue
+            keep = ratios.get(elem.tag, 0.0) if mode == 'stratified' else ratio
+            if rand.random() < keep:
+                yield elem.tag, int(elem.attrib['id']), element_xml(elem)
+    for item in reservoir:
+        yield item
+
+def iter_referenced_nodes(fname, node_ids):
+    """Yield (type, id, xml) of the nodes with the given ids"""
+    with open_osm(fname) as osm_file:
+        for elem in iter_file_elements(fname, osm_file):
+            if elem.tag in ('way', 'relation'):
+                # Nodes come first in osm files
+                break
+            if elem.tag == 'node' and int(elem.attrib['id']) in node_ids:
+                yield 'node', int(elem.attrib['id']), element_xml(elem)
+
+def sample_osm(infname, sample_fname, mode='ratio', ratio=0.1, size=1000,
+               seed=0, seek=False, keep_refs=False):
+    rand = random.Random(seed)
+    if seek:
+        if mode != 'ratio' or is_compressed(infname) or is_pbf(infname):
+            raise ValueError("Only ratio samples of uncompressed xml files "
+                             "can be taken by seeking")
+        if not 0 < ratio < 1:
+            raise ValueError("A sample taken by seeking needs a ratio "
+                             "between 0 and 1")
+        items = iter_seek_sample(infname, ratio, rand)
+    else:
+        items = iter_parse_sample(infname, mode, ratio, size, rand)
+    if keep_refs or mode == 'reservoir':
+        items = list(items)
+    if keep_refs:
+        sampled = set(elem_id for tag, elem_id, xml in items if tag == 'node')
+        refs = set()
+        for tag, elem_id, xml in items:
+            if tag == 'way':
+                refs.update(int(ref) for ref in ND_REF_RE.findall(xml))
+        items.extend(iter_referenced_nodes(infname, refs - sampled))
+    if isinstance(items, list):
+        items.sort(key=lambda (tag, elem_id, xml): 
+                   (SAMPLE_TYPES.index(tag), elem_id))
+    count = 0
     with open(sample_fname, 'wb') as output:
         output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-        output.write('<osm>\n  ')
-        
-        # Write every 10th top level element
-        for i, element in enumerate(sample_element(infname)):
-            if i % 10 == 0:
-                output.write(ET.tostring(element, encoding='utf-8'))
+        output.write('<osm>\n')
+        for tag, elem_id, xml in items:
+            output.write(xml)
+            count += 1
+        output.write('</osm>\n')
+    return count
 
-        output.write('</osm>')
+def sample_elements(infname, sample_fname, ratio=0.1, seed=0):
+    """Write a 1 in 10 sample of the top level elements"""
+    return sample_osm(infname, sample_fname, 'ratio', ratio, seed=seed)
 
 ############################################################################
 # Audit and clean openstreet data programmatically by SAX parsing the xml file
@@ -84,21 +623,18 @@ def sample_elements(infname, sample_fname):
 Assess the size of the map by determining the number of occurences of
 each tag
 """
-def count_tags(fname):
-    tags = {}
-    with open(fname, "r") as osm_file:
-        for event, elem in ET.iterparse(osm_file):
-            if elem.tag in tags:
-                tags[elem.tag] += 1
-            else:
-                tags[elem.tag] = 1
+def count_tag(elem, tags):
+    if elem.tag in tags:
+        tags[elem.tag] += 1
+    else:
+        tags[elem.tag] = 1
     return tags
 
+def count_tags(fname):
+    return run_auditors(fname, [TagAuditor()])[0].tags
+
 def audit_tags(fname):
-    tags = count_tags(fname)
-    print "\nAuditing tags"
-    print "=========================================================="
-    pprint.pprint(tags)
+    run_auditors(fname, [TagAuditor()])[0].report()
 
 """Audit keys:
 
@@ -111,10 +647,11 @@ tags. We would like to change the data model and expand the
 {"street": "Some value"}}
 
 """
+lower = re.compile(r'^([a-z]|_)*$')
+lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
+problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+
 def key_type(element, keys):
-    lower = re.compile(r'^([a-z]|_)*$')
-    lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
-    problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
     if element.tag == "tag":
         key = element.attrib['k']
         if problemchars.search(key):
@@ -128,13 +665,7 @@ def key_type(element, keys):
     return keys
 
 def audit_keys(fname):
-    keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
-    with open(fname, "r") as osm_file:
-        for _, element in ET.iterparse(osm_file):
-            keys = key_type(element, keys)
-    print "\nAuditing keys"
-    print "=========================================================="
-    pprint.pprint(keys)
+    run_auditors(fname, [KeyAuditor()])[0].report()
 
 """Audit users: 
 
@@ -146,24 +677,18 @@ def get_user(element):
     else:
         return None
 
-def audit_users(fname):
-    users = {}
-    with open(fname, "r") as osm_file:
-        for _, element in ET.iterparse(osm_file):
-            if element.tag == "node" or element.tag == "way" :
-                user = get_user(element)
-                #users.add(get_user(element))
-                if user in users:
-                    users[user] += 1
-                else:
-                    users[user] = 1
+def count_user(element, users):
+    if element.tag == "node" or element.tag == "way" :
+        user = get_user(element)
+        #users.add(get_user(element))
+        if user in users:
+            users[user] += 1
+        else:
+            users[user] = 1
+    return users
 
-    print "\nAuditing users"
-    print "=========================================================="
-    print "Number of users = ", len(users)
-    pprint.pprint(users)
-    if fname.endswith("example.osm"):
-        assert len(users) == 8
+def audit_users(fname):
+    run_auditors(fname, [UserAuditor()])[0].report()
 
 """Audit and clean street types: 
 
@@ -177,17 +702,26 @@ street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
 def is_street_name(elem):
     return (elem.tag == "tag") and (elem.attrib['k'] == "addr:street")
 
-def audit_street_type(street_name, rare_street_types):
-    expected = ["Avenue","Boulevard", "Connector", "Commons", "Court", 
-                "Drive", "Parkway", "Place","Lane","Road", "Row",
-                "Sarani", "Square", "Street", "Trail"]
+expected_street_types = frozenset([
+    "Avenue","Boulevard", "Connector", "Commons", "Court", 
+    "Drive", "Parkway", "Place","Lane","Road", "Row",
+    "Sarani", "Square", "Street", "Trail"])
+
+def street_type_class(street_name, street_types=expected_street_types):
+    """The street type of a street name if it is not an expected one,
+    'UNKNOWN' if there is none, otherwise None"""
     m = street_type_re.search(street_name)
     if m:
         street_type = m.group()
-        if street_type not in expected:
-            rare_street_types[street_type].add(street_name)
-    else:
-        rare_street_types['UNKNOWN'].add(street_name)
+        if street_type not in street_types:
+            return street_type
+        return None
+    return 'UNKNOWN'
+
+def audit_street_type(street_name, rare_street_types):
+    street_type = cleaning_rules.street_type(street_name)
+    if not street_type is None:
+        rare_street_types[street_type].add(street_name)
 
 street_mapping = { 
     "street": "Street",
@@ -214,7 +748,9 @@ street_mapping = {
     "lane": "Lane",
     "ln": "Lane"
 }
-def fix_street_name(name, mapping):
+housenum_re = re.compile(r'^\s*\d+/?\d*[a-zA-Z]?,?[^a-zA-Z]*')
+
+def clean_street_name(name, mapping):
     fixed_name = name
 
     # Use more standard names for street types
@@ -226,12 +762,15 @@ def fix_street_name(name, mapping):
 
     # If steet name contains street number, move the info to house number
     housenum = None
-    housenum_re = re.compile(r'^\s*\d+/?\d*[a-zA-Z]?,?[^a-zA-Z]*')
     m = housenum_re.search(fixed_name)
     if m:
         re_match = m.group()
         housenum = re_match.rstrip().rstrip(',').lstrip()
         fixed_name = fixed_name[len(re_match):]
+    return housenum, fixed_name
+
+def fix_street_name(name, mapping):
+    housenum, fixed_name = clean_street_name(name, mapping)
     if name != fixed_name:
         print "Cleaning street name: ", name, " to ", fixed_name
     return housenum, fixed_name
@@ -268,21 +807,30 @@ def fix_city_name(name, city_mapping):
     return fixed_name
 
 postcode_re = re.compile(r'\s*\d+\s*')
+# Digits in a valid postcode, 6 for an Indian PIN code
+POSTCODE_LENGTH = 6
+
 def is_postcode(elem):
     mykey = elem.attrib['k']
     return (mykey.startswith("addr:post") and mykey.endswith("code"))
 
+def postcode_class(code, pattern=postcode_re):
+    """The digits of a postcode, or None if it has none"""
+    m = pattern.search(code)
+    if m:
+        re_match = m.group()
+        return re_match.rstrip().rstrip(',').lstrip()
+    return None
+
 def audit_postcode(tagelem, postcodes):
     isValid = False
     code = tagelem.attrib['v']
     pkey = tagelem.attrib['k']
-    m = postcode_re.search(code)
-    if m:
-        re_match = m.group()
-        pcode = re_match.rstrip().rstrip(',').lstrip()
+    pcode = cleaning_rules.postcode(code)
+    if not pcode is None:
         pcode_key = pkey+str(len(pcode))
         postcodes[pcode_key].add(pcode)
-        if len(pcode) == 6:
+        if len(pcode) == cleaning_rules.postcode_length:
             isValid = True
     else:
         postcodes[pkey+str(0)].add(code)
@@ -294,7 +842,90 @@ def fix_postcode(name):
         print "Cleaning post code: ", code, " to ", fixed_code
     return fixed_code
     
+"""Cleaning rules:
+
+The same street, city and postcode values come up again and again
+across the elements of a map. CleaningRules holds its own copy of the
+mapping tables, and remembers the result for each distinct value in a
+bounded least recently used cache, so that each value is fixed or
+classified only once. The expected street types and the postcode
+pattern and length are part of the rules too, so that other regions
+can bring their own.
+"""
+RULE_CACHE_SIZE = 100000
+
+class LRUCache(object):
+    """Memoize a function of one argument, keeping the results for up to
+    maxsize most recently used arguments"""
+    def __init__(self, func, maxsize=RULE_CACHE_SIZE):
+        self.func = func
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, arg):
+        try:
+            result = self.results.pop(arg)
+            self.hits += 1
+        except KeyError:
+            result = self.func(arg)
+            self.misses += 1
+            if len(self.results) >= self.maxsize:
+                self.results.popitem(last=False)
+        self.results[arg] = result
+        return result
+
+class CleaningRules(object):
+    def __init__(self, street_mapping, city_mapping, 
+                 cache_size=RULE_CACHE_SIZE, 
+                 street_types=expected_street_types, 
+                 postcode_pattern=postcode_re.pattern,
+                 postcode_length=POSTCODE_LENGTH):
+        self.street_mapping = dict(street_mapping)
+        self.city_mapping = dict(city_mapping)
+        self.street_types = frozenset(street_types)
+        self.postcode_re = re.compile(postcode_pattern)
+        self.postcode_length = postcode_length
+        # Cleaned street names are still reported for every value
+        self.caches = {
+            "street": LRUCache(self.fix_street_name_uncached, cache_size),
+            "city": LRUCache(self.fix_city_name_uncached, cache_size),
+            "street_type": LRUCache(self.street_type_uncached, cache_size),
+            "postcode": LRUCache(self.postcode_uncached, cache_size),
+        }
+        self.street_type = self.caches["street_type"]
+        self.postcode = self.caches["postcode"]
 
+    def fix_street_name_uncached(self, name):
+        return clean_street_name(name, self.street_mapping)
+
+    def fix_city_name_uncached(self, name):
+        return fix_city_name(name, self.city_mapping)
+
+    def street_type_uncached(self, name):
+        return street_type_class(name, self.street_types)
+
+    def postcode_uncached(self, code):
+        return postcode_class(code, self.postcode_re)
+
+    def clean_street(self, name):
+        return self.caches["street"](name)
+
+    def fix_street(self, name):
+        housenum, fixed_name = self.clean_street(name)
+        if name != fixed_name:
+            print "Cleaning street name: ", name, " to ", fixed_name
+        return housenum, fixed_name
+
+    def fix_city(self, name):
+        return self.caches["city"](name)
+
+    def stats(self):
+        return dict((name, (cache.hits, cache.misses)) 
+                    for name, cache in self.caches.iteritems())
+
+cleaning_rules = CleaningRules(street_mapping, city_mapping)
 
 """ Audit and clean addresses:
 Top level functions to clean and audit addresses.
@@ -309,53 +940,39 @@ def clean_address(elem):
         if is_housenum(tagelem):
             housenum_elem = tagelem
         if is_street_name(tagelem):
-            housenum, fixed_name = fix_street_name(
-                tagelem.attrib['v'], street_mapping) 
+            housenum, fixed_name = cleaning_rules.fix_street(
+                tagelem.attrib['v'])
             tagelem.attrib['v'] = fixed_name
         if is_city_name(tagelem):
-            fixed_name = fix_city_name(tagelem.attrib['v'], city_mapping) 
+            fixed_name = cleaning_rules.fix_city(tagelem.attrib['v'])
             tagelem.attrib['v'] = fixed_name
     if not housenum is None:
         if housenum_elem is None:
             hnattrib = {'k': "addr:housenumber", 'v': housenum}
-            hn = ET.SubElement(elem, 'tag', hnattrib)
+            hn = add_child(elem, 'tag', hnattrib)
             print "house number attribute = ", hnattrib
             print "hn.attrib['v'] = ", hn.attrib['v']
         else:
-            housenum_elem['v'] = housenum
+            housenum_elem.attrib['v'] = housenum
     return elem
 
+def audit_address(elem, rare_street_types, city_names, postcodes):
+    for tagelem in elem.iter("tag"):
+        if is_street_name(tagelem):
+            audit_street_type(tagelem.attrib['v'], 
+                              rare_street_types)   
+        if is_city_name(tagelem):
+            audit_city_name(tagelem.attrib['v'], city_names)
+        if is_postcode(tagelem):
+            audit_postcode(tagelem, postcodes)
+
 def audit_clean_addresses(fname, cleanup=False):
-    city_names = set()
-    rare_street_types = defaultdict(set)
-    postcodes = defaultdict(set)
-    with open(fname, "r") as osm_file:
-        for event, elem in ET.iterparse(osm_file, events=("start",)):
-            if elem.tag == "node" or elem.tag == "way":
-                if cleanup:
-                    elem = clean_address(elem)
-                for tagelem in elem.iter("tag"):
-                    if is_street_name(tagelem):
-                        audit_street_type(tagelem.attrib['v'], 
-                                          rare_street_types)   
-                    if is_city_name(tagelem):
-                        audit_city_name(tagelem.attrib['v'], city_names)
-                    if is_postcode(tagelem):
-                        audit_postcode(tagelem, postcodes)
-
-
-    pprint.pprint(dict(rare_street_types))
-    pprint.pprint(city_names)
-    pprint.pprint(postcodes)
+    run_auditors(fname, [AddressAuditor(cleanup)])[0].report()
 
 def audit_addresses(fname):
-    print "\nAuditing addresses"
-    print "=========================================================="
     audit_clean_addresses(fname, False)
 
 def clean_addresses(fname):
-    print "\nCleaning addresses"
-    print "=========================================================="
     audit_clean_addresses(fname, True)
 
 ############################################################################
@@ -447,11 +1064,35 @@ In particular the following things should be done:
 should be turned into
 "node_refs": ["305896090", "1719825889"]
 """
-lower = re.compile(r'^([a-z]|_)*$')
-lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
-problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 CREATED = ["version", "changeset", "timestamp", "user", "uid"]
 
+# Classes of second level "k" values, with a cache of the class of each
+# distinct key
+IGNORED_KEY = "ignored"
+ADDRESS_KEY = "address"
+NESTED_ADDRESS_KEY = "nested_address"
+OTHER_KEY = "other"
+key_classes = {}
+
+def classify_key(key):
+    try:
+        return key_classes[key]
+    except KeyError:
+        pass
+    if problemchars.search(key):
+        key_class = IGNORED_KEY
+    elif key.startswith("addr:"):
+        if lower_colon.search(key[len("addr:"):]):
+            key_class = NESTED_ADDRESS_KEY
+        else:
+            key_class = ADDRESS_KEY
+    else:
+        key_class = OTHER_KEY
+    if len(key_classes) >= RULE_CACHE_SIZE:
+        key_classes.clear()
+    key_classes[key] = key_class
+    return key_class
+
 def is_valid(element):
     valid = False
     if element.tag != "node" or element.tag != "way":
@@ -489,30 +1130,41 @@ def shape_element(element):
             else:
                 node[attr] = val
 
-        # Reshape second-level element
+        # Reshape second-level elements in a single pass, cleaning
+        # the street, city and house number on the way
         address = None
         node_refs = None
-        for child in element.iter():
-            child = clean_address(child)
-            if 'k' in child.attrib:
+        housenum = None
+        housenum_key = None
+        for child in element:
+            if child.tag == "tag":
                 key = child.attrib['k']
                 val = child.attrib['v']
+                key_class = classify_key(key)
 
                 # if second level tag "k" value contains problematic 
                 # characters, it should be ignored
-                if problemchars.search(key):
+                if key_class is IGNORED_KEY:
                     continue
                 # if second level tag "k" value starts with "addr:", it 
                 # should be added to a dictionary "address"
-                if key.startswith("addr:"):
+                if key_class is ADDRESS_KEY:
                     if address is None:
                         address = {}
                     l2key = key[len("addr:"):]
-                    # if there is a second ":" that separates the
-                    # type/direction of a street, the tag should be
-                    # ignored, for example:
-                    if not lower_colon.search(l2key):
-                        address[l2key]=val
+                    if key == "addr:street":
+                        housenum, val = cleaning_rules.clean_street(val)
+                    elif key == "addr:city":
+                        val = cleaning_rules.fix_city(val)
+                    elif key == "addr:housenum":
+                        housenum_key = l2key
+                    address[l2key]=val
+                # if there is a second ":" that separates the
+                # type/direction of a street, the tag should be
+                # ignored, but the address is kept
+                elif key_class is NESTED_ADDRESS_KEY:
+                    if address is None:
+                        address = {}
                 # if second level tag "k" value does not start with
                 # "addr:", but contains ":", you can process it same
                 # as any other tag.
@@ -520,10 +1172,14 @@ def shape_element(element):
                     node[key]=val
 
             # Turn <nd> elements inside a "way" into node_refs array
-            if element.tag=='way' and child.tag=="nd" and 'ref' in child.attrib:
+            elif element.tag=='way' and child.tag=="nd" and 'ref' in child.attrib:
                 if node_refs is None:
                     node_refs = []
                 node_refs.append(child.attrib['ref'])
+        # A house number found in the street name goes to the house
+        # number of the address, like clean_address() does
+        if not housenum is None:
+            address[housenum_key or "housenumber"] = housenum
         if not created is None:
             node["created"]=created
         if not pos is None:
@@ -532,6 +1188,9 @@ def shape_element(element):
             node["address"]=address
         if not node_refs is None:
             node["node_refs"]=node_refs
+        # A "type" tag overwrites "type", so the element type is kept
+        # where no tag can reach it
+        node["osm_type"] = element.tag
         return node
     else:
         return None
@@ -542,6 +1201,7 @@ def test_reshaped_data(data):
         "id": "261114295", 
         "visible": "true", 
         "type": "node", 
+        "osm_type": "node", 
         "pos": [41.9730791, -87.6866303], 
         "created": {
             "changeset": "11129782", 
@@ -561,137 +1221,4759 @@ def test_reshaped_data(data):
                                       "2199822370", "2199822284", 
                                       "2199822281"]
 
+def make_test_way(nrefs, ntags):
+    way = ET.Element('way', {'id': "1", 'visible': "true", 'version': "1",
+                             'changeset': "1", 'user': "user", 'uid': "1",
+                             'timestamp': "2013-08-03T16:43:42Z"})
+    for ref in range(nrefs):
+        ET.SubElement(way, 'nd', {'ref': str(1000000 + ref)})
+    for i in range(ntags):
+        ET.SubElement(way, 'tag', {'k': "key{}".format(i), 'v': "value"})
+    ET.SubElement(way, 'tag', {'k': "addr:street", 'v': "12 Park st"})
+    ET.SubElement(way, 'tag', {'k': "addr:city", 'v': "kolkata"})
+    return way
+
+def benchmark_shape_element(nrefs=(10, 100, 1000, 10000), ntags=20, 
+                            min_time=0.5):
+    """Print the time shape_element() takes per way, for ways with more
+    and more node refs. The cost per ref should stay flat."""
+    for n in nrefs:
+        way = make_test_way(n, ntags)
+        count = 0
+        start = time.time()
+        while True:
+            shape_element(way)
+            count += 1
+            elapsed = time.time() - start
+            if elapsed >= min_time:
+                break
+        print "{:6d} refs: {:10.1f} us per way, {:.3f} us per ref".format(
+            n, 1e6 * elapsed / count, 1e6 * elapsed / count / n)
+
 # Reshape and write data into a json file
-def reshape_data(fname, pretty = False):
-    print "\nReshaping and saving data"
-    print "=========================================================="
-    # You do not need to change this file
-    file_out = "{0}.json".format(os.path.basename(fname))
-    data = []
-    with codecs.open(file_out, "w") as fo:
-        for _, element in ET.iterparse(fname):
-            shaped_elem = shape_element(element) if is_valid(element) else None
+def reshape_data(fname, pretty = False, compact = False):
+    """Yield each shaped element as soon as it is written to the json
+    file, so that it can be streamed on to the database without keeping
+    the whole data set in memory. With compact, ShapedRecords are
+    yielded, which take much less memory when they are kept."""
+    reshaper = Reshaper(pretty)
+    reshaper.start(fname)
+    table = {}
+    with open_osm(fname) as osm_file:
+        for element in iter_file_elements(fname, osm_file):
+            shaped_elem = reshaper.process(element)
             if not shaped_elem is None:
-                data.append(shaped_elem)
-                if pretty:
-                    fo.write(json.dumps(shaped_elem, indent=2)+"\n")
-                else:
-                    fo.write(json.dumps(shaped_elem) + "\n")
+                if compact:
+                    shaped_elem = compact_record(shaped_elem, table)
+                yield shaped_elem
+    reshaper.finish()
+    reshaper.report()
 
-    # Test reshaped data
-    if fname.endswith("example.osm"):
-        test_reshaped_data(data)
-    return data
+def iter_json_documents(json_fname, block_size=OUTPUT_BUFFER_SIZE):
+    """Yield the documents of a json file written by the Reshaper one at
+    a time, whether it was written pretty or not"""
+    decoder = json.JSONDecoder()
+    with open_output(json_fname) as json_file:
+        buf = ''
+        pos = 0
+        while True:
+            block = json_file.read(block_size)
+            buf = buf[pos:].lstrip() + block
+            pos = 0
+            while True:
+                # A document may continue in the next block
+                try:
+                    doc, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if not block and buf[pos:].strip():
+                        raise
+                    break
+                yield doc
+                pos = end
+                while pos < len(buf) and buf[pos].isspace():
+                    pos += 1
+            if not block:
+                break
 
-# Insert maps data into database
-def insert_maps(map_data, db):
-    print "\nInserting data into MongoDB"
+############################################################################
+# Compact shaped documents
+############################################################################
+"""
+Shaped documents held in memory repeat the same strings over and over:
+the keys, the user names and common values like "true" or
+"residential", and every node ref is a decimal string. compact_record()
+turns a shaped document into a ShapedRecord that holds:
+
+- the keys of the document as a tuple, shared by all documents with the
+  same keys in the same order
+- the values, with keys, user names and values of up to
+  INTERN_MAX_LENGTH characters interned in a string table shared by the
+  records, and nested dicts like "created" and "address" as records
+- the id, uid, changeset and version as ints, and the node_refs as an
+  array of 64 bit ints (see INT64_TYPECODE)
+
+Numbers that would not be written back the same, like "007", are kept
+as strings. to_dict() rebuilds the shaped document as an OrderedDict,
+since a dict built again may iterate its keys in another order, so that
+it serializes to the same json.
+"""
+INTERN_MAX_LENGTH = 32
+# ASCII digits only: isdigit() is also true of u'\xb2', which int()
+# rejects, and of Bengali digits
+DIGITS_RE = re.compile(r'[0-9]+\Z')
+NUMERIC_KEYS = frozenset(["id", "uid", "changeset", "version"])
+
+class ShapedRecord(object):
+    __slots__ = ('keys', 'values')
+
+    def __init__(self, keys, values):
+        self.keys = keys
+        self.values = values
+
+    def __getitem__(self, key):
+        try:
+            return expand_value(self.values[self.keys.index(key)])
+        except ValueError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def get(self, key, default=None):
+        return self[key] if key in self.keys else default
+
+    def to_dict(self):
+        return OrderedDict([(key, expand_value(value)) 
+                            for key, value in zip(self.keys, self.values)])
+
+def compact_value(key, value, table):
+    if isinstance(value, basestring):
+        if key in NUMERIC_KEYS and DIGITS_RE.match(value):
+            number = int(value)
+            if str(number) == value:
+                return number
+        if len(value) <= INTERN_MAX_LENGTH or key == "user":
+            return table.setdefault(value, value)
+        return value
+    elif isinstance(value, dict):
+        return compact_record(value, table)
+    elif key == "node_refs":
+        if all(DIGITS_RE.match(ref) and str(int(ref)) == ref 
+               for ref in value):
+            return array.array(INT64_TYPECODE, [int(ref) for ref in value])
+        return tuple(value)
+    elif isinstance(value, list):
+        return tuple(value)
+    return value
+
+def expand_value(value):
+    if isinstance(value, ShapedRecord):
+        return value.to_dict()
+    elif isinstance(value, (int, long)):
+        return str(value)
+    elif isinstance(value, array.array):
+        return ['%d' % ref for ref in value]
+    elif isinstance(value, tuple):
+        return list(value)
+    return value
+
+def compact_record(doc, table):
+    """Compact a shaped document, interning strings into the dict table"""
+    keys = tuple([table.setdefault(key, key) for key in doc])
+    return ShapedRecord(table.setdefault(keys, keys), 
+                        tuple([compact_value(key, value, table) 
+                               for key, value in doc.iteritems()]))
+
+def hold_documents(fname, compact, queue):
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        docs = list(reshape_data(fname, compact=compact))
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+    queue.put((len(docs), rss - start_rss))
+
+def test_compact_memory(fname):
+    """Check that the compact records serialize to the same json as the
+    shaped documents, and print the memory taken to hold all documents
+    of the file either way, each in a fresh process"""
+    table = {}
+    for doc in reshape_data(fname):
+        record = compact_record(doc, table)
+        assert json.dumps(record.to_dict()) == json.dumps(doc)
+    print "\nMemory holding the shaped documents of {}".format(fname)
     print "=========================================================="
-    for map_elem in map_data:
-        db.maps.insert(map_elem)
-    print "First document inserted into the maps database with {} documents:".format(db.maps.count())
-    pprint.pprint(db.maps.find_one())
+    used = {}
+    for compact in (False, True):
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=hold_documents, 
+                                       args=(fname, compact, queue))
+        proc.start()
+        count, used[compact] = queue.get()
+        proc.join()
+        print "{0:8}: {1} documents, {2:.1f} MB, {3:.0f} bytes each".format(
+            "compact" if compact else "dicts", count, used[compact] / 1024.0,
+            1024.0 * used[compact] / max(count, 1))
+    print "saving: {0:.1f}x".format(float(used[False]) / max(used[True], 1))
 
-# Perform some queries in the maps database
-def query_data(db):
-    print "\nPerform queries on MongoDB"
+############################################################################
+# Output formats: compact json lines and bson
+############################################################################
+"""
+The Reshaper writes the shaped documents through an OutputWriter, in one
+of two formats:
+
+- 'json': one compact json document per line, or indented with pretty.
+  The encoder can be the standard json module, or ujson or simplejson
+  when they are installed, which are faster.
+- 'bson': concatenated bson documents, the format of a mongodump
+  collection file, so that it loads straight into MongoDB with
+  mongorestore --db maps --collection maps <basename>.bson
+  The bson C extension of pymongo is used when it is installed, and
+  bson_document() otherwise.
+
+Encoded documents are collected into OUTPUT_BUFFER_SIZE blocks before
+they are written, and the file can be compressed with gzip (which
+mongorestore reads with --gzip) or with zstd when zstandard is
+installed. The parts written by the workers of a parallel run are not
+compressed, since compressed parts would be copied into the main
+output uncompressed and compressed again anyway.
+
+iter_output_documents() reads back any of these files.
+benchmark_outputs() compares the size and the write and read speed of
+the formats, encoders and compressions.
+"""
+OUTPUT_FORMATS = ('json', 'bson')
+OUTPUT_COMPRESSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+JSON_ENCODERS = ('json', 'ujson', 'simplejson')
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+OUTPUT_BENCHMARKS = [
+    ('json', 'json', None, True),
+    ('json', 'json', None, False),
+    ('json', 'ujson', None, False),
+    ('json', 'simplejson', None, False),
+    ('json', 'json', 'gzip', False),
+    ('json', 'json', 'zstd', False),
+    ('bson', None, None, False),
+    ('bson', None, 'gzip', False),
+    ('bson', None, 'zstd', False),
+]
+
+def output_fname(fname, output_format='json', compression=None):
+    """Name of the output file for the osm file fname"""
+    return "{0}.{1}{2}".format(osm_basename(fname), output_format, 
+                               OUTPUT_COMPRESSIONS[compression])
+
+def make_encoder(output_format='json', encoder='json', pretty=False):
+    """Function encoding a document into a string in the output format"""
+    if output_format == 'bson':
+        try:
+            from bson import BSON
+            return BSON.encode
+        except ImportError:
+            return bson_document
+    if output_format != 'json':
+        raise ValueError("Unknown output format: {}".format(output_format))
+    if encoder == 'ujson':
+        import ujson
+        if pretty:
+            return lambda doc: ujson.dumps(doc, indent=2) + "\n"
+        return lambda doc: ujson.dumps(doc) + "\n"
+    if encoder == 'simplejson':
+        import simplejson as json_module
+    elif encoder == 'json':
+        json_module = json
+    else:
+        raise ValueError("Unknown json encoder: {}".format(encoder))
+    if pretty:
+        return lambda doc: json_module.dumps(doc, indent=2) + "\n"
+    dumps = json_module.JSONEncoder(separators=(',', ':')).encode
+    return lambda doc: dumps(doc) + "\n"
+
+def bson_element(name, value):
+    name = name.encode('utf-8') if isinstance(name, unicode) else name
+    if isinstance(value, bool):
+        return '\x08' + name + '\x00' + ('\x01' if value else '\x00')
+    elif isinstance(value, (int, long)):
+        if -2**31 <= value < 2**31:
+            return '\x10' + name + '\x00' + struct.pack('<i', value)
+        return '\x12' + name + '\x00' + struct.pack('<q', value)
+    elif isinstance(value, float):
+        return '\x01' + name + '\x00' + struct.pack('<d', value)
+    elif isinstance(value, basestring):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return ('\x02' + name + '\x00' + struct.pack('<i', len(value) + 1) 
+                + value + '\x00')
+    elif isinstance(value, dict):
+        return '\x03' + name + '\x00' + bson_document(value)
+    elif isinstance(value, (list, tuple, array.array)):
+        return '\x04' + name + '\x00' + bson_document(
+            OrderedDict((str(i), item) for i, item in enumerate(value)))
+    elif value is None:
+        return '\x0a' + name + '\x00'
+    raise TypeError("Can not encode {!r} as bson".format(value))
+
+def bson_document(doc):
+    """Encode a shaped document as bson"""
+    body = ''.join([bson_element(name, value) 
+                    for name, value in doc.iteritems()])
+    return struct.pack('<i', len(body) + 5) + body + '\x00'
+
+def bson_decode(data, pos=0):
+    """Decode the bson document at pos in data, and return it with the
+    position after it"""
+    end = pos + struct.unpack_from('<i', data, pos)[0] - 1
+    pos += 4
+    doc = {}
+    while pos < end:
+        kind = data[pos]
+        name_end = data.index('\x00', pos + 1)
+        name = data[pos + 1:name_end].decode('utf-8')
+        pos = name_end + 1
+        if kind == '\x02':
+            size = struct.unpack_from('<i', data, pos)[0]
+            value = data[pos + 4:pos + 3 + size].decode('utf-8')
+            pos += 4 + size
+        elif kind == '\x10':
+            value = struct.unpack_from('<i', data, pos)[0]
+            pos += 4
+        elif kind == '\x12':
+            value = struct.unpack_from('<q', data, pos)[0]
+            pos += 8
+        elif kind == '\x01':
+            value = struct.unpack_from('<d', data, pos)[0]
+            pos += 8
+        elif kind == '\x03':
+            value, pos = bson_decode(data, pos)
+        elif kind == '\x04':
+            items, pos = bson_decode(data, pos)
+            value = [items[str(i)] for i in range(len(items))]
+        elif kind == '\x08':
+            value = data[pos] == '\x01'
+            pos += 1
+        elif kind == '\x0a':
+            value = None
+        else:
+            raise ValueError("Unsupported bson type {!r}".format(kind))
+        doc[name] = value
+    return doc, end + 1
+
+class OutputWriter(object):
+    """Write encoded documents to fname in large blocks, compressed with
+    compression if it is given. An uncompressed file can be continued
+    from offset instead of being written from the start."""
+    def __init__(self, fname, encode, compression=None, offset=None,
+                 buffer_size=OUTPUT_BUFFER_SIZE):
+        self.encode = encode
+        self.compression = compression
+        self.buffer_size = buffer_size
+        if compression == 'zstd':
+            import zstandard
+        elif compression not in OUTPUT_COMPRESSIONS:
+            raise ValueError("Unknown compression: {}".format(compression))
+        if offset is None:
+            self.raw = open(fname, 'wb')
+        else:
+            self.raw = open(fname, 'r+b')
+            self.raw.truncate(offset)
+            self.raw.seek(offset)
+        if compression == 'gzip':
+            self.fo = gzip.GzipFile(fileobj=self.raw, mode='wb', 
+                                    compresslevel=GZIP_LEVEL)
+        elif compression == 'zstd':
+            self.fo = zstandard.ZstdCompressor(
+                level=ZSTD_LEVEL).stream_writer(self.raw)
+        else:
+            self.fo = self.raw
+        self.blocks = []
+        self.size = 0
+        # Bytes written before compression
+        self.bytes = offset or 0
+
+    def write(self, doc):
+        self.write_raw(self.encode(doc))
+
+    def write_raw(self, data):
+        self.blocks.append(data)
+        self.size += len(data)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.fo.write(''.join(self.blocks))
+        self.bytes += self.size
+        self.blocks = []
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        if self.compression == 'gzip':
+            self.fo.close()
+        elif self.compression == 'zstd':
+            import zstandard
+            self.fo.flush(zstandard.FLUSH_FRAME)
+        self.raw.close()
+
+@contextmanager
+def open_output(fname):
+    """Open an output file written by an OutputWriter as a stream of
+    uncompressed data"""
+    raw = open(fname, 'rb')
+    try:
+        if fname.endswith(OUTPUT_COMPRESSIONS['gzip']):
+            stream = gzip.GzipFile(fileobj=raw, mode='rb')
+        elif fname.endswith(OUTPUT_COMPRESSIONS['zstd']):
+            import zstandard
+            stream = zstandard.ZstdDecompressor().stream_reader(raw)
+        else:
+            stream = raw
+        yield stream
+    finally:
+        raw.close()
+
+def iter_bson_documents(bson_fname, block_size=OUTPUT_BUFFER_SIZE):
+    """Yield the documents of a bson file one at a time"""
+    with open_output(bson_fname) as bson_file:
+        buf = ''
+        pos = 0
+        while True:
+            block = bson_file.read(block_size)
+            buf = buf[pos:] + block
+            pos = 0
+            while len(buf) - pos >= 4:
+                size = struct.unpack_from('<i', buf, pos)[0]
+                # A document may continue in the next block
+                if len(buf) - pos < size:
+                    break
+                doc, pos = bson_decode(buf, pos)
+                yield doc
+            if not block:
+                if pos < len(buf):
+                    raise ValueError("Truncated bson file: " + bson_fname)
+                break
+
+def iter_output_documents(fname):
+    """Yield the documents of a json or bson output file, or of all the
+    shards listed in a shard manifest"""
+    if os.path.basename(fname) == SHARD_MANIFEST:
+        return iter_manifest_documents(fname)
+    if '.bson' in os.path.basename(fname):
+        return iter_bson_documents(fname)
+    return iter_json_documents(fname)
+
+def benchmark_outputs(fname, outputs=OUTPUT_BENCHMARKS):
+    """Reshape the file into each (format, encoder, compression, pretty)
+    output, and print the size of the output and the speed of writing
+    and reading it back. Outputs needing a module that is not installed
+    are skipped."""
+    print "\nBenchmarking outputs of {}".format(fname)
     print "=========================================================="
+    results = []
+    for output_format, encoder, compression, pretty in outputs:
+        name = "{0}{1}{2}{3}".format(
+            output_format, '/' + encoder if encoder else '', 
+            '+' + compression if compression else '', 
+            ' pretty' if pretty else '')
+        try:
+            reshaper = Reshaper(pretty, output_format=output_format,
+                                compression=compression, 
+                                encoder=encoder or 'json')
+            run_auditors(fname, [reshaper])
+        except ImportError as e:
+            print "{0:28} skipped: {1}".format(name, e)
+            continue
+        size = os.path.getsize(reshaper.file_out)
+        start = time.time()
+        count = sum(1 for doc in iter_output_documents(reshaper.file_out))
+        read_time = time.time() - start
+        assert count == reshaper.count
+        results.append({"output": name, "bytes": size, 
+                        "write_seconds": reshaper.write_time,
+                        "read_seconds": read_time})
+        print ("{0:28} {1:8.1f} MB  write {2:7.1f} MB/s {3:9.0f} docs/s  "
+               "read {4:9.0f} docs/s").format(
+            name, float(size) / MB, 
+            float(reshaper.bytes_out) / MB / reshaper.write_time,
+            count / reshaper.write_time, count / read_time)
+        os.remove(reshaper.file_out)
+    return results
 
-    # number of unique users 
-    uniq_user_count = len(db.maps.distinct("created.user"))
-    print "There are {} of unique contrbuting users in Kolkata, India.".format(uniq_user_count)
-
-    # number of nodes and ways 
-    node_count = db.maps.find({"type" : "node"}).count()
-    ways_count = db.maps.find({"type" : "way"}).count()
-    print "There are {} nodes and {} ways in Kolkata, India ".format(node_count, ways_count)
-
-    # number of chosen type of nodes, like cafes, shops etc 
-    cafe_count = db.maps.find({"amenity" : "cafe"}).count()
-    restaurant_count = db.maps.find({"amenity" : "restaurant"}).count()
-    shop_count = db.maps.find({"amenity" : "shop"}).count()
-    hospital_count = db.maps.find({"amenity" : "hospital"}).count()
-    school_count = db.maps.find({"amenity" : "school"}).count()
-    college_count = db.maps.find({"amenity" : "college"}).count()
-    univ_count = db.maps.find({"amenity" : "university"}).count()
-
-    print """Amenities:
-        cafes: {}
-        restaurants: {}
-        shops: {}
-        hospitals: {}
-        schools: {}
-        colleges: {}
-        universities: {}
-    """.format(cafe_count, restaurant_count, shop_count, hospital_count, school_count, college_count, univ_count)
-
-    # Top 10 businesses
-    pipeline = [
-        {"$match" : {"type" : "node",
-                     "shop" : {"$exists" : 1}}},
-        {"$group" : {"_id" : "$shop",
-                     "count" : {"$sum" : 1}}},
-        {"$sort" : {"count" : -1}},
-        {"$limit" : 10}
-    ]
-    result = db.maps.aggregate(pipeline)
-    print "Top 10 businesses:"
-    pprint.pprint(result)
+############################################################################
+# Audit, clean and reshape the data in a single pass
+############################################################################
+"""
+Parsing the xml file takes most of the time on large metro extracts.
+Rather than parsing the file once for every audit, run_auditors()
+parses it once and hands each element over to a list of registered
+auditors. Every auditor keeps its own state, and prints its own report
+after the pass.
 
-    # Number of different types of highways
-    pipeline = [
-        {"$match" : {"type" : "way",
-                     "highway" : {"$exists" : 1}}},
-        {"$group" : {"_id" : "$highway",
-                     "count" : {"$sum" : 1}}},
-        {"$sort" : {"count" : -1}},
-        {"$limit" : 10}
-    ]
-    result = db.maps.aggregate(pipeline)
-    print "Number and types of highways"
-    pprint.pprint(result)
+Auditors are called in the order they are registered, so the ones
+looking at raw data must come before the ones that clean it up.
 
+When the file is parsed in parallel chunks, every chunk runs its own
+copy of the auditors (started with the chunk number as part), and the
+copies are merged back into the original auditors in file order.
+"""
+class Auditor(object):
+    title = None
+    # Whether checkpoint() can save the state in the middle of a pass
+    resumable = True
 
-    db.maps.aggregate
+    def start(self, fname, part=None):
+        self.fname = fname
 
-def wrangle_maps(fname):
-    # Audit some data elements
-    audit_tags(fname)
-    audit_keys(fname)
-    audit_users(fname)
-    audit_addresses(fname)
+    def process(self, element):
+        pass
 
-    # Clean up addresses and save to a json file
-    clean_addresses(fname)
+    def finish(self):
+        pass
 
-    # Reshape and write data into a json file
-    map_data = reshape_data(fname, True)
-    pprint.pprint(map_data[0])
+    def merge(self, other):
+        pass
 
-    # Insert maps data into database
-    db = get_mongodb('maps')
-    insert_maps(map_data, db) 
-    #db.maps.stats()
+    def report(self):
+        print "\n" + self.title
+        print "=========================================================="
 
-    # release memory held by map_data; we will work with mongodb from now on
-    del map_data
+    def cache_key(self):
+        """What the results depend on besides the file and the rules"""
+        return "{0}:{1}".format(type(self).__name__, self.title)
 
-    # Perform some queries in the maps database
-    query_data(db)
+    def outputs(self):
+        """Files written by the auditor"""
+        return []
 
-    # Clean up data
-    db.maps.drop()
+    def checkpoint(self):
+        """The state of the auditor in the middle of a pass"""
+        return dict(self.__dict__)
+
+    def resume(self, state):
+        self.__dict__.update(state)
+
+class TagAuditor(Auditor):
+    title = "Auditing tags"
+
+    def start(self, fname, part=None):
+        Auditor.start(self, fname, part)
+        self.tags = {}
+
+    def process(self, element):
+        for elem in element.iter():
+            count_tag(elem, self.tags)
+
+    def merge(self, other):
+        for tag, count in other.tags.iteritems():
+            self.tags[tag] = self.tags.get(tag, 0) + count
+
+    def report(self):
+        Auditor.report(self)
+        pprint.pprint(self.tags)
+
+class KeyAuditor(Auditor):
+    title = "Auditing keys"
+
+    def start(self, fname, part=None):
+        Auditor.start(self, fname, part)
+        self.keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, 
+                     "other": 0}
+
+    def process(self, element):
+        for tagelem in element.iter("tag"):
+            key_type(tagelem, self.keys)
+
+    def merge(self, other):
+        for key, count in other.keys.iteritems():
+            self.keys[key] += count
+
+    def report(self):
+        Auditor.report(self)
+        pprint.pprint(self.keys)
+
+class UserAuditor(Auditor):
+    title = "Auditing users"
+
+    def start(self, fname, part=None):
+        Auditor.start(self, fname, part)
+        self.users = {}
+
+    def process(self, element):
+        count_user(element, self.users)
+
+    def merge(self, other):
+        for user, count in other.users.iteritems():
+            self.users[user] = self.users.get(user, 0) + count
+
+    def report(self):
+        Auditor.report(self)
+        print "Number of users = ", len(self.users)
+        pprint.pprint(self.users)
+        if self.fname.endswith("example.osm"):
+            assert len(self.users) == 8
+
+class AddressAuditor(Auditor):
+    def __init__(self, cleanup=False):
+        self.cleanup = cleanup
+        self.title = "Cleaning addresses" if cleanup else "Auditing addresses"
+
+    def start(self, fname, part=None):
+        Auditor.start(self, fname, part)
+        self.city_names = set()
+        self.rare_street_types = defaultdict(set)
+        self.postcodes = defaultdict(set)
+
+    def process(self, element):
+        if element.tag == "node" or element.tag == "way":
+            if self.cleanup:
+                element = clean_address(element)
+            audit_address(element, self.rare_street_types, self.city_names,
+                          self.postcodes)
+
+    def merge(self, other):
+        self.city_names |= other.city_names
+        for street_type, names in other.rare_street_types.iteritems():
+            self.rare_street_types[street_type] |= names
+        for pcode_key, codes in other.postcodes.iteritems():
+            self.postcodes[pcode_key] |= codes
+
+    def report(self):
+        Auditor.report(self)
+        pprint.pprint(dict(self.rare_street_types))
+        pprint.pprint(self.city_names)
+        pprint.pprint(self.postcodes)
+
+class RuleCacheAuditor(Auditor):
+    """Hits and misses of the cleaning rule caches during the pass"""
+    title = "Cleaning rule caches"
+
+    def start(self, fname, part=None):
+        Auditor.start(self, fname, part)
+        # Worker processes keep their caches from chunk to chunk
+        self.started = cleaning_rules.stats()
+        self.stats = {}
+
+    def finish(self):
+        # In parallel runs this adds nothing to the merged chunk counts
+        for name, (hits, misses) in cleaning_rules.stats().iteritems():
+            hits0, misses0 = self.started[name]
+            self.add(name, hits - hits0, misses - misses0)
+
+    def checkpoint(self):
+        # A resumed pass starts counting from the caches of a new process
+        self.finish()
+        self.started = cleaning_rules.stats()
+        return Auditor.checkpoint(self)
+
+    def resume(self, state):
+        Auditor.resume(self, state)
+        self.started = cleaning_rules.stats()
+
+    def add(self, name, hits, misses):
+        hits0, misses0 = self.stats.get(name, (0, 0))
+        self.stats[name] = (hits0 + hits, misses0 + misses)
+
+    def merge(self, other):
+        for name, (hits, misses) in other.stats.iteritems():
+            self.add(name, hits, misses)
+
+    def report(self):
+        Auditor.report(self)
+        for name, (hits, misses) in sorted(self.stats.iteritems()):
+            print "{}: {} hits, {} misses".format(name, hits, misses)
+
+class Reshaper(Auditor):
+    title = "Reshaping and saving data"
+
+    def __init__(self, pretty=False, node_index=None, output_format='json',
+                 compression=None, encoder='json', index_nodes=False):
+        self.pretty = pretty
+        # Name of a node index file to add geometry to the ways
+        self.node_index_fname = node_index
+        # Fill the node index from the nodes of the pass itself
+        self.index_nodes = index_nodes
+        self.output_format = output_format
+        self.compression = compression
+        self.encoder = encoder
+        # Keep the shaped documents of a pipeline batch to be loaded
+        self.keep_docs = False
+        # A compressed output can not be continued after a checkpoint,
+        # nor can the node index be
+        self.resumable = compression is None and not index_nodes
+
+    def start(self, fname, part=None):
+        Auditor.start(self, fname, part)
+        self.node_index = None
+        self.indexer = None
+        if self.index_nodes:
+            if part is not None:
+                raise ValueError("Nodes can only be indexed in a serial pass")
+            self.indexer = NodeIndexer()
+            self.indexer.start(fname)
+        elif self.node_index_fname:
+            self.node_index = NodeIndex(self.node_index_fname)
+        encode = make_encoder(self.output_format, self.encoder, self.pretty)
+        self.file_out, self.fo = self.open_writer(fname, part, encode)
+        # Only the first and last elements are kept for testing
+        self.first = None
+        self.last = None
+        self.count = 0
+        self.stats = MapStats()
+        self.write_time = 0.0
+        self.bytes_out = 0
+        self.docs = [] if self.keep_docs else None
+
+    def open_writer(self, fname, part, encode):
+        """Name of the output file, and the writer of the documents"""
+        if part is None:
+            file_out = output_fname(fname, self.output_format, 
+                                    self.compression)
+            return file_out, OutputWriter(file_out, encode, self.compression)
+        # Parts are compressed when they are merged
+        file_out = "{0}.part{1}".format(
+            output_fname(fname, self.output_format), part)
+        return file_out, OutputWriter(file_out, encode)
+
+    def open_node_index(self):
+        """Write the index of the nodes seen so far, and map it"""
+        self.indexer.finish()
+        self.node_index = NodeIndex(self.indexer.index_fname)
+
+    def process(self, element):
+        if self.indexer is not None and self.node_index is None:
+            if element.tag == "node":
+                self.indexer.process(element)
+            elif element.tag in ("way", "relation"):
+                self.open_node_index()
+        shaped_elem = shape_element(element) if is_valid(element) else None
+        if not shaped_elem is None:
+            if self.node_index and "node_refs" in shaped_elem:
+                add_way_geometry(shaped_elem, self.node_index)
+            if self.first is None:
+                self.first = shaped_elem
+            self.last = shaped_elem
+            self.count += 1
+            self.stats.add(shaped_elem)
+            if self.docs is not None:
+                self.docs.append(shaped_elem)
+            start = time.time()
+            self.fo.write(shaped_elem)
+            self.write_time += time.time() - start
+        return shaped_elem
+
+    def finish(self):
+        if self.indexer is not None and self.node_index is None:
+            # An extract without ways still gets its index
+            self.open_node_index()
+        start = time.time()
+        self.fo.close()
+        self.write_time += time.time() - start
+        self.bytes_out = self.fo.bytes
+        # file objects can not be sent back from a worker process
+        del self.fo
+        if self.node_index:
+            self.node_index.close()
+        del self.node_index
+
+    def merge(self, other):
+        if self.first is None:
+            self.first = other.first
+        if not other.last is None:
+            self.last = other.last
+        self.count += other.count
+        self.stats.merge(other.stats)
+        self.write_time += other.write_time
+        start = time.time()
+        self.merge_output(other)
+        self.write_time += time.time() - start
+
+    def merge_output(self, other):
+        with open(other.file_out, "rb") as part:
+            while True:
+                data = part.read(OUTPUT_BUFFER_SIZE)
+                if not data:
+                    break
+                self.fo.write_raw(data)
+        os.remove(other.file_out)
+
+    def cache_key(self):
+        return "{0}:{1}:{2}:{3}:{4}:{5}:{6}".format(
+            Auditor.cache_key(self), self.pretty, self.output_format, 
+            self.compression, self.encoder, self.node_index_fname,
+            self.index_nodes)
+
+    def outputs(self):
+        if self.index_nodes:
+            return [self.file_out, self.indexer.index_fname]
+        return [self.file_out]
+
+    def checkpoint(self):
+        self.fo.flush()
+        self.fo.raw.flush()
+        self.fo_bytes = self.fo.bytes
+        state = Auditor.checkpoint(self)
+        del state["fo"], state["node_index"]
+        return state
+
+    def resume(self, state):
+        Auditor.resume(self, state)
+        self.fo = OutputWriter(self.file_out, make_encoder(
+            self.output_format, self.encoder, self.pretty), offset=self.fo_bytes)
+        self.node_index = None
+        if self.node_index_fname:
+            self.node_index = NodeIndex(self.node_index_fname)
+
+    def report(self):
+        Auditor.report(self)
+        print "{} elements written to {}".format(self.count, self.file_out)
+        if self.indexer is not None:
+            print "{} nodes indexed in {}".format(self.indexer.count, 
+                                                  self.indexer.index_fname)
+        # Test reshaped data
+        if self.fname.endswith("example.osm"):
+            test_reshaped_data([self.first, self.last])
+
+def run_auditors(fname, auditors, processes=1, monitor=None):
+    """Run the auditors over the elements of the file. A RunMonitor
+    times the pass and each of the auditors."""
+    if monitor is not None:
+        auditors = monitor.start_pass(fname, auditors, processes)
+    # Compressed extracts can not be cut into byte ranges, but bz2
+    # extracts are still decompressed in parallel
+    if processes > 1 and not is_compressed(fname):
+        run_auditors_parallel(fname, auditors, processes, monitor)
+    else:
+        for auditor in auditors:
+            auditor.start(fname)
+        with open_osm(fname, processes) as osm_file:
+            if monitor is not None:
+                osm_file = CountingReader(osm_file, monitor)
+            for element in iter_file_elements(fname, osm_file):
+                for auditor in auditors:
+                    auditor.process(element)
+        for auditor in auditors:
+            auditor.finish()
+    if monitor is not None:
+        auditors = monitor.finish_pass()
+    return auditors
+
+############################################################################
+# Instrument a run: stage timings, progress and profiling
+############################################################################
+"""
+A RunMonitor times the stages of a run. Passed to run_auditors(), it
+wraps each auditor in a TimedAuditor that adds up the wall time of its
+process() calls, counts the bytes read from the file and the time spent
+reading and uncompressing them, and prints a progress line with an ETA
+every PROGRESS_INTERVAL seconds. What is left of the pass is the parse,
+which for pbf files includes uncompressing the blocks.
+Stages outside of a pass, like the database load, are timed with
+stage(). report() prints the stages, and save() writes them as json.
+
+Only the wall time is taken for each auditor, since reading the cpu
+clock for every element costs about as much as the cheaper auditors
+do. Cpu time and peak rss are taken for the pass and for each stage,
+and include the worker processes of a parallel run. In a parallel run
+the auditor times are added up over the workers, the file is read by
+the workers, and progress moves on as each chunk is merged.
+
+With profile set to the title of an auditor, its process() calls run
+under cProfile. The stats are saved to <basename>.prof, with the stats
+of all workers of a parallel run merged, and the top PROFILE_TOP
+functions are printed.
+"""
+PROGRESS_INTERVAL = 5.0
+PROFILE_TOP = 20
+
+def cpu_times():
+    """User and system time of this process and its finished children"""
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+def peak_rss():
+    """Peak rss in KB of this process, or of its largest finished child"""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def chunk_size(chunk):
+    """Bytes in a (start, end) xml chunk or in a run of pbf blocks"""
+    if isinstance(chunk, tuple):
+        return chunk[1] - chunk[0]
+    return sum(size for block_type, offset, size in chunk)
+
+class CountingReader(object):
+    """File like object that counts the bytes read from osm_file for
+    the monitor, and the time spent reading and uncompressing them"""
+    def __init__(self, osm_file, monitor):
+        self.osm_file = osm_file
+        self.monitor = monitor
+
+    def read(self, size=-1):
+        start = time.time()
+        data = self.osm_file.read(size)
+        self.monitor.read_time += time.time() - start
+        self.monitor.update(len(data))
+        return data
+
+    def seek(self, offset, whence=0):
+        return self.osm_file.seek(offset, whence)
+
+    def tell(self):
+        return self.osm_file.tell()
+
+class TimedAuditor(Auditor):
+    """Wraps an auditor to time it, and optionally profile it"""
+    def __init__(self, auditor, profile=False):
+        self.auditor = auditor
+        self.title = auditor.title
+        self.profile = profile
+
+    def __copy__(self):
+        return TimedAuditor(copy.copy(self.auditor), self.profile)
+
+    @property
+    def resumable(self):
+        return self.auditor.resumable
+
+    def start(self, fname, part=None):
+        Auditor.start(self, fname, part)
+        self.part = part
+        self.wall = 0.0
+        self.count = 0
+        self.profiler = cProfile.Profile() if self.profile else None
+        self.profiles = []
+        start = time.time()
+        self.auditor.start(fname, part)
+        self.wall += time.time() - start
+
+    def process(self, element):
+        start = time.time()
+        if self.profiler is None:
+            self.auditor.process(element)
+        else:
+            self.profiler.enable()
+            self.auditor.process(element)
+            self.profiler.disable()
+        self.wall += time.time() - start
+        self.count += 1
+
+    def finish(self):
+        start = time.time()
+        self.auditor.finish()
+        self.wall += time.time() - start
+        # The main auditor of a parallel run only merges the workers'
+        if self.profiler is not None and not self.profiles:
+            prof_fname = "{0}.prof".format(osm_basename(self.fname))
+            if self.part is not None:
+                prof_fname += ".part{}".format(self.part)
+            self.profiler.dump_stats(prof_fname)
+            self.profiles.append(prof_fname)
+        # profilers can not be sent back from a worker process
+        del self.profiler
+
+    def merge(self, other):
+        self.auditor.merge(other.auditor)
+        self.wall += other.wall
+        self.count += other.count
+        self.profiles.extend(other.profiles)
+
+    def report(self):
+        self.auditor.report()
+
+class RunMonitor(object):
+    def __init__(self, profile=None, interval=PROGRESS_INTERVAL):
+        # Title of the auditor to profile
+        self.profile = profile
+        self.interval = interval
+        self.started = time.time()
+        self.stages = []
+        self.files = []
+        # Queue stats of a pipelined pass
+        self.queues = None
+
+    def add_stage(self, name, seconds, cpu_seconds=None, elements=None, 
+                  nbytes=None, rss=None):
+        stage = {"stage": name, "seconds": seconds}
+        if cpu_seconds is not None:
+            stage["cpu_seconds"] = cpu_seconds
+        if elements is not None:
+            stage["elements"] = elements
+            if seconds > 0:
+                stage["elements_per_sec"] = elements / seconds
+        if nbytes is not None:
+            stage["bytes"] = nbytes
+            if seconds > 0:
+                stage["mb_per_sec"] = float(nbytes) / MB / seconds
+        if rss is not None:
+            stage["peak_rss_kb"] = rss
+        self.stages.append(stage)
+        return stage
+
+    @contextmanager
+    def stage(self, name, elements=None):
+        """Time the body of a with statement as a stage"""
+        start = time.time()
+        cpu_start = cpu_times()
+        yield
+        self.add_stage(name, time.time() - start, cpu_times() - cpu_start,
+                       elements, rss=peak_rss())
+
+    def start_pass(self, fname, auditors, processes=1):
+        self.fname = fname
+        self.processes = processes
+        self.total = None if is_compressed(fname) else os.path.getsize(fname)
+        self.files.append(fname)
+        self.bytes = 0
+        self.read_time = 0.0
+        self.timed = [TimedAuditor(auditor, auditor.title == self.profile)
+                      for auditor in auditors]
+        # Whether the auditor times add up to the time of the pass
+        self.serial = processes <= 1 or is_compressed(fname)
+        self.pass_start = time.time()
+        self.pass_cpu = cpu_times()
+        self.next_progress = self.pass_start + self.interval
+        return self.timed
+
+    def update(self, nbytes):
+        """Count nbytes more read, and print the progress when due"""
+        self.bytes += nbytes
+        now = time.time()
+        if now < self.next_progress:
+            return
+        self.next_progress = now + self.interval
+        elapsed = now - self.pass_start
+        elements = self.timed[0].count if self.timed else 0
+        line = "{0:.0f}s: {1} elements, {2:.1f} MB, {3:.0f} elements/s".format(
+            elapsed, elements, float(self.bytes) / MB, elements / elapsed)
+        if self.total:
+            left = elapsed * (self.total - self.bytes) / max(self.bytes, 1)
+            line += ", {0:.0f}% ETA {1:.0f}s".format(
+                100.0 * self.bytes / self.total, left)
+        print line
+
+    def finish_pass(self):
+        wall = time.time() - self.pass_start
+        elements = self.timed[0].count if self.timed else 0
+        self.add_stage("pass over " + os.path.basename(self.fname), wall,
+                       cpu_times() - self.pass_cpu, elements, 
+                       self.bytes or self.total, peak_rss())
+        if self.read_time:
+            self.add_stage("read and uncompress", self.read_time, 
+                           nbytes=self.bytes)
+        for auditor in self.timed:
+            self.add_stage(auditor.title, auditor.wall, 
+                           elements=auditor.count)
+            # Time spent encoding and writing out the reshaped data
+            write_time = getattr(auditor.auditor, "write_time", None)
+            if write_time is not None:
+                self.add_stage("serialize output", write_time, 
+                               elements=auditor.auditor.count,
+                               nbytes=auditor.auditor.bytes_out)
+            if auditor.profiles:
+                self.save_profile(auditor.profiles)
+        # Worker times overlap, so the parse is only left over serially
+        if self.serial:
+            parse = wall - self.read_time - sum(auditor.wall 
+                                                for auditor in self.timed)
+            self.add_stage("parse", parse, elements=elements)
+        auditors = [auditor.auditor for auditor in self.timed]
+        del self.timed
+        return auditors
+
+    def save_profile(self, profiles):
+        prof_fname = "{0}.prof".format(osm_basename(self.fname))
+        stats = pstats.Stats(*profiles)
+        for part in profiles:
+            if part != prof_fname:
+                os.remove(part)
+        stats.dump_stats(prof_fname)
+        print "\nProfile of {} saved to {}".format(self.profile, prof_fname)
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+
+    def report(self):
+        print "\nRun stages"
+        print "=========================================================="
+        for stage in self.stages:
+            line = "{0:28} {1:9.2f}s".format(stage["stage"][:28], 
+                                            stage["seconds"])
+            if "cpu_seconds" in stage:
+                line += " cpu {0:9.2f}s".format(stage["cpu_seconds"])
+            if "elements_per_sec" in stage:
+                line += " {0:10.0f} elements/s".format(
+                    stage["elements_per_sec"])
+            if "mb_per_sec" in stage:
+                line += " {0:7.1f} MB/s".format(stage["mb_per_sec"])
+            print line
+        print "peak rss {} KB".format(peak_rss())
+
+    def save(self, report_fname):
+        """Write the run report as json"""
+        run = {"files": self.files, 
+               "time": time.strftime('%Y-%m-%dT%H:%M:%S', 
+                                     time.localtime(self.started)),
+               "seconds": time.time() - self.started,
+               "parser": XML_PARSER, "peak_rss_kb": peak_rss(),
+               "stages": self.stages}
+        if self.queues is not None:
+            run["queues"] = self.queues
+        with open(report_fname, "w") as report_file:
+            json.dump(run, report_file, indent=2)
+
+############################################################################
+# Approximate audits in bounded memory
+############################################################################
+"""
+The exact UserAuditor and AddressAuditor keep every distinct user,
+street name, city and postcode, which on a country sized extract takes
+more memory than anything else in the pass. The sketch auditors below
+give approximate answers in a fixed amount of memory, and each result
+is reported with its error bound:
+
+- HyperLogLog counts the distinct users, keys, street names, cities and
+  postcodes, in 2**SKETCH_PRECISION one byte registers. The standard
+  error of a count is 1.04 / sqrt(2**SKETCH_PRECISION), 0.8%, and the
+  bound reported is twice that, at about 95% confidence.
+- HeavyHitters finds the top contributors and the most common rare
+  street types. It counts everything in a Count-Min sketch of
+  SKETCH_DEPTH rows of SKETCH_WIDTH counters, and keeps the SKETCH_TOP
+  items with the highest estimates. An estimate is never below the true
+  count, and with probability 1 - exp(-SKETCH_DEPTH) at most
+  e / SKETCH_WIDTH of the total count above it.
+- DistinctSample keeps SKETCH_EXAMPLES example values of an anomaly
+  bucket (a rare street type, a postcode length, the city names): the
+  distinct values with the smallest hashes. That is a uniform sample of
+  the distinct values, which merges exactly across workers, and also
+  estimates their number. Only SKETCH_BUCKETS buckets are kept, later
+  ones go to an "other" bucket.
+
+All sketches hash a value once with sketch_hash(), which is md5 so that
+the hashes are the same in every worker process, and merge by combining
+their state, so they also work in parallel runs.
+"""
+SKETCH_PRECISION = 14
+SKETCH_WIDTH = 2048
+SKETCH_DEPTH = 5
+SKETCH_TOP = 20
+SKETCH_EXAMPLES = 16
+SKETCH_BUCKETS = 64
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+
+def sketch_hash(value):
+    """Two independent 64 bit hashes of a string"""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return struct.unpack('<QQ', hashlib.md5(value).digest())
+
+class HyperLogLog(object):
+    def __init__(self, precision=SKETCH_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value, hashes=None):
+        h = (hashes or sketch_hash(value))[0]
+        index = h >> (HASH_BITS - self.precision)
+        rest = (h << self.precision) & HASH_MASK
+        rank = HASH_BITS - rest.bit_length() + 1 if rest else \
+               HASH_BITS - self.precision + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(max(a, b) for a, b in 
+                                   zip(self.registers, other.registers))
+
+    def count(self):
+        m = len(self.registers)
+        estimate = (0.7213 / (1 + 1.079 / m) * m * m / 
+                    sum(2.0 ** -register for register in self.registers))
+        zeros = self.registers.count(b"\x00")
+        # Linear counting is more accurate for small counts
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def error(self):
+        """Relative error bound of count(), at about 95% confidence"""
+        return 2 * 1.04 / math.sqrt(len(self.registers))
+
+    def report(self, name):
+        count = self.count()
+        print "{0} ~ {1} +/- {2:.0f} (95%)".format(
+            name, count, count * self.error())
+
+class CountMinSketch(object):
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.counters = array.array('l', [0] * (width * depth))
+        self.total = 0
+
+    def cells(self, hashes):
+        h1, h2 = hashes
+        return [row * self.width + (h1 + row * h2) % self.width 
+                for row in range(self.depth)]
+
+    def add(self, value, count=1, hashes=None):
+        """Count value, and return its estimated count"""
+        cells = self.cells(hashes or sketch_hash(value))
+        counters = self.counters
+        for cell in cells:
+            counters[cell] += count
+        self.total += count
+        return min(counters[cell] for cell in cells)
+
+    def estimate(self, value, hashes=None):
+        return min(self.counters[cell] 
+                   for cell in self.cells(hashes or sketch_hash(value)))
+
+    def merge(self, other):
+        counters = self.counters
+        for cell, count in enumerate(other.counters):
+            counters[cell] += count
+        self.total += other.total
+
+    def error(self):
+        """Most an estimate exceeds the true count by, with probability
+        1 - exp(-depth)"""
+        return int(math.ceil(math.e / self.width * self.total))
+
+class HeavyHitters(object):
+    """The top items by their Count-Min sketch estimate"""
+    def __init__(self, top=SKETCH_TOP, width=SKETCH_WIDTH, 
+                 depth=SKETCH_DEPTH):
+        self.top = top
+        self.sketch = CountMinSketch(width, depth)
+        self.items = {}
+        self.min_count = 0
+
+    def add(self, value, hashes=None):
+        count = self.sketch.add(value, hashes=hashes)
+        if value in self.items or len(self.items) < self.top:
+            self.items[value] = count
+        elif count > self.min_count:
+            del self.items[min(self.items, key=self.items.get)]
+            self.items[value] = count
+        else:
+            return
+        if len(self.items) == self.top:
+            self.min_count = min(self.items.itervalues())
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+        candidates = set(self.items) | set(other.items)
+        estimates = dict((value, self.sketch.estimate(value)) 
+                         for value in candidates)
+        self.items = dict(sorted(estimates.iteritems(), 
+                                 key=lambda (value, count): -count)[:self.top])
+        if len(self.items) == self.top:
+            self.min_count = min(self.items.itervalues())
+
+    def report(self, name):
+        print "{0}, counts over by at most {1} ({2:.1%}):".format(
+            name, self.sketch.error(), 1 - math.exp(-self.sketch.depth))
+        pprint.pprint(top_counts(self.items))
+
+class DistinctSample(object):
+    """The distinct values with the size smallest hashes"""
+    def __init__(self, size=SKETCH_EXAMPLES):
+        self.size = size
+        # max heap of (-hash, value)
+        self.heap = []
+        self.hashes = set()
+        self.count = 0
+
+    def add(self, value, hashes=None):
+        self.count += 1
+        h = (hashes or sketch_hash(value))[1]
+        if h in self.hashes:
+            return
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, (-h, value))
+            self.hashes.add(h)
+        elif h < -self.heap[0][0]:
+            self.hashes.remove(-heapq.heapreplace(self.heap, (-h, value))[0])
+            self.hashes.add(h)
+
+    def merge(self, other):
+        self.count += other.count
+        for neg_h, value in other.heap:
+            self.add(value, (None, -neg_h))
+        # add() counted the merged values again
+        self.count -= len(other.heap)
+
+    def values(self):
+        return sorted(value for neg_h, value in self.heap)
+
+    def distinct(self):
+        """Estimated number of distinct values, and its relative error"""
+        if len(self.heap) < self.size:
+            return len(self.heap), 0.0
+        kth = -self.heap[0][0]
+        return (int((self.size - 1) * float(1 << HASH_BITS) / (kth + 1)),
+                2.0 / math.sqrt(self.size - 2))
+
+class BucketSamples(object):
+    """A DistinctSample for each of up to max_buckets buckets"""
+    def __init__(self, size=SKETCH_EXAMPLES, max_buckets=SKETCH_BUCKETS):
+        self.size = size
+        self.max_buckets = max_buckets
+        self.buckets = {}
+
+    def add(self, bucket, value, hashes=None):
+        if bucket not in self.buckets:
+            if len(self.buckets) >= self.max_buckets:
+                bucket = "other"
+            if bucket not in self.buckets:
+                self.buckets[bucket] = DistinctSample(self.size)
+        self.buckets[bucket].add(value, hashes)
+
+    def merge(self, other):
+        for bucket, sample in other.buckets.iteritems():
+            if bucket in self.buckets:
+                self.buckets[bucket].merge(sample)
+            elif len(self.buckets) < self.max_buckets:
+                self.buckets[bucket] = sample
+            else:
+                if "other" not in self.buckets:
+                    self.buckets["other"] = DistinctSample(self.size)
+                self.buckets["other"].merge(sample)
+
+    def report(self):
+        for bucket, sample in sorted(self.buckets.iteritems()):
+            distinct, error = sample.distinct()
+            print "{0}: {1} values, ~{2} distinct +/- {3:.0%}".format(
+                bucket, sample.count, distinct, error)
+            pprint.pprint(sample.values())
+
+class SketchKeyAuditor(KeyAuditor):
+    title = "Auditing keys (approximate)"
+
+    def start(self, fname, part=None):
+        KeyAuditor.start(self, fname, part)
+        self.distinct_keys = HyperLogLog()
+
+    def process(self, element):
+        for tagelem in element.iter("tag"):
+            key_type(tagelem, self.keys)
+            self.distinct_keys.add(tagelem.attrib['k'])
+
+    def merge(self, other):
+        KeyAuditor.merge(self, other)
+        self.distinct_keys.merge(other.distinct_keys)
+
+    def report(self):
+        KeyAuditor.report(self)
+        self.distinct_keys.report("Distinct keys")
+
+class SketchUserAuditor(Auditor):
+    title = "Auditing users (approximate)"
+
+    def start(self, fname, part=None):
+        Auditor.start(self, fname, part)
+        self.distinct_users = HyperLogLog()
+        self.top_users = HeavyHitters()
+
+    def process(self, element):
+        if element.tag == "node" or element.tag == "way":
+            user = get_user(element)
+            if user is None:
+                return
+            hashes = sketch_hash(user)
+            self.distinct_users.add(user, hashes)
+            self.top_users.add(user, hashes)
+
+    def merge(self, other):
+        self.distinct_users.merge(other.distinct_users)
+        self.top_users.merge(other.top_users)
+
+    def report(self):
+        Auditor.report(self)
+        self.distinct_users.report("Number of users")
+        self.top_users.report("Top contributors")
+
+class SketchAddressAuditor(Auditor):
+    def __init__(self, cleanup=False):
+        self.cleanup = cleanup
+        self.title = "{} (approximate)".format(
+            "Cleaning addresses" if cleanup else "Auditing addresses")
+
+    def start(self, fname, part=None):
+        Auditor.start(self, fname, part)
+        self.street_names = HyperLogLog()
+        self.city_names = HyperLogLog()
+        self.postcodes = HyperLogLog()
+        self.rare_street_types = HeavyHitters()
+        self.examples = BucketSamples()
+
+    def process(self, element):
+        if element.tag != "node" and element.tag != "way":
+            return
+        if self.cleanup:
+            element = clean_address(element)
+        for tagelem in element.iter("tag"):
+            value = tagelem.attrib['v']
+            if is_street_name(tagelem):
+                hashes = sketch_hash(value)
+                self.street_names.add(value, hashes)
+                street_type = cleaning_rules.street_type(value)
+                if not street_type is None:
+                    self.rare_street_types.add(street_type)
+                    self.examples.add("street type " + street_type, value,
+                                      hashes)
+            if is_city_name(tagelem):
+                hashes = sketch_hash(value)
+                self.city_names.add(value, hashes)
+                self.examples.add("city", value, hashes)
+            if is_postcode(tagelem):
+                pcode = cleaning_rules.postcode(value)
+                pkey = tagelem.attrib['k']
+                if pcode is None:
+                    bucket, pcode = pkey + "0", value
+                else:
+                    bucket = pkey + str(len(pcode))
+                hashes = sketch_hash(pcode)
+                self.postcodes.add(pcode, hashes)
+                self.examples.add(bucket, pcode, hashes)
+
+    def merge(self, other):
+        for name in ("street_names", "city_names", "postcodes", 
+                     "rare_street_types", "examples"):
+            getattr(self, name).merge(getattr(other, name))
+
+    def report(self):
+        Auditor.report(self)
+        self.street_names.report("Distinct street names")
+        self.city_names.report("Distinct city names")
+        self.postcodes.report("Distinct postcodes")
+        self.rare_street_types.report("Top rare street types")
+        self.examples.report()
+
+def test_sketches(fname):
+    """Check the approximate audits against the exact ones"""
+    users, sketch_users, addresses, sketch_addresses = run_auditors(
+        fname, [UserAuditor(), SketchUserAuditor(), AddressAuditor(), 
+                SketchAddressAuditor()])
+    nusers = len([user for user in users.users if user is not None])
+    distinct = sketch_users.distinct_users
+    assert abs(distinct.count() - nusers) <= distinct.error() * nusers + 1
+    error = sketch_users.top_users.sketch.error()
+    for user, count in sketch_users.top_users.items.iteritems():
+        assert users.users[user] <= count <= users.users[user] + error
+    for street_type, count in top_counts(
+            sketch_addresses.rare_street_types.items):
+        assert street_type in addresses.rare_street_types
+    ncities = len(addresses.city_names)
+    distinct = sketch_addresses.city_names
+    assert abs(distinct.count() - ncities) <= distinct.error() * ncities + 1
+    print "{}: {} users ~ {}, {} cities ~ {}".format(
+        fname, nusers, sketch_users.distinct_users.count(), ncities,
+        distinct.count())
+
+############################################################################
+# Parse byte range chunks of the file in parallel
+############################################################################
+"""
+The uncompressed osm file is split into byte ranges that start at a
+top level <node, <way or <relation tag. Each chunk is wrapped in <osm>
+tags so that it parses on its own, and a pool of worker processes runs
+a copy of the auditors over each chunk. The per-chunk results are
+merged in file order, which gives the same results as a serial run.
+"""
+ELEMENT_STARTS = ('<node', '<way', '<relation')
+CHUNKS_PER_PROCESS = 4
+
+def find_element_start(osm_file, offset, block_size=MB):
+    """Return the offset of the first top level element at or after
+    offset, or None if there is none"""
+    osm_file.seek(offset)
+    carry = ''
+    while True:
+        block = osm_file.read(block_size)
+        if not block:
+            return None
+        buf = carry + block
+        hits = [buf.find(start) for start in ELEMENT_STARTS]
+        hits = [hit for hit in hits if hit >= 0]
+        if hits:
+            return offset - len(carry) + min(hits)
+        offset += len(block)
+        # an element start may straddle two blocks
+        carry = buf[-len('<relation'):]
+
+def find_chunks(fname, nchunks):
+    size = os.path.getsize(fname)
+    bounds = [0]
+    with open(fname, "rb") as osm_file:
+        for i in range(1, nchunks):
+            start = find_element_start(osm_file, size * i // nchunks)
+            if start is None:
+                break
+            if start > bounds[-1]:
+                bounds.append(start)
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+class ChunkReader(object):
+    """File like object that reads the byte range [start, end) of a file,
+    with head and tail added so that the chunk parses on its own"""
+    def __init__(self, fname, start, end, head='', tail=''):
+        self.osm_file = open(fname, "rb")
+        self.osm_file.seek(start)
+        self.left = end - start
+        self.head = head
+        self.tail = tail
+
+    def read(self, size=-1):
+        if self.head:
+            data, self.head = self.head, ''
+            return data
+        if self.left > 0:
+            if size < 0 or size > self.left:
+                size = self.left
+            data = self.osm_file.read(size)
+            self.left = self.left - len(data) if data else 0
+            if data:
+                return data
+        data, self.tail = self.tail, ''
+        return data
+
+    def close(self):
+        self.osm_file.close()
+
+def audit_chunk(task):
+    fname, part, (start, end), last, auditors = task
+    for auditor in auditors:
+        auditor.start(fname, part)
+    reader = ChunkReader(fname, start, end, 
+                         '' if part == 0 else '<osm>', 
+                         '' if last else '</osm>')
+    try:
+        # Only the last chunk closes the real root element
+        for element in iter_xml_elements(reader, with_root=last):
+            for auditor in auditors:
+                auditor.process(element)
+    finally:
+        reader.close()
+    for auditor in auditors:
+        auditor.finish()
+    return auditors
+
+def run_auditors_parallel(fname, auditors, processes=None, monitor=None):
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if is_pbf(fname):
+        chunks = find_pbf_chunks(fname, processes * CHUNKS_PER_PROCESS)
+        worker = audit_pbf_chunk
+    else:
+        chunks = find_chunks(fname, processes * CHUNKS_PER_PROCESS)
+        worker = audit_chunk
+    # Workers get copies of the auditors taken before they are started
+    tasks = [(fname, part, chunk, part == len(chunks) - 1, 
+              [copy.copy(auditor) for auditor in auditors])
+             for part, chunk in enumerate(chunks)]
+    for auditor in auditors:
+        auditor.start(fname)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for task, chunk_auditors in zip(tasks, pool.imap(worker, tasks)):
+            for auditor, chunk_auditor in zip(auditors, chunk_auditors):
+                auditor.merge(chunk_auditor)
+            if monitor is not None:
+                monitor.update(chunk_size(task[2]))
+    finally:
+        pool.terminate()
+    for auditor in auditors:
+        auditor.finish()
+    return auditors
+
+############################################################################
+# Read .osm.pbf extracts
+############################################################################
+"""
+A .osm.pbf file is a sequence of blocks, each made of a 4 byte length,
+a BlobHeader and a zlib compressed Blob holding either the HeaderBlock
+or a PrimitiveBlock of nodes, ways and relations. The protobuf messages
+are decoded by hand, so no protobuf library is needed.
+
+Every element is turned into the same OSMRecord the expat parser
+would produce, with its <tag>, <nd> and <member> children, so
+the auditors and shape_element() work on pbf files unchanged, and give
+the same output as on the xml version of the extract.
+
+Blocks decode independently of each other. In parallel runs the data
+blocks are split into runs of consecutive blocks, and each run is
+audited by a worker process like a byte range chunk of an xml file.
+"""
+PBF_MEMBER_TYPES = ('node', 'way', 'relation')
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = ord(buf[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+def signed(value):
+    """int32/int64 fields are varints of their two's complement"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def zigzag(value):
+    """sint32/sint64 fields are zigzag encoded"""
+    return (value >> 1) ^ -(value & 1)
+
+def iter_fields(buf):
+    """Yield (field number, wire type, value) for each field of a
+    protobuf message. Length delimited values are yielded as strings."""
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire == 2:
+            size, pos = read_varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire == 1:
+            value = struct.unpack('<Q', buf[pos:pos + 8])[0]
+            pos += 8
+        elif wire == 5:
+            value = struct.unpack('<I', buf[pos:pos + 4])[0]
+            pos += 4
+        else:
+            raise IOError("Unsupported protobuf wire type {}".format(wire))
+        yield field, wire, value
+
+def unpack_varints(wire, value):
+    """Values of a repeated integer field, whether packed or not"""
+    if wire != 2:
+        return [value]
+    values = []
+    pos = 0
+    while pos < len(value):
+        varint, pos = read_varint(value, pos)
+        values.append(varint)
+    return values
+
+def delta_decode(values):
+    total = 0
+    decoded = []
+    for value in values:
+        total += zigzag(value)
+        decoded.append(total)
+    return decoded
+
+def format_degrees(nanodegrees):
+    """Exact decimal string of a coordinate, which converts to the same
+    float as the 7 digit value in the xml file"""
+    sign = '-' if nanodegrees < 0 else ''
+    degrees, fraction = divmod(abs(nanodegrees), 10 ** 9)
+    return '{}{}.{:09d}'.format(sign, degrees, fraction).rstrip('0')
+
+def iter_pbf_blocks(pbf_file):
+    """Yield (type, offset, size) of each blob in the file"""
+    offset = 0
+    while True:
+        head = pbf_file.read(4)
+        if len(head) < 4:
+            break
+        header_size = struct.unpack('>I', head)[0]
+        block_type = None
+        data_size = 0
+        for field, wire, value in iter_fields(pbf_file.read(header_size)):
+            if field == 1:
+                block_type = value
+            elif field == 3:
+                data_size = value
+        offset += 4 + header_size
+        yield block_type, offset, data_size
+        offset += data_size
+        pbf_file.seek(offset)
+
+def read_pbf_blob(pbf_file, offset, size):
+    pbf_file.seek(offset)
+    for field, wire, value in iter_fields(pbf_file.read(size)):
+        if field == 1:
+            return value
+        elif field == 3:
+            return zlib.decompress(value)
+        elif field > 3:
+            raise IOError("Unsupported pbf blob compression")
+    return ''
+
+class PrimitiveBlock(object):
+    """Decode the elements of a PrimitiveBlock into OSMRecords"""
+    def __init__(self, data):
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+        for field, wire, value in iter_fields(data):
+            if field == 1:
+                self.strings = [fix_text(s) 
+                                for f, w, s in iter_fields(value) if f == 1]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 18:
+                self.date_granularity = value
+            elif field == 19:
+                self.lat_offset = signed(value)
+            elif field == 20:
+                self.lon_offset = signed(value)
+
+    def elements(self):
+        for group in self.groups:
+            for field, wire, value in iter_fields(group):
+                if field == 1:
+                    yield self.node(value)
+                elif field == 2:
+                    for node in self.dense_nodes(value):
+                        yield node
+                elif field == 3:
+                    yield self.way(value)
+                elif field == 4:
+                    yield self.relation(value)
+
+    def lat(self, lat):
+        return format_degrees(self.lat_offset + self.granularity * lat)
+
+    def lon(self, lon):
+        return format_degrees(self.lon_offset + self.granularity * lon)
+
+    def timestamp(self, timestamp):
+        seconds = timestamp * self.date_granularity // 1000
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+    def make_element(self, tag, elem_id, info):
+        """Element with its attributes in the order of the xml file"""
+        elem = OSMRecord(tag, {})
+        attrib = elem.attrib
+        attrib['id'] = str(elem_id)
+        if 'visible' in info:
+            attrib['visible'] = 'true' if info['visible'] else 'false'
+        for attr in ('version', 'changeset'):
+            if attr in info:
+                attrib[attr] = str(info[attr])
+        if 'timestamp' in info:
+            attrib['timestamp'] = self.timestamp(info['timestamp'])
+        if info.get('user_sid'):
+            attrib['user'] = self.strings[info['user_sid']]
+        if 'uid' in info:
+            attrib['uid'] = str(info['uid'])
+        return elem
+
+    def add_tags(self, elem, keys, vals):
+        for key, val in zip(keys, vals):
+            elem.append(OSMChild('tag', {'k': self.strings[key], 
+                                         'v': self.strings[val]}))
+
+    def info(self, data):
+        info = {}
+        for field, wire, value in iter_fields(data):
+            if field == 1:
+                info['version'] = signed(value)
+            elif field == 2:
+                info['timestamp'] = signed(value)
+            elif field == 3:
+                info['changeset'] = signed(value)
+            elif field == 4:
+                info['uid'] = signed(value)
+            elif field == 5:
+                info['user_sid'] = value
+            elif field == 6:
+                info['visible'] = bool(value)
+        return info
+
+    def node(self, data):
+        elem_id = lat = lon = 0
+        keys, vals, info = [], [], {}
+        for field, wire, value in iter_fields(data):
+            if field == 1:
+                elem_id = zigzag(value)
+            elif field == 2:
+                keys.extend(unpack_varints(wire, value))
+            elif field == 3:
+                vals.extend(unpack_varints(wire, value))
+            elif field == 4:
+                info = self.info(value)
+            elif field == 8:
+                lat = zigzag(value)
+            elif field == 9:
+                lon = zigzag(value)
+        elem = self.make_element('node', elem_id, info)
+        elem.attrib['lat'] = self.lat(lat)
+        elem.attrib['lon'] = self.lon(lon)
+        self.add_tags(elem, keys, vals)
+        return elem
+
+    def dense_nodes(self, data):
+        ids, lats, lons, keys_vals = [], [], [], []
+        dense_info = {}
+        for field, wire, value in iter_fields(data):
+            if field == 1:
+                ids = delta_decode(unpack_varints(wire, value))
+            elif field == 5:
+                dense_info = self.dense_info(value)
+            elif field == 8:
+                lats = delta_decode(unpack_varints(wire, value))
+            elif field == 9:
+                lons = delta_decode(unpack_varints(wire, value))
+            elif field == 10:
+                keys_vals = unpack_varints(wire, value)
+        # keys_vals holds key, value string ids of all nodes in turn,
+        # with a 0 after the tags of each node
+        kv_pos = 0
+        for i, elem_id in enumerate(ids):
+            info = dict((attr, values[i]) 
+                        for attr, values in dense_info.iteritems())
+            keys, vals = [], []
+            while kv_pos < len(keys_vals) and keys_vals[kv_pos] != 0:
+                keys.append(keys_vals[kv_pos])
+                vals.append(keys_vals[kv_pos + 1])
+                kv_pos += 2
+            kv_pos += 1
+            elem = self.make_element('node', elem_id, info)
+            elem.attrib['lat'] = self.lat(lats[i])
+            elem.attrib['lon'] = self.lon(lons[i])
+            self.add_tags(elem, keys, vals)
+            yield elem
+
+    def dense_info(self, data):
+        dense_info = {}
+        for field, wire, value in iter_fields(data):
+            values = unpack_varints(wire, value)
+            if field == 1:
+                dense_info['version'] = [signed(v) for v in values]
+            elif field == 2:
+                dense_info['timestamp'] = delta_decode(values)
+            elif field == 3:
+                dense_info['changeset'] = delta_decode(values)
+            elif field == 4:
+                dense_info['uid'] = delta_decode(values)
+            elif field == 5:
+                dense_info['user_sid'] = delta_decode(values)
+            elif field == 6:
+                dense_info['visible'] = [bool(v) for v in values]
+        return dense_info
+
+    def way(self, data):
+        elem_id = 0
+        keys, vals, refs, info = [], [], [], {}
+        for field, wire, value in iter_fields(data):
+            if field == 1:
+                elem_id = signed(value)
+            elif field == 2:
+                keys.extend(unpack_varints(wire, value))
+            elif field == 3:
+                vals.extend(unpack_varints(wire, value))
+            elif field == 4:
+                info = self.info(value)
+            elif field == 8:
+                refs.extend(unpack_varints(wire, value))
+        elem = self.make_element('way', elem_id, info)
+        for ref in delta_decode(refs):
+            elem.append(OSMChild('nd', {'ref': str(ref)}))
+        self.add_tags(elem, keys, vals)
+        return elem
+
+    def relation(self, data):
+        elem_id = 0
+        keys, vals, roles, memids, types, info = [], [], [], [], [], {}
+        for field, wire, value in iter_fields(data):
+            if field == 1:
+                elem_id = signed(value)
+            elif field == 2:
+                keys.extend(unpack_varints(wire, value))
+            elif field == 3:
+                vals.extend(unpack_varints(wire, value))
+            elif field == 4:
+                info = self.info(value)
+            elif field == 8:
+                roles.extend(unpack_varints(wire, value))
+            elif field == 9:
+                memids.extend(unpack_varints(wire, value))
+            elif field == 10:
+                types.extend(unpack_varints(wire, value))
+        elem = self.make_element('relation', elem_id, info)
+        for mtype, ref, role in zip(types, delta_decode(memids), roles):
+            elem.append(OSMChild('member', {'type': PBF_MEMBER_TYPES[mtype],
+                                            'ref': str(ref),
+                                            'role': self.strings[role]}))
+        self.add_tags(elem, keys, vals)
+        return elem
+
+def pbf_bounds(data):
+    """The <bounds> element for the bounding box of a HeaderBlock"""
+    for field, wire, value in iter_fields(data):
+        if field == 1:
+            box = dict((f, format_degrees(zigzag(v)))
+                       for f, w, v in iter_fields(value))
+            return OSMRecord('bounds', {'minlat': box.get(4, '0'),
+                                        'minlon': box.get(1, '0'),
+                                        'maxlat': box.get(3, '0'),
+                                        'maxlon': box.get(2, '0')})
+    return None
+
+def iter_pbf_elements(pbf_file, blocks=None, with_root=True):
+    """Yield the elements of a pbf file in file order, like
+    iter_elements() does for an xml file. If blocks is given, only
+    those (type, offset, size) blocks are read."""
+    if blocks is None:
+        blocks = list(iter_pbf_blocks(pbf_file))
+    for block_type, offset, size in blocks:
+        data = read_pbf_blob(pbf_file, offset, size)
+        if block_type == 'OSMHeader':
+            bounds = pbf_bounds(data)
+            if bounds is not None:
+                yield bounds
+        elif block_type == 'OSMData':
+            for element in PrimitiveBlock(data).elements():
+                yield element
+    if with_root:
+        yield OSMRecord('osm', {})
+
+def find_pbf_chunks(fname, nchunks):
+    """Split the blocks of the file into nchunks runs of consecutive
+    blocks"""
+    with open(fname, 'rb') as pbf_file:
+        blocks = list(iter_pbf_blocks(pbf_file))
+    nchunks = max(1, min(nchunks, len(blocks)))
+    bounds = [len(blocks) * i // nchunks for i in range(nchunks + 1)]
+    return [blocks[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+def audit_pbf_chunk(task):
+    fname, part, blocks, last, auditors = task
+    for auditor in auditors:
+        auditor.start(fname, part)
+    with open(fname, 'rb') as pbf_file:
+        for element in iter_pbf_elements(pbf_file, blocks, with_root=last):
+            for auditor in auditors:
+                auditor.process(element)
+    for auditor in auditors:
+        auditor.finish()
+    return auditors
+
+def test_pbf_output(xml_fname, pbf_fname):
+    """A pbf file and its xml version must reshape to the same json"""
+    outputs = []
+    for fname in (xml_fname, pbf_fname):
+        reshaper = run_auditors(fname, [Reshaper()])[0]
+        with open(reshaper.file_out, 'rb') as json_file:
+            outputs.append(json_file.read())
+    assert outputs[0] == outputs[1]
+
+############################################################################
+# Pipelined pass: read, shape and load at the same time
+############################################################################
+"""
+run_auditors() and the database load take turns: the database waits
+while the file is parsed, and the cpu waits on the disk and the
+database. run_pipeline() overlaps them, as stages connected by bounded
+StageQueues:
+
+1. a reader thread reads and uncompresses the file, and cuts it into
+   batches of about PIPELINE_BATCH_BYTES of whole top level elements
+   (or runs of PIPELINE_PBF_BLOCKS blocks of a pbf file)
+2. a feeder thread hands the batches to a pool of worker processes,
+   which parse, audit, clean, shape and serialize them like the chunks
+   of run_auditors_parallel(), keeping at most PIPELINE_QUEUE_SIZE
+   batches in flight, and merges the results in file order. The
+   shaped documents of each batch are passed on.
+3. the main thread loads the documents into the storage, whose
+   BulkLoader writes with threads of its own on MongoDB.
+
+Unlike the byte range chunks, the batches are cut out of the stream,
+so compressed extracts are parsed in parallel too. When a stage is
+slower than the one before it, the queue in front of it fills up and
+the earlier stages block, so memory stays bounded. An error in any
+stage stops the others, and is raised once they have all exited.
+
+The depth of each queue, and the number of batches in flight in the
+pool, is sampled as items go through, along with the time spent waiting
+to put and to get. A queue that stays full points at the stage taking
+from it as the bottleneck.
+"""
+PIPELINE_BATCH_BYTES = 1 * MB
+PIPELINE_PBF_BLOCKS = 4
+PIPELINE_QUEUE_SIZE = 8
+# How often blocked stages check whether the pipeline has stopped
+PIPELINE_TIMEOUT = 0.1
+
+class PipelineStopped(Exception):
+    pass
+
+class StageQueue(object):
+    """Bounded queue between two stages, giving up when stop is set"""
+    def __init__(self, name, consumer, maxsize, stop):
+        self.name = name
+        self.consumer = consumer
+        self.maxsize = maxsize
+        self.queue = Queue.Queue(maxsize)
+        self.stop = stop
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+        self.samples = 0
+        self.total_depth = 0
+        self.max_depth = 0
+
+    def sample(self, depth):
+        self.samples += 1
+        self.total_depth += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def put(self, item):
+        start = time.time()
+        while True:
+            if self.stop.is_set():
+                raise PipelineStopped()
+            try:
+                self.queue.put(item, timeout=PIPELINE_TIMEOUT)
+                break
+            except Queue.Full:
+                pass
+        self.put_wait += time.time() - start
+        self.sample(self.queue.qsize())
+
+    def get(self):
+        start = time.time()
+        while True:
+            if self.stop.is_set():
+                raise PipelineStopped()
+            try:
+                item = self.queue.get(timeout=PIPELINE_TIMEOUT)
+                break
+            except Queue.Empty:
+                pass
+        self.get_wait += time.time() - start
+        return item
+
+    def fill(self):
+        """Average depth as a fraction of the queue size"""
+        if not self.samples:
+            return 0.0
+        return float(self.total_depth) / self.samples / self.maxsize
+
+    def stats(self):
+        return {"queue": self.name, "consumer": self.consumer, 
+                "size": self.maxsize, "max_depth": self.max_depth,
+                "average_fill": self.fill(), "put_wait": self.put_wait,
+                "get_wait": self.get_wait}
+
+def iter_xml_batches(osm_file, batch_bytes=PIPELINE_BATCH_BYTES):
+    """Cut an xml stream into (data, last) batches that end just before
+    a top level element"""
+    batch = None
+    pending = ''
+    while True:
+        block = osm_file.read(batch_bytes)
+        if not block:
+            break
+        pending += block
+        cut = max(pending.rfind(start) for start in ELEMENT_STARTS)
+        if cut > 0:
+            if batch is not None:
+                yield batch, False
+            batch, pending = pending[:cut], pending[cut:]
+    if batch is not None:
+        yield batch, not pending
+    if pending:
+        yield pending, True
+
+def iter_pbf_batches(pbf_file, nblocks=PIPELINE_PBF_BLOCKS):
+    blocks = list(iter_pbf_blocks(pbf_file))
+    for start in range(0, len(blocks), nblocks):
+        yield blocks[start:start + nblocks], start + nblocks >= len(blocks)
+
+def audit_batch(task):
+    fname, part, data, last, auditors = task
+    for auditor in auditors:
+        auditor.start(fname, part)
+    batch = io.BytesIO(('' if part == 0 else '<osm>') + data + 
+                       ('' if last else '</osm>'))
+    for element in iter_xml_elements(batch, with_root=last):
+        for auditor in auditors:
+            auditor.process(element)
+    for auditor in auditors:
+        auditor.finish()
+    return auditors
+
+class Pipeline(object):
+    def __init__(self, fname, auditors, processes=1, monitor=None):
+        self.fname = fname
+        self.auditors = auditors
+        self.processes = processes
+        self.monitor = monitor
+        self.stop = threading.Event()
+        self.errors = []
+        self.batches = StageQueue("batches", "parse and shape", 
+                                  PIPELINE_QUEUE_SIZE, self.stop)
+        self.in_flight = StageQueue("in flight", "parse and shape",
+                                    PIPELINE_QUEUE_SIZE, self.stop)
+        self.docs = StageQueue("documents", "load", PIPELINE_QUEUE_SIZE,
+                               self.stop)
+
+    def run_stage(self, target, *args):
+        """Run a stage in a thread, and stop the others if it fails"""
+        try:
+            target(*args)
+        except PipelineStopped:
+            pass
+        except Exception as e:
+            self.errors.append(e)
+            self.stop.set()
+
+    def read(self):
+        with open_osm(self.fname, self.processes) as osm_file:
+            if self.monitor is not None:
+                osm_file = CountingReader(osm_file, self.monitor)
+            if is_pbf(self.fname):
+                batches = iter_pbf_batches(osm_file)
+            else:
+                batches = iter_xml_batches(osm_file)
+            for batch in batches:
+                self.batches.put(batch)
+        self.batches.put(None)
+
+    def collect(self, result):
+        while True:
+            if self.stop.is_set():
+                raise PipelineStopped()
+            try:
+                chunk_auditors = result.get(PIPELINE_TIMEOUT)
+                break
+            except multiprocessing.TimeoutError:
+                pass
+        for auditor, chunk_auditor in zip(self.auditors, chunk_auditors):
+            auditor.merge(chunk_auditor)
+        if self.reshaper_index is not None:
+            reshaper = unwrap_auditor(chunk_auditors[self.reshaper_index])
+            self.docs.put(reshaper.docs)
+
+    def feed(self, pool, templates, worker):
+        in_flight = collections.deque()
+        part = 0
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                break
+            data, last = batch
+            task = (self.fname, part, data, last, 
+                    [copy.copy(template) for template in templates])
+            in_flight.append(pool.apply_async(worker, (task,)))
+            self.in_flight.sample(len(in_flight))
+            part += 1
+            if len(in_flight) >= PIPELINE_QUEUE_SIZE:
+                self.collect(in_flight.popleft())
+        while in_flight:
+            self.collect(in_flight.popleft())
+        self.docs.put(None)
+
+    def iter_docs(self):
+        while True:
+            docs = self.docs.get()
+            if docs is None:
+                break
+            for doc in docs:
+                yield doc
+
+    def run(self, storage=None):
+        self.reshaper_index = None
+        for index, auditor in enumerate(self.auditors):
+            if isinstance(unwrap_auditor(auditor), Reshaper):
+                # Batch reshapers send their documents back to be loaded
+                unwrap_auditor(auditor).keep_docs = storage is not None
+                if storage is not None:
+                    self.reshaper_index = index
+        # Workers get copies of the auditors taken before they are started
+        templates = [copy.copy(auditor) for auditor in self.auditors]
+        for auditor in self.auditors:
+            auditor.start(self.fname)
+        worker = audit_pbf_chunk if is_pbf(self.fname) else audit_batch
+        pool = multiprocessing.Pool(self.processes)
+        threads = [threading.Thread(target=self.run_stage, 
+                                    args=(self.read,)),
+                   threading.Thread(target=self.run_stage, 
+                                    args=(self.feed, pool, templates, 
+                                          worker))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            if storage is not None:
+                storage.load(self.iter_docs())
+            else:
+                for thread in threads:
+                    while thread.is_alive():
+                        thread.join(PIPELINE_TIMEOUT)
+        except PipelineStopped:
+            pass
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            if self.errors:
+                self.stop.set()
+            for thread in threads:
+                thread.join()
+            pool.terminate()
+        if self.errors:
+            raise self.errors[0]
+        for auditor in self.auditors:
+            auditor.finish()
+        return self.auditors
+
+    def report(self):
+        print "\nPipeline queues"
+        print "=========================================================="
+        for queue in (self.batches, self.in_flight, self.docs):
+            print ("{0:10} {1:4.0%} full on average, max {2}/{3}, "
+                   "put waits {4:.2f}s, get waits {5:.2f}s").format(
+                queue.name, queue.fill(), queue.max_depth, queue.maxsize,
+                queue.put_wait, queue.get_wait)
+        # The stage behind the last mostly full queue holds up the rest
+        bottleneck = "read and uncompress"
+        for queue in (self.batches, self.in_flight, self.docs):
+            if queue.fill() >= 0.5:
+                bottleneck = queue.consumer
+        print "bottleneck: " + bottleneck
+
+    def stats(self):
+        return [queue.stats() 
+                for queue in (self.batches, self.in_flight, self.docs)]
+
+def unwrap_auditor(auditor):
+    """The auditor inside a TimedAuditor"""
+    return getattr(auditor, "auditor", auditor)
+
+def run_pipeline(fname, auditors, storage=None, processes=1, monitor=None):
+    """Run the auditors over the file and load the documents of its
+    Reshaper into storage, in one pipelined pass"""
+    if monitor is not None:
+        auditors = monitor.start_pass(fname, auditors, processes)
+        monitor.serial = False
+    pipeline = Pipeline(fname, auditors, processes, monitor)
+    pipeline.run(storage)
+    pipeline.report()
+    if monitor is not None:
+        monitor.queues = pipeline.stats()
+        auditors = monitor.finish_pass()
+    return auditors
+
+############################################################################
+# Result cache and resumable runs
+############################################################################
+"""
+A ResultCache keeps the finished auditors of a pass, pickled, under a
+key made of the sha1 of the input file, a fingerprint of the cleaning
+rules (the street and city mappings, the expected street types and
+CACHE_VERSION, to be bumped when the cleaning code changes) and the
+cache_key() of the auditor. lookup() returns the cached auditors, as
+long as the files they wrote are still there with the same sizes, and
+the auditors that still have to run. The sha1 of a file is kept along
+with its size and modification time, so an unchanged file is only
+hashed once.
+
+run_auditors_resumable() runs a pass in batches of whole elements, and
+every CHECKPOINT_INTERVAL seconds saves a checkpoint: the byte offset
+in the uncompressed stream (or of the next pbf block), the id of the
+last element and the state of the auditors, with the size of the
+Reshaper's output so far. A run interrupted in the pass resumes from
+its checkpoint, which is named after the same key as the cache. Passes
+split over processes, and auditors that write files during the pass
+or a compressed output, are not checkpointed.
+
+load_resumable() records the number of documents the storage has
+committed, and a load that is interrupted skips them when it is run
+again. The MongoDB documents get an _id made of their osm_type and id,
+and duplicates are ignored, since the batches still in flight when the
+load stopped may have been written already.
+"""
+RESULT_CACHE_DIR = ".wrangle_cache"
+CACHE_VERSION = 3
+CHECKPOINT_INTERVAL = 60.0
+
+def rules_fingerprint(rules):
+    return hashlib.sha1(json.dumps([
+        CACHE_VERSION, sorted(rules.street_mapping.items()), 
+        sorted(rules.city_mapping.items()), sorted(rules.street_types),
+        rules.postcode_re.pattern, rules.postcode_length])).hexdigest()
+
+def save_pickle(fname, obj):
+    """Write obj to fname, replacing the old file only once it is written"""
+    with open(fname + ".tmp", "wb") as pickle_file:
+        pickle.dump(obj, pickle_file, pickle.HIGHEST_PROTOCOL)
+    os.rename(fname + ".tmp", fname)
+
+def load_pickle(fname):
+    if not os.path.exists(fname):
+        return None
+    with open(fname, "rb") as pickle_file:
+        return pickle.load(pickle_file)
+
+class ResultCache(object):
+    def __init__(self, cache_dir=RESULT_CACHE_DIR, rules=None):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.rules = rules or cleaning_rules
+        self.digests_fname = os.path.join(cache_dir, "digests.json")
+        self.digests = {}
+        if os.path.exists(self.digests_fname):
+            with open(self.digests_fname) as digests_file:
+                self.digests = json.load(digests_file)
+
+    def file_digest(self, fname):
+        path = os.path.abspath(fname)
+        stat = os.stat(path)
+        known = self.digests.get(path)
+        if known and known[:2] == [stat.st_size, stat.st_mtime]:
+            return known[2]
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as osm_file:
+            for block in iter(lambda: osm_file.read(OUTPUT_BUFFER_SIZE), ''):
+                sha1.update(block)
+        self.digests[path] = [stat.st_size, stat.st_mtime, sha1.hexdigest()]
+        with open(self.digests_fname, "w") as digests_file:
+            json.dump(self.digests, digests_file)
+        return sha1.hexdigest()
+
+    def path(self, fname, keys, ext):
+        key = hashlib.sha1("\n".join([self.file_digest(fname), 
+                                      rules_fingerprint(self.rules)] + 
+                                     keys)).hexdigest()
+        return os.path.join(self.cache_dir, "{0}-{1}{2}".format(
+            osm_basename(fname), key[:20], ext))
+
+    def result_fname(self, fname, auditor):
+        return self.path(fname, [auditor.cache_key()], ".pickle")
+
+    def checkpoint_fname(self, fname, auditors, stage="pass"):
+        return self.path(fname, [auditor.cache_key() for auditor in auditors],
+                         "." + stage)
+
+    def lookup(self, fname, auditors):
+        """The auditors with cached results replaced by them, and the
+        auditors that are not cached"""
+        found = []
+        missing = []
+        for auditor in auditors:
+            cached = load_pickle(self.result_fname(fname, auditor))
+            if cached is not None:
+                cached_auditor, sizes = cached
+                outputs = cached_auditor.outputs()
+                if all(os.path.exists(output) and 
+                       os.path.getsize(output) == size
+                       for output, size in zip(outputs, sizes)):
+                    print "Using cached results of " + auditor.title
+                    found.append(cached_auditor)
+                    continue
+            found.append(auditor)
+            missing.append(auditor)
+        return found, missing
+
+    def store(self, fname, auditors):
+        for auditor in auditors:
+            sizes = [os.path.getsize(output) for output in auditor.outputs()]
+            save_pickle(self.result_fname(fname, auditor), (auditor, sizes))
+
+def run_auditors_resumable(fname, auditors, checkpoint_fname, processes=1,
+                           monitor=None):
+    """Like run_auditors(), saving checkpoints to checkpoint_fname and
+    resuming from the one an interrupted run left"""
+    if ((processes > 1 and not is_compressed(fname)) or 
+        not all(auditor.resumable for auditor in auditors)):
+        return run_auditors(fname, auditors, processes, monitor)
+    start = time.time()
+    cpu_start = cpu_times()
+    state = load_pickle(checkpoint_fname)
+    if state is None:
+        for auditor in auditors:
+            auditor.start(fname)
+        position = part = count = 0
+    else:
+        for auditor, auditor_state in zip(auditors, state["auditors"]):
+            auditor.resume(auditor_state)
+        position, part, count = state["position"], state["part"], \
+                                state["count"]
+        print "Resuming {0} at byte {1}, after {2} {3}".format(
+            fname, position, *state["last"])
+    last = state and state["last"]
+    saved = time.time()
+    with open_osm(fname, processes) as osm_file:
+        if is_pbf(fname):
+            blocks = [block for block in iter_pbf_blocks(osm_file)
+                      if block[1] >= position]
+            batches = [(blocks[i:i + PIPELINE_PBF_BLOCKS], 
+                        i + PIPELINE_PBF_BLOCKS >= len(blocks))
+                       for i in range(0, len(blocks), PIPELINE_PBF_BLOCKS)]
+        else:
+            if is_compressed(fname):
+                skip = position
+                while skip > 0:
+                    skip -= len(osm_file.read(min(skip, OUTPUT_BUFFER_SIZE)))
+            else:
+                osm_file.seek(position)
+            batches = iter_xml_batches(osm_file)
+        for batch, last_batch in batches:
+            if part and time.time() - saved >= CHECKPOINT_INTERVAL:
+                save_pickle(checkpoint_fname, {
+                    "position": position, "part": part, "count": count,
+                    "last": last, 
+                    "auditors": [auditor.checkpoint() 
+                                 for auditor in auditors]})
+                saved = time.time()
+            if is_pbf(fname):
+                elements = iter_pbf_elements(osm_file, batch, last_batch)
+            else:
+                elements = iter_xml_elements(io.BytesIO(
+                    ('' if part == 0 else '<osm>') + batch + 
+                    ('' if last_batch else '</osm>')), with_root=last_batch)
+            for element in elements:
+                for auditor in auditors:
+                    auditor.process(element)
+                last = (element.tag, element.attrib.get('id'))
+                count += 1
+            part += 1
+            if is_pbf(fname):
+                block_type, offset, size = batch[-1]
+                position = offset + size
+            else:
+                position += len(batch)
+    for auditor in auditors:
+        auditor.finish()
+    if os.path.exists(checkpoint_fname):
+        os.remove(checkpoint_fname)
+    if monitor is not None:
+        monitor.add_stage("resumable pass over " + os.path.basename(fname),
+                          time.time() - start, cpu_times() - cpu_start, 
+                          count, rss=peak_rss())
+    return auditors
+
+def load_resumable(db, docs_fname, checkpoint_fname):
+    """Load the documents of docs_fname into db, skipping the documents
+    an interrupted load committed already"""
+    state = load_pickle(checkpoint_fname) or {"loaded": 0}
+    loaded = state["loaded"]
+    if loaded:
+        print "Resuming the load of {} after {} documents".format(
+            docs_fname, loaded)
+    docs = itertools.islice(iter_output_documents(docs_fname), loaded, None)
+    def committed(count):
+        save_pickle(checkpoint_fname, {"loaded": loaded + count})
+    db.load(docs, committed)
+    if os.path.exists(checkpoint_fname):
+        os.remove(checkpoint_fname)
+
+############################################################################
+# Resolve way geometry from a node coordinate index
+############################################################################
+"""
+Ways only refer to their nodes by id. The NodeIndexer collects the id
+and coordinates of every node during a pass over the file, and writes
+them into a node index file: a header, then the sorted node ids as
+int64, then the latitudes and the longitudes as int32 in units of 1e-7
+degrees, the precision of the osm file. NodeIndex maps the file into
+memory and finds nodes by binary search over the ids, so tens of
+millions of nodes are resolved without loading them into Python
+objects.
+
+While collecting, the columns are appended to temporary files in
+blocks. Extracts list their nodes in id order, in which case the
+columns are simply copied into the index. Otherwise they are sorted
+externally: runs of NODE_SORT_BLOCK nodes are sorted in memory and
+written to disk, and the runs are merged into the columns, so that
+memory does not grow with the number of nodes.
+
+With an index, the Reshaper adds the bounding box, centroid and length
+in metres of each way to its document. Nodes missing from the extract
+are left out. Extracts list all nodes before the ways, so in a serial
+pass the Reshaper fills the index itself with index_nodes: it collects
+the nodes as they are shaped, and writes and maps the index when the
+first way comes. Only the parts of a parallel or pipelined pass can not
+see the nodes of the parts before them, and those runs index the nodes
+in a pass of their own with build_node_index().
+"""
+NODE_INDEX_MAGIC = 'OSMNODES'
+NODE_INDEX_HEADER = struct.Struct('=8sq')
+NODE_INDEX_BLOCK = 64 * 1024
+# Nodes sorted in memory at a time when the extract is not in id order
+NODE_SORT_BLOCK = 1024 * 1024
+COORD_SCALE = 10 ** 7
+# array has no 64 bit typecode on Python 2; 'l' is 64 bit on 64 bit
+# unix, and doubles hold node ids exactly elsewhere
+INT64_TYPECODE = 'l' if array.array('l').itemsize == 8 else 'd'
+INT64_FORMAT = '=q' if INT64_TYPECODE == 'l' else '=d'
+# An id, latitude and longitude in a sorted run
+NODE_RECORD = struct.Struct(INT64_FORMAT + 'ii')
+EARTH_RADIUS = 6371008.8
+
+class NodeIndexer(Auditor):
+    title = "Indexing node coordinates"
+    # The columns are written out during the pass
+    resumable = False
+
+    def outputs(self):
+        return [self.index_fname]
+
+    def start(self, fname, part=None):
+        Auditor.start(self, fname, part)
+        self.part = part
+        self.index_fname = "{0}.nodes".format(osm_basename(fname))
+        if part is not None:
+            self.index_fname += ".part{}".format(part)
+        self.column_fnames = [self.index_fname + ext 
+                              for ext in ('.ids', '.lats', '.lons')]
+        self.column_files = [open(cfname, 'wb') 
+                             for cfname in self.column_fnames]
+        self.new_columns()
+        self.count = 0
+        self.first_id = None
+        self.last_id = None
+        self.is_sorted = True
+
+    def new_columns(self):
+        self.columns = [array.array(INT64_TYPECODE), array.array('i'), 
+                        array.array('i')]
+
+    def flush(self):
+        for column, column_file in zip(self.columns, self.column_files):
+            column.tofile(column_file)
+        self.new_columns()
+
+    def process(self, element):
+        if element.tag != "node" or 'lat' not in element.attrib:
+            return
+        node_id = int(element.attrib['id'])
+        if self.first_id is None:
+            self.first_id = node_id
+        elif node_id <= self.last_id:
+            self.is_sorted = False
+        self.last_id = node_id
+        ids, lats, lons = self.columns
+        ids.append(node_id)
+        lats.append(int(round(float(element.attrib['lat']) * COORD_SCALE)))
+        lons.append(int(round(float(element.attrib['lon']) * COORD_SCALE)))
+        self.count += 1
+        if len(ids) >= NODE_INDEX_BLOCK:
+            self.flush()
+
+    def merge(self, other):
+        for cfname, column_file in zip(other.column_fnames, 
+                                       self.column_files):
+            with open(cfname, 'rb') as part:
+                shutil.copyfileobj(part, column_file, OUTPUT_BUFFER_SIZE)
+            os.remove(cfname)
+        if other.count:
+            if self.count and (not other.is_sorted or 
+                               other.first_id <= self.last_id):
+                self.is_sorted = False
+            elif not other.is_sorted:
+                self.is_sorted = False
+            if self.first_id is None:
+                self.first_id = other.first_id
+            self.last_id = other.last_id
+            self.count += other.count
+
+    def finish(self):
+        self.flush()
+        for column_file in self.column_files:
+            column_file.close()
+        # file objects can not be sent back from a worker process
+        del self.column_files
+        if self.part is None:
+            write_node_index(self.index_fname, self.column_fnames, 
+                             self.count, self.is_sorted)
+
+    def report(self):
+        Auditor.report(self)
+        print "{} nodes indexed in {}".format(self.count, self.index_fname)
+
+def write_node_index(index_fname, column_fnames, count, is_sorted):
+    if not is_sorted:
+        sort_node_columns(column_fnames, count)
+    with open(index_fname, 'wb') as index_file:
+        index_file.write(NODE_INDEX_HEADER.pack(NODE_INDEX_MAGIC, count))
+        for cfname in column_fnames:
+            with open(cfname, 'rb') as column_file:
+                shutil.copyfileobj(column_file, index_file, 
+                                   OUTPUT_BUFFER_SIZE)
+    for cfname in column_fnames:
+        os.remove(cfname)
+
+def iter_column_blocks(column_fnames, count, block=NODE_SORT_BLOCK):
+    """Yield the id, latitude and longitude columns in blocks of up to
+    block nodes"""
+    column_files = [open(cfname, 'rb') for cfname in column_fnames]
+    try:
+        left = count
+        while left:
+            size = min(block, left)
+            columns = []
+            for column_file, typecode in zip(column_files, 
+                                             (INT64_TYPECODE, 'i', 'i')):
+                column = array.array(typecode)
+                column.fromfile(column_file, size)
+                columns.append(column)
+            left -= size
+            yield columns
+    finally:
+        for column_file in column_files:
+            column_file.close()
+
+def iter_node_run(run_fname):
+    """Yield the (id, lat, lon) records of a sorted run"""
+    with open(run_fname, 'rb') as run_file:
+        while True:
+            data = run_file.read(NODE_INDEX_BLOCK * NODE_RECORD.size)
+            if not data:
+                break
+            for pos in xrange(0, len(data), NODE_RECORD.size):
+                yield NODE_RECORD.unpack_from(data, pos)
+
+def sort_node_columns(column_fnames, count, block=NODE_SORT_BLOCK):
+    """Sort the column files by node id, in runs of block nodes that are
+    merged from disk"""
+    run_fnames = []
+    for ids, lats, lons in iter_column_blocks(column_fnames, count, block):
+        run_fname = "{0}.run{1}".format(column_fnames[0], len(run_fnames))
+        order = sorted(xrange(len(ids)), key=ids.__getitem__)
+        with open(run_fname, 'wb') as run_file:
+            for start in xrange(0, len(order), NODE_INDEX_BLOCK):
+                run_file.write(''.join(
+                    NODE_RECORD.pack(ids[i], lats[i], lons[i]) 
+                    for i in order[start:start + NODE_INDEX_BLOCK]))
+        run_fnames.append(run_fname)
+        del order
+    column_files = [open(cfname, 'wb') for cfname in column_fnames]
+    columns = [array.array(INT64_TYPECODE), array.array('i'), 
+               array.array('i')]
+    for record in heapq.merge(*[iter_node_run(run_fname) 
+                                for run_fname in run_fnames]):
+        for column, value in zip(columns, record):
+            column.append(value)
+        if len(columns[0]) >= NODE_INDEX_BLOCK:
+            for column, column_file in zip(columns, column_files):
+                column.tofile(column_file)
+                del column[:]
+    for column, column_file in zip(columns, column_files):
+        column.tofile(column_file)
+        column_file.close()
+    for run_fname in run_fnames:
+        os.remove(run_fname)
+
+class NodeColumn(object):
+    """Read only sequence view of a column of the index file"""
+    def __init__(self, buf, offset, fmt, count):
+        self.buf = buf
+        self.offset = offset
+        self.unpack = struct.Struct(fmt).unpack_from
+        self.size = struct.calcsize(fmt)
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.unpack(self.buf, self.offset + i * self.size)[0]
+
+class NodeIndex(object):
+    def __init__(self, index_fname):
+        self.index_file = open(index_fname, 'rb')
+        self.buf = mmap.mmap(self.index_file.fileno(), 0, 
+                             access=mmap.ACCESS_READ)
+        magic, count = NODE_INDEX_HEADER.unpack_from(self.buf, 0)
+        if magic != NODE_INDEX_MAGIC:
+            raise IOError("Not a node index file: " + index_fname)
+        offset = NODE_INDEX_HEADER.size
+        self.ids = NodeColumn(self.buf, offset, INT64_FORMAT, count)
+        offset += 8 * count
+        self.lats = NodeColumn(self.buf, offset, '=i', count)
+        offset += 4 * count
+        self.lons = NodeColumn(self.buf, offset, '=i', count)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def find(self, node_id, lo=0):
+        i = bisect.bisect_left(self.ids, node_id, lo)
+        if i < len(self.ids) and self.ids[i] == node_id:
+            return i
+        return None
+
+    def lookup(self, node_id):
+        """(lat, lon) of a node, or None if it is not in the index"""
+        i = self.find(int(node_id))
+        if i is None:
+            return None
+        return (float(self.lats[i]) / COORD_SCALE, 
+                float(self.lons[i]) / COORD_SCALE)
+
+    def lookup_many(self, node_ids):
+        """(lat, lon) or None for each of a list of node ids, as for the
+        refs of a way. The ids are searched in order, each search
+        starting where the last one ended."""
+        wanted = sorted(set(int(node_id) for node_id in node_ids))
+        found = {}
+        lo = 0
+        for node_id in wanted:
+            lo = bisect.bisect_left(self.ids, node_id, lo)
+            if lo == len(self.ids):
+                break
+            if self.ids[lo] == node_id:
+                found[node_id] = (float(self.lats[lo]) / COORD_SCALE,
+                                  float(self.lons[lo]) / COORD_SCALE)
+        return [found.get(int(node_id)) for node_id in node_ids]
+
+    def close(self):
+        self.buf.close()
+        self.index_file.close()
+
+def haversine(pos1, pos2):
+    """Distance in metres between two (lat, lon) positions"""
+    lat1, lon1 = math.radians(pos1[0]), math.radians(pos1[1])
+    lat2, lon2 = math.radians(pos2[0]), math.radians(pos2[1])
+    a = (math.sin((lat2 - lat1) / 2) ** 2 + 
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+def add_way_geometry(doc, node_index):
+    coords = [pos for pos in node_index.lookup_many(doc["node_refs"]) 
+              if pos is not None]
+    if not coords:
+        return doc
+    lats = [pos[0] for pos in coords]
+    lons = [pos[1] for pos in coords]
+    doc["bbox"] = [min(lats), min(lons), max(lats), max(lons)]
+    # A closed way lists its first node again at the end
+    vertices = coords[:-1] if len(coords) > 1 and coords[0] == coords[-1] \
+        else coords
+    doc["centroid"] = [sum(pos[0] for pos in vertices) / len(vertices),
+                       sum(pos[1] for pos in vertices) / len(vertices)]
+    doc["length"] = sum(haversine(pos1, pos2) 
+                        for pos1, pos2 in zip(coords[:-1], coords[1:]))
+    return doc
+
+def build_node_index(fname, processes=1, monitor=None, cache=None):
+    auditors = missing = [NodeIndexer()]
+    if cache is not None:
+        auditors, missing = cache.lookup(fname, auditors)
+    if missing:
+        run_auditors(fname, missing, processes, monitor)
+        if cache is not None:
+            cache.store(fname, missing)
+    indexer = auditors[0]
+    indexer.report()
+    return indexer.index_fname
+
+############################################################################
+# Partitioned output: shards by element type and tile
+############################################################################
+"""
+A single output file can only be read by one loader at a time. The
+ShardedReshaper splits the shaped documents by element type and by
+tile, the geohash of PARTITION_PRECISION characters of the "pos" of a
+node or the "centroid" of a way, into shard files under
+<basename>.shards/. A shard is closed once SHARD_MAX_BYTES of documents
+(before compression) are written to it, and the next documents of its
+type and tile go to a new one. Ways have no centroid without a node
+index, and go to the "untiled" shards of their type. At most
+SHARD_MAX_OPEN shards are open at a time, each buffering
+SHARD_BUFFER_SIZE bytes; the least recently written one is closed when
+another has to be opened.
+
+The workers of a parallel or pipelined pass write an uncompressed
+piece for each type and tile they see. The main process copies the
+pieces into its shards document by document, without decoding them, so
+that many small batches do not leave many small shards behind. Shards
+are therefore always compact: one json document per line, or bson.
+
+The manifest.json of the directory lists each shard with its type,
+tile, document count, bytes before compression, file bytes and the
+bounding box [minlat, minlon, maxlat, maxlon] of its documents. The
+bounding box of a shard filled from pieces covers the whole of those
+pieces. select_shards() picks the shards of some types that overlap a
+bounding box, iter_output_documents() reads all the shards of a
+manifest, and import_shards() loads them into MongoDB with a process
+for each shard, the largest first.
+"""
+PARTITION_PRECISION = 4
+SHARD_MAX_BYTES = 64 * MB
+SHARD_MAX_OPEN = 64
+SHARD_BUFFER_SIZE = 256 * 1024
+SHARD_MANIFEST = "manifest.json"
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+def geohash(lat, lon, precision=PARTITION_PRECISION):
+    """Geohash of precision characters of a position"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = nbits = 0
+    # Bits alternate between longitude and latitude, longitude first
+    use_lon = True
+    while len(chars) < precision:
+        span, value = (lon_range, lon) if use_lon else (lat_range, lat)
+        mid = (span[0] + span[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            span[0] = mid
+        else:
+            bits *= 2
+            span[1] = mid
+        use_lon = not use_lon
+        nbits += 1
+        if nbits == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = nbits = 0
+    return "".join(chars)
+
+def doc_point(doc):
+    """Position of a shaped node, or centroid of a way"""
+    return doc.get("pos") or doc.get("centroid")
+
+def extend_bbox(bbox, other):
+    if bbox is None:
+        return other and list(other)
+    if other is None:
+        return bbox
+    return [min(bbox[0], other[0]), min(bbox[1], other[1]),
+            max(bbox[2], other[2]), max(bbox[3], other[3])]
+
+def shard_dirname(fname):
+    return "{0}.shards".format(osm_basename(fname))
+
+def iter_encoded_documents(fname, output_format='json', 
+                           block_size=OUTPUT_BUFFER_SIZE):
+    """Yield the documents of an uncompressed compact output file as they
+    are encoded, one json line or bson document at a time"""
+    with open(fname, "rb") as encoded_file:
+        buf = ''
+        while True:
+            block = encoded_file.read(block_size)
+            buf += block
+            pos = 0
+            while True:
+                if output_format == 'bson':
+                    if len(buf) - pos < 4:
+                        break
+                    end = pos + struct.unpack_from('<i', buf, pos)[0]
+                    if end > len(buf):
+                        break
+                else:
+                    end = buf.find('\n', pos) + 1
+                    if not end:
+                        break
+                yield buf[pos:end]
+                pos = end
+            buf = buf[pos:]
+            if not block:
+                break
+
+class ShardWriter(object):
+    """Write documents into the shards of each element type and tile
+    under dirname. A worker writes one uncompressed piece for each type
+    and tile instead, named after its part."""
+    def __init__(self, dirname, encode, output_format='json', 
+                 compression=None, precision=PARTITION_PRECISION,
+                 max_bytes=SHARD_MAX_BYTES, part=None):
+        self.dirname = dirname
+        self.encode = encode
+        self.output_format = output_format
+        self.compression = compression
+        self.precision = precision
+        self.max_bytes = max_bytes
+        self.part = part
+        # Open shards by (type, tile), the least recently written first
+        self.open = OrderedDict()
+        self.sequence = defaultdict(int)
+        self.shards = []
+        self.bytes = 0
+
+    def shard_key(self, doc):
+        point = doc_point(doc)
+        tile = geohash(point[0], point[1], self.precision) if point else None
+        # Not "type", which a tag can set to anything
+        return doc["osm_type"], tile
+
+    def shard(self, key):
+        """Writer and manifest entry of the open shard of the key"""
+        entry = self.open.pop(key, None)
+        if entry is None:
+            if len(self.open) >= SHARD_MAX_OPEN:
+                self.close_shard(*self.open.popitem(last=False)[1])
+            elem_type, tile = key
+            self.sequence[key] += 1
+            shard_fname = "{0}-{1}-{2:04d}.{3}{4}".format(
+                elem_type, tile or "untiled", self.sequence[key],
+                self.output_format, OUTPUT_COMPRESSIONS[self.compression])
+            if self.part is not None:
+                shard_fname += ".part{0}".format(self.part)
+            shard = {"file": shard_fname, "type": elem_type, "tile": tile,
+                     "count": 0, "bbox": None}
+            writer = OutputWriter(os.path.join(self.dirname, shard_fname), 
+                                  self.encode, self.compression, 
+                                  buffer_size=SHARD_BUFFER_SIZE)
+            entry = writer, shard
+        self.open[key] = entry
+        return entry
+
+    def write(self, doc):
+        key = self.shard_key(doc)
+        writer, shard = self.shard(key)
+        writer.write(doc)
+        point = doc_point(doc)
+        self.added(key, doc.get("bbox") or (point and point + point))
+
+    def write_encoded(self, key, data, bbox):
+        """Add a document already encoded, lying within bbox"""
+        writer, shard = self.shard(key)
+        writer.write_raw(data)
+        self.added(key, bbox)
+
+    def added(self, key, bbox):
+        writer, shard = self.open[key]
+        shard["count"] += 1
+        shard["bbox"] = extend_bbox(shard["bbox"], bbox)
+        if (self.part is None and 
+            writer.bytes + writer.size >= self.max_bytes):
+            del self.open[key]
+            self.close_shard(writer, shard)
+
+    def close_shard(self, writer, shard):
+        writer.close()
+        shard["bytes"] = writer.bytes
+        shard["file_bytes"] = os.path.getsize(
+            os.path.join(self.dirname, shard["file"]))
+        self.bytes += writer.bytes
+        self.shards.append(shard)
+
+    def close(self):
+        for writer, shard in self.open.values():
+            self.close_shard(writer, shard)
+        self.open.clear()
+
+class ShardedReshaper(Reshaper):
+    """Reshaper writing shards and their manifest instead of one file"""
+    title = "Reshaping and saving shards"
+
+    def __init__(self, node_index=None, output_format='json', 
+                 compression=None, encoder='json', 
+                 precision=PARTITION_PRECISION, max_bytes=SHARD_MAX_BYTES,
+                 index_nodes=False):
+        Reshaper.__init__(self, False, node_index, output_format, 
+                          compression, encoder, index_nodes)
+        self.precision = precision
+        self.max_bytes = max_bytes
+        # Shards can not be continued from a checkpoint
+        self.resumable = False
+
+    def open_writer(self, fname, part, encode):
+        dirname = shard_dirname(fname)
+        self.part = part
+        if part is None:
+            # Shards of an earlier run would be mixed with the new ones
+            if os.path.isdir(dirname):
+                shutil.rmtree(dirname)
+            os.makedirs(dirname)
+        writer = ShardWriter(dirname, encode, self.output_format, 
+                             self.compression if part is None else None,
+                             self.precision, self.max_bytes, part)
+        self.shards = writer.shards
+        return os.path.join(dirname, SHARD_MANIFEST), writer
+
+    def merge_output(self, other):
+        for piece in other.shards:
+            piece_fname = os.path.join(self.fo.dirname, piece["file"])
+            key = (piece["type"], piece["tile"])
+            for data in iter_encoded_documents(piece_fname, 
+                                               self.output_format):
+                self.fo.write_encoded(key, data, piece["bbox"])
+            os.remove(piece_fname)
+
+    def finish(self):
+        Reshaper.finish(self)
+        if self.part is None:
+            self.write_manifest()
+
+    def write_manifest(self):
+        self.shards.sort(key=lambda shard: (shard["type"], 
+                                            shard["tile"] or "", 
+                                            shard["file"]))
+        bbox = None
+        for shard in self.shards:
+            bbox = extend_bbox(bbox, shard["bbox"])
+        manifest = {"source": os.path.basename(self.fname), 
+                    "format": self.output_format, 
+                    "compression": self.compression,
+                    "precision": self.precision, 
+                    "max_bytes": self.max_bytes, "count": self.count, 
+                    "bytes": self.bytes_out, "bbox": bbox, 
+                    "shards": self.shards}
+        with open(self.file_out, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+
+    def cache_key(self):
+        return "{0}:{1}:{2}".format(Reshaper.cache_key(self), self.precision,
+                                    self.max_bytes)
+
+    def outputs(self):
+        dirname = os.path.dirname(self.file_out)
+        return [self.file_out] + [os.path.join(dirname, shard["file"]) 
+                                  for shard in self.shards]
+
+    def report(self):
+        Reshaper.report(self)
+        tiles = set(shard["tile"] for shard in self.shards)
+        print "{} shards in {} tiles, {} bytes".format(
+            len(self.shards), len(tiles), self.bytes_out)
+
+def load_manifest(manifest_fname):
+    with open(manifest_fname) as manifest_file:
+        return json.load(manifest_file)
+
+def select_shards(manifest, types=None, bbox=None):
+    """Shards of the element types given that overlap bbox"""
+    selected = []
+    for shard in manifest["shards"]:
+        if types is not None and shard["type"] not in types:
+            continue
+        if bbox is not None:
+            if shard["bbox"] is None:
+                continue
+            minlat, minlon, maxlat, maxlon = shard["bbox"]
+            if (minlat > bbox[2] or maxlat < bbox[0] or 
+                minlon > bbox[3] or maxlon < bbox[1]):
+                continue
+        selected.append(shard)
+    return selected
+
+def iter_manifest_documents(manifest_fname, types=None, bbox=None):
+    """Yield the documents of the shards selected from the manifest"""
+    dirname = os.path.dirname(manifest_fname)
+    for shard in select_shards(load_manifest(manifest_fname), types, bbox):
+        for doc in iter_output_documents(os.path.join(dirname, 
+                                                      shard["file"])):
+            yield doc
+
+def import_shard(task):
+    db_name, shard_fname = task
+    loader = BulkLoader(get_mongodb(db_name).maps, writers=1, indexes=())
+    return loader.load(iter_output_documents(shard_fname))
+
+def import_shards(manifest_fname, db_name, processes=None, types=None, 
+                  bbox=None):
+    """Load the selected shards into the maps collection of db_name,
+    several shards at a time"""
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    dirname = os.path.dirname(manifest_fname)
+    shards = sorted(select_shards(load_manifest(manifest_fname), types, bbox),
+                    key=lambda shard: -shard["bytes"])
+    tasks = [(db_name, os.path.join(dirname, shard["file"])) 
+             for shard in shards]
+    print "\nImporting {} shards into MongoDB".format(len(tasks))
+    print "=========================================================="
+    start = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        inserted = sum(pool.imap_unordered(import_shard, tasks))
+    finally:
+        pool.terminate()
+    ensure_indexes(get_mongodb(db_name).maps)
+    elapsed = time.time() - start
+    print "Inserted {} documents in {:.2f} s ({:.0f} docs/s)".format(
+        inserted, elapsed, inserted / elapsed if elapsed else 0)
+    return inserted
+
+############################################################################
+# Spatial index over the shaped nodes
+############################################################################
+"""
+The SpatialIndex answers bounding box, radius and nearest neighbour
+queries over the "pos" of the shaped nodes without a database. Nodes
+are bucketed into a grid of cell_size degree cells, and stored sorted
+by cell in compact arrays: ids, coordinates in 1e-7 degrees, and for
+each of SPATIAL_TAGS the value of the tag as a number into a table of
+distinct values. A query only looks at the cells its area overlaps.
+
+The index is built from any stream of shaped documents, like the one
+reshape_data() yields or iter_json_documents() reads back, and saved
+to a file: a header line of json describing the arrays, followed by
+the arrays themselves.
+"""
+SPATIAL_INDEX_MAGIC = 'OSMGRID1'
+SPATIAL_TAGS = ("amenity", "shop", "highway", "cuisine")
+SPATIAL_CELL_SIZE = 0.01
+
+class SpatialIndex(object):
+    def __init__(self, cell_size=SPATIAL_CELL_SIZE, tag_keys=SPATIAL_TAGS):
+        self.cell_size = cell_size
+        self.tag_keys = list(tag_keys)
+        self.ids = array.array(INT64_TYPECODE)
+        self.lats = array.array('i')
+        self.lons = array.array('i')
+        # Value 0 stands for a missing tag
+        self.tag_values = dict((key, [None]) for key in self.tag_keys)
+        self.tag_numbers = dict((key, {None: 0}) for key in self.tag_keys)
+        self.tags = dict((key, array.array('i')) for key in self.tag_keys)
+        self.cells = {}
+
+    def cell(self, lat, lon):
+        return (int(math.floor(lat / self.cell_size)), 
+                int(math.floor(lon / self.cell_size)))
+
+    def add(self, doc):
+        """Add a shaped document, if it is a node with a position"""
+        pos = doc.get("pos")
+        if pos is None:
+            return
+        self.ids.append(int(doc["id"]))
+        self.lats.append(int(round(pos[0] * COORD_SCALE)))
+        self.lons.append(int(round(pos[1] * COORD_SCALE)))
+        for key in self.tag_keys:
+            value = doc.get(key)
+            numbers = self.tag_numbers[key]
+            if value not in numbers:
+                numbers[value] = len(self.tag_values[key])
+                self.tag_values[key].append(value)
+            self.tags[key].append(numbers[value])
+
+    def build(self):
+        """Sort the points by cell and fill the cell table"""
+        keys = [self.cell(float(lat) / COORD_SCALE, float(lon) / COORD_SCALE)
+                for lat, lon in zip(self.lats, self.lons)]
+        order = sorted(xrange(len(keys)), key=keys.__getitem__)
+        for name in ('ids', 'lats', 'lons'):
+            column = getattr(self, name)
+            setattr(self, name, array.array(column.typecode, 
+                                            (column[i] for i in order)))
+        for key in self.tag_keys:
+            column = self.tags[key]
+            self.tags[key] = array.array('i', (column[i] for i in order))
+        self.cells = {}
+        for pos, i in enumerate(order):
+            start, end = self.cells.get(keys[i], (pos, pos))
+            self.cells[keys[i]] = (start, pos + 1)
+        return self
+
+    def __len__(self):
+        return len(self.ids)
+
+    def save(self, index_fname):
+        header = {
+            "cell_size": self.cell_size,
+            "count": len(self.ids),
+            "tag_keys": self.tag_keys,
+            "tag_values": self.tag_values,
+            "cells": [[row, col, start, end] for (row, col), (start, end) 
+                      in sorted(self.cells.iteritems())],
+            "id_typecode": INT64_TYPECODE,
+        }
+        with open(index_fname, 'wb') as index_file:
+            index_file.write(SPATIAL_INDEX_MAGIC + json.dumps(header) + "\n")
+            self.ids.tofile(index_file)
+            self.lats.tofile(index_file)
+            self.lons.tofile(index_file)
+            for key in self.tag_keys:
+                self.tags[key].tofile(index_file)
+
+    @classmethod
+    def load(cls, index_fname):
+        with open(index_fname, 'rb') as index_file:
+            if index_file.read(len(SPATIAL_INDEX_MAGIC)) != SPATIAL_INDEX_MAGIC:
+                raise IOError("Not a spatial index file: " + index_fname)
+            header = json.loads(index_file.readline())
+            index = cls(header["cell_size"], header["tag_keys"])
+            count = header["count"]
+            index.ids = array.array(str(header["id_typecode"]))
+            for column in (index.ids, index.lats, index.lons):
+                column.fromfile(index_file, count)
+            for key in index.tag_keys:
+                index.tags[key].fromfile(index_file, count)
+        index.tag_values = header["tag_values"]
+        index.tag_numbers = dict(
+            (key, dict((value, i) for i, value in enumerate(values)))
+            for key, values in index.tag_values.iteritems())
+        index.cells = dict(((row, col), (start, end)) 
+                           for row, col, start, end in header["cells"])
+        return index
+
+    def tag_filter(self, tags):
+        """Turn {key: value} into {key: value number}. A value of None
+        only asks for the tag to be there."""
+        wanted = {}
+        for key, value in (tags or {}).iteritems():
+            if value is None:
+                wanted[key] = None
+            elif value in self.tag_numbers[key]:
+                wanted[key] = self.tag_numbers[key][value]
+            else:
+                # No node has this value
+                return False
+        return wanted
+
+    def matches(self, i, wanted):
+        for key, number in wanted.iteritems():
+            value = self.tags[key][i]
+            if value == 0 or (number is not None and value != number):
+                return False
+        return True
+
+    def iter_cells(self, minlat, minlon, maxlat, maxlon):
+        row0, col0 = self.cell(minlat, minlon)
+        row1, col1 = self.cell(maxlat, maxlon)
+        if (row1 - row0 + 1) * (col1 - col0 + 1) > len(self.cells):
+            # Cheaper to go through the cells there are
+            for (row, col), span in self.cells.iteritems():
+                if row0 <= row <= row1 and col0 <= col <= col1:
+                    yield span
+            return
+        for row in xrange(row0, row1 + 1):
+            for col in xrange(col0, col1 + 1):
+                span = self.cells.get((row, col))
+                if span is not None:
+                    yield span
+
+    def position(self, i):
+        return (float(self.lats[i]) / COORD_SCALE, 
+                float(self.lons[i]) / COORD_SCALE)
+
+    def bbox(self, minlat, minlon, maxlat, maxlon, tags=None):
+        """Ids of the nodes inside the box"""
+        wanted = self.tag_filter(tags)
+        if wanted is False:
+            return []
+        lat0, lat1 = minlat * COORD_SCALE, maxlat * COORD_SCALE
+        lon0, lon1 = minlon * COORD_SCALE, maxlon * COORD_SCALE
+        found = []
+        for start, end in self.iter_cells(minlat, minlon, maxlat, maxlon):
+            for i in xrange(start, end):
+                if (lat0 <= self.lats[i] <= lat1 and 
+                    lon0 <= self.lons[i] <= lon1 and
+                    self.matches(i, wanted)):
+                    found.append(self.ids[i])
+        return found
+
+    def radius_box(self, lat, lon, metres):
+        dlat = math.degrees(metres / EARTH_RADIUS)
+        coslat = max(math.cos(math.radians(lat)), 1e-6)
+        dlon = min(math.degrees(metres / (EARTH_RADIUS * coslat)), 180)
+        return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+    def radius(self, lat, lon, metres, tags=None):
+        """(distance, id) of the nodes within metres, nearest first"""
+        wanted = self.tag_filter(tags)
+        if wanted is False:
+            return []
+        found = []
+        for start, end in self.iter_cells(*self.radius_box(lat, lon, metres)):
+            for i in xrange(start, end):
+                if not self.matches(i, wanted):
+                    continue
+                distance = haversine((lat, lon), self.position(i))
+                if distance <= metres:
+                    found.append((distance, self.ids[i]))
+        found.sort()
+        return found
+
+    def nearest(self, lat, lon, k=1, tags=None):
+        """(distance, id) of the k nearest nodes, nearest first. The
+        search radius doubles until k nodes are found within it."""
+        metres = self.cell_size * math.pi / 180 * EARTH_RADIUS
+        # Half the earth's circumference covers everything
+        limit = math.pi * EARTH_RADIUS
+        while True:
+            found = self.radius(lat, lon, metres, tags)
+            if len(found) >= k or metres >= limit:
+                return found[:k]
+            metres *= 2
+
+def build_spatial_index(docs, index_fname=None, cell_size=SPATIAL_CELL_SIZE):
+    """Build a spatial index from a stream of shaped documents, and save
+    it if index_fname is given"""
+    index = SpatialIndex(cell_size)
+    for doc in docs:
+        index.add(doc)
+    index.build()
+    if index_fname:
+        index.save(index_fname)
+    return index
+
+def neighbourhood_report(index, minlat, minlon, maxlat, maxlon):
+    """Amenity counts and top shops of the report in query_data() for
+    the nodes inside a box"""
+    amenities = dict((amenity, len(index.bbox(minlat, minlon, maxlat, maxlon,
+                                              {"amenity": amenity})))
+                     for amenity in REPORT_AMENITIES)
+    shops = defaultdict(int)
+    shop_numbers = index.tags["shop"]
+    lat0, lat1 = minlat * COORD_SCALE, maxlat * COORD_SCALE
+    lon0, lon1 = minlon * COORD_SCALE, maxlon * COORD_SCALE
+    for start, end in index.iter_cells(minlat, minlon, maxlat, maxlon):
+        for i in xrange(start, end):
+            if (shop_numbers[i] and lat0 <= index.lats[i] <= lat1 and 
+                lon0 <= index.lons[i] <= lon1):
+                shops[index.tag_values["shop"][shop_numbers[i]]] += 1
+    return {"amenities": amenities, "shops": top_counts(shops)}
+
+def test_spatial_index(docs, index, queries=100, seed=0):
+    """Check queries against a scan of all documents, and print the
+    time per query"""
+    nodes = [doc for doc in docs if "pos" in doc]
+    rand = random.Random(seed)
+    times = defaultdict(float)
+    for q in range(queries):
+        lat, lon = rand.choice(nodes)["pos"]
+        metres = rand.choice((100, 500, 2000))
+        tags = rand.choice((None, {"amenity": None}, {"amenity": "cafe"}))
+        start = time.time()
+        found = index.radius(lat, lon, metres, tags)
+        times["radius"] += time.time() - start
+        expected = sorted(
+            (haversine((lat, lon), doc["pos"]), int(doc["id"])) 
+            for doc in nodes 
+            if (haversine((lat, lon), doc["pos"]) <= metres and
+                all(key in doc and (val is None or doc[key] == val)
+                    for key, val in (tags or {}).iteritems())))
+        assert [i for d, i in found] == [i for d, i in expected]
+
+        minlat, minlon, maxlat, maxlon = index.radius_box(lat, lon, metres)
+        start = time.time()
+        found = index.bbox(minlat, minlon, maxlat, maxlon, tags)
+        times["bbox"] += time.time() - start
+        expected = [int(doc["id"]) for doc in nodes 
+                    if (minlat <= doc["pos"][0] <= maxlat and 
+                        minlon <= doc["pos"][1] <= maxlon and
+                        all(key in doc and (val is None or doc[key] == val)
+                            for key, val in (tags or {}).iteritems()))]
+        assert sorted(found) == sorted(expected)
+
+        start = time.time()
+        found = index.nearest(lat, lon, 10, tags)
+        times["nearest"] += time.time() - start
+        assert len(found) == min(10, len([doc for doc in nodes if all(
+            key in doc and (val is None or doc[key] == val)
+            for key, val in (tags or {}).iteritems())]))
+    for query, elapsed in sorted(times.iteritems()):
+        print "{}: {:.2f} ms per query".format(query, 1000 * elapsed / queries)
+
+"""Memory regression test:
+
+Peak memory of the audits must not grow with the size of the input
+file. Synthetic files of each size are audited in a fresh process, and
+the peak resident set sizes are compared.
+"""
+def write_test_osm(fname, size):
+    node = (' <node id="{0}" visible="true" version="1" changeset="1" '
+            'timestamp="2013-08-03T16:43:42Z" user="user{1}" uid="{1}" '
+            'lat="22.5726" lon="88.3639">\n'
+            '  <tag k="addr:street" v="Park Street"/>\n'
+            '  <tag k="addr:city" v="Kolkata"/>\n'
+            '  <tag k="addr:postcode" v="700016"/>\n'
+            ' </node>\n')
+    with open(fname, "w") as ofile:
+        ofile.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        ofile.write('<osm>\n')
+        written = 0
+        i = 0
+        while written < size:
+            i += 1
+            elem = node.format(i, i % 100)
+            ofile.write(elem)
+            written += len(elem)
+        ofile.write('</osm>\n')
+
+def audit_peak_rss(fname, queue):
+    auditors = [TagAuditor(), KeyAuditor(), UserAuditor(), 
+                AddressAuditor(False)]
+    run_auditors(fname, auditors)
+    queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def test_streaming_memory(data_dir, sizes=(10 * MB, 1024 * MB)):
+    peaks = []
+    for size in sizes:
+        fname = os.path.join(data_dir, "memtest_{}.osm".format(size))
+        write_test_osm(fname, size)
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=audit_peak_rss, 
+                                       args=(fname, queue))
+        proc.start()
+        peaks.append(queue.get())
+        proc.join()
+        os.remove(fname)
+    print "Peak RSS (KB) for input sizes {}: {}".format(sizes, peaks)
+    # Allow some slack for allocator noise, but nothing that scales
+    # with the input
+    assert peaks[-1] < peaks[0] * 1.1 + 8 * 1024
+
+############################################################################
+# Synthetic osm files and per stage benchmarks
+############################################################################
+"""
+generate_osm() writes a synthetic osm file of any number of elements,
+from a few thousand to tens of millions, one element at a time. The
+mix of nodes and ways, the number of tags per element, the share of
+elements with an address, and the share of addresses with messy
+street and city values (abbreviated or misspelt street types, house
+numbers in the street name, odd city spellings, bad postcodes) can all
+be set. The same seed gives the same file.
+
+benchmark_stages() runs each stage of the pipeline over a file on its
+own, in a fresh process, and records its time, elements and MB per
+second, and peak memory. Each run is appended as a line of json to a
+results file, and compare_benchmarks() sets the last run against the
+one before it.
+"""
+SYNTHETIC_BBOX = (22.45, 88.25, 22.70, 88.50)
+SYNTHETIC_STREETS = ["Park", "Camac", "Elgin", "Hazra", "Rash Behari", 
+                     "Lenin", "Gariahat", "Shyamsundar", "Jadavpur"]
+SYNTHETIC_STREET_TYPES = ["Street", "Road", "Avenue", "Lane", "Sarani"]
+SYNTHETIC_MESSY_TYPES = ["st", "St.", "rd", "Rd.", "raod", "ave", "ln", 
+                         "pally", "sqr"]
+SYNTHETIC_CITIES = ["Kolkata"]
+SYNTHETIC_MESSY_CITIES = ["kolkata", "KOLKATA", "saltlake", "Salt Lake", 
+                          "salt lake sector 5", "Dum Dum Cantt", "bamangachi"]
+SYNTHETIC_TAGS = [("amenity", ["cafe", "restaurant", "school", "hospital", 
+                               "college", "bank"]),
+                  ("shop", ["bakery", "clothes", "mobile_phone", 
+                            "supermarket"]),
+                  ("name", ["Test place"]),
+                  ("cuisine", ["indian", "chinese", "bengali"]),
+                  ("name:bn", ["test"]),
+                  ("source", ["survey", "bing"])]
+SYNTHETIC_HIGHWAYS = ["residential", "primary", "secondary", "tertiary", 
+                      "service"]
+
+def synthetic_address(rand, messy_ratio):
+    messy = rand.random() < messy_ratio
+    street = rand.choice(SYNTHETIC_STREETS) + " " + rand.choice(
+        SYNTHETIC_MESSY_TYPES if messy else SYNTHETIC_STREET_TYPES)
+    if messy and rand.random() < 0.3:
+        street = "{}/{}, {}".format(rand.randint(1, 200), 
+                                    rand.randint(1, 9), street)
+    city = rand.choice(SYNTHETIC_MESSY_CITIES if messy else SYNTHETIC_CITIES)
+    if messy and rand.random() < 0.3:
+        postcode = rand.choice(["7000 {}".format(rand.randint(10, 99)), 
+                                str(rand.randint(70000, 70099))])
+    else:
+        postcode = str(rand.randint(700001, 700160))
+    return [("addr:street", street), ("addr:city", city), 
+            ("addr:postcode", postcode)]
+
+def synthetic_tags(rand, tags_per_element):
+    ntags = rand.randint(0, 2 * tags_per_element)
+    return [(key, rand.choice(values)) 
+            for key, values in rand.sample(SYNTHETIC_TAGS, 
+                                           min(ntags, len(SYNTHETIC_TAGS)))]
+
+def synthetic_element(tag, elem_id, rand, users, attrs, children):
+    # A few users make most of the edits
+    uid = min(int(rand.paretovariate(1.2)), len(users))
+    head = ' <{} id="{}" visible="true" version="{}" changeset="{}" ' \
+        'timestamp="2015-{:02d}-{:02d}T12:00:00Z" user="{}" uid="{}"{}'.format(
+            tag, elem_id, rand.randint(1, 9), rand.randint(1, 40000000), 
+            rand.randint(1, 12), rand.randint(1, 28), users[uid - 1], 
+            uid, attrs)
+    if not children:
+        return head + '/>\n'
+    return head + '>\n' + ''.join(children) + ' </{}>\n'.format(tag)
+
+def generate_osm(fname, elements=10000, way_ratio=0.1, tags_per_element=1,
+                 address_density=0.2, messy_ratio=0.3, nusers=1000, 
+                 seed=0):
+    """Write a synthetic osm file of about the given number of top level
+    elements, way_ratio of which are ways"""
+    rand = random.Random(seed)
+    users = ["user{}".format(i) for i in range(nusers)]
+    nways = int(elements * way_ratio)
+    nnodes = max(elements - nways, 2)
+    minlat, minlon, maxlat, maxlon = SYNTHETIC_BBOX
+    tag_xml = '  <tag k={} v={}/>\n'
+    with open(fname, 'wb', OUTPUT_BUFFER_SIZE) as ofile:
+        ofile.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        ofile.write('<osm version="0.6" generator="generate_osm">\n')
+        ofile.write(' <bounds minlat="{}" minlon="{}" maxlat="{}" '
+                    'maxlon="{}"/>\n'.format(*SYNTHETIC_BBOX))
+        for node_id in xrange(1, nnodes + 1):
+            tags = synthetic_tags(rand, tags_per_element)
+            if rand.random() < address_density:
+                tags += synthetic_address(rand, messy_ratio)
+            attrs = ' lat="{:.7f}" lon="{:.7f}"'.format(
+                rand.uniform(minlat, maxlat), rand.uniform(minlon, maxlon))
+            ofile.write(synthetic_element(
+                'node', node_id, rand, users, attrs,
+                [tag_xml.format(quoteattr(k), quoteattr(v)) 
+                 for k, v in tags]))
+        for way_id in xrange(1, nways + 1):
+            # Ways run through nodes with nearby ids
+            first = rand.randint(1, nnodes)
+            refs = [min(first + i, nnodes) 
+                    for i in range(rand.randint(2, 30))]
+            if rand.random() < 0.2:
+                refs.append(refs[0])
+            tags = [("highway", rand.choice(SYNTHETIC_HIGHWAYS))]
+            tags += synthetic_tags(rand, tags_per_element)
+            if rand.random() < address_density:
+                tags += synthetic_address(rand, messy_ratio)
+            children = ['  <nd ref="{}"/>\n'.format(ref) for ref in refs]
+            children += [tag_xml.format(quoteattr(k), quoteattr(v)) 
+                         for k, v in tags]
+            ofile.write(synthetic_element('way', way_id, rand, users, '', 
+                                          children))
+        ofile.write('</osm>\n')
+
+class ShapeAuditor(Auditor):
+    """shape_element() on its own, without writing the result"""
+    title = "Shaping elements"
+
+    def process(self, element):
+        if is_valid(element):
+            shape_element(element)
+
+class CountAuditor(Auditor):
+    """Count the top level elements, to time the parse on its own"""
+    title = "Counting elements"
+
+    def start(self, fname, part=None):
+        Auditor.start(self, fname, part)
+        self.count = 0
+
+    def process(self, element):
+        self.count += 1
+
+    def merge(self, other):
+        self.count += other.count
+
+BENCHMARK_STAGES = [
+    ("parse", CountAuditor),
+    ("count_tags", TagAuditor),
+    ("audit_keys", KeyAuditor),
+    ("audit_users", UserAuditor),
+    ("audit_clean_addresses", lambda: AddressAuditor(True)),
+    ("shape_element", ShapeAuditor),
+    ("shape_and_json_write", Reshaper),
+]
+
+def run_stage(fname, make_auditor, queue):
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        start = time.time()
+        cpu_start = time.clock()
+        run_auditors(fname, [make_auditor()])
+        elapsed = time.time() - start
+        cpu = time.clock() - cpu_start
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+    queue.put((elapsed, cpu, 
+               resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def benchmark_stages(fname, results_fname="benchmarks.json", 
+                     stages=BENCHMARK_STAGES):
+    """Time each stage over the file in a fresh process, print the
+    results and append them to results_fname"""
+    with open_osm(fname) as osm_file:
+        elements = sum(1 for elem in iter_file_elements(fname, osm_file))
+    size = os.path.getsize(fname)
+    run = {"file": os.path.basename(fname), "bytes": size, 
+           "elements": elements, "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+           "parser": XML_PARSER, "stages": {}}
+    print "\nBenchmarking {} ({:.1f} MB, {} elements)".format(
+        fname, float(size) / MB, elements)
+    print "=========================================================="
+    for name, make_auditor in stages:
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=run_stage, 
+                                       args=(fname, make_auditor, queue))
+        proc.start()
+        elapsed, cpu, peak_rss = queue.get()
+        proc.join()
+        run["stages"][name] = {
+            "seconds": elapsed,
+            "cpu_seconds": cpu,
+            "elements_per_sec": elements / elapsed,
+            "mb_per_sec": size / elapsed / MB,
+            "peak_rss_kb": peak_rss,
+        }
+        print "{:22s} {:8.2f} s {:10.0f} elements/s {:7.1f} MB/s {:8d} KB".format(
+            name, elapsed, elements / elapsed, size / elapsed / MB, peak_rss)
+    if results_fname:
+        with open(results_fname, 'ab') as results:
+            results.write(json.dumps(run) + "\n")
+    return run
+
+def compare_benchmarks(results_fname="benchmarks.json"):
+    """Print the speed of each stage in the last run relative to the run
+    before it"""
+    runs = list(iter_json_documents(results_fname))
+    if len(runs) < 2:
+        print "Nothing to compare yet"
+        return
+    before, after = runs[-2], runs[-1]
+    print "{} ({}) against {} ({})".format(after["time"], after["file"], 
+                                           before["time"], before["file"])
+    for name, stage in sorted(after["stages"].iteritems()):
+        if name in before["stages"]:
+            old = before["stages"][name]
+            print "{:22s} {:6.2f}x speed {:6.2f}x memory".format(
+                name, stage["elements_per_sec"] / old["elements_per_sec"],
+                float(stage["peak_rss_kb"]) / old["peak_rss_kb"])
+
+############################################################################
+# Bulk load the reshaped data into MongoDB
+############################################################################
+"""
+Inserting one document at a time costs a round trip to the server per
+element. The BulkLoader cuts the stream of documents into batches,
+limited both by number of documents and by their approximate size, and
+a few writer threads send the batches with unordered insert_many calls.
+The batch queue is bounded, so the stream is never read far ahead of
+the writers. A failed batch is retried a few times before the load
+gives up, with only the documents its write errors list, or all of
+them when the error has no details. Documents keep the _id they got
+on the first attempt, and duplicate keys on a retry are the documents
+that were written before the error. The indexes are built once all
+documents are in.
+
+MemoryCollection is an in-process stand-in for a collection, which
+lets the loader be tested and benchmarked without a running server.
+"""
+MAPS_INDEXES = ["osm_type", "amenity", "shop", "highway", "created.user"]
+
+class BulkLoader(object):
+    def __init__(self, collection, batch_size=1000, batch_bytes=8 * MB,
+                 writers=4, retries=3, indexes=MAPS_INDEXES, 
+                 ignore_duplicates=False):
+        self.collection = collection
+        # Documents with their own _id may have been inserted already
+        self.ignore_duplicates = ignore_duplicates
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.writers = writers
+        self.retries = retries
+        self.indexes = indexes
+        self.inserted = 0
+        self.batches = 0
+        self.retried = 0
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+        self.committed = None
+
+    def iter_batches(self, docs):
+        batch = []
+        batch_bytes = 0
+        for doc in docs:
+            # The json size is close enough to the bson size
+            doc_bytes = len(json.dumps(doc))
+            if batch and (len(batch) >= self.batch_size or 
+                          batch_bytes + doc_bytes > self.batch_bytes):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(doc)
+            batch_bytes += doc_bytes
+        if batch:
+            yield batch
+
+    def insert_batch(self, batch):
+        size = len(batch)
+        for attempt in range(self.retries + 1):
+            try:
+                self.collection.insert_many(batch, ordered=False)
+                break
+            except Exception as e:
+                # The documents of a partly inserted batch keep the _id
+                # they were given, so the ones already written come back
+                # as duplicate keys on a retry
+                duplicates_written = self.ignore_duplicates or attempt > 0
+                if duplicates_written and is_duplicate_error(e):
+                    break
+                if attempt == self.retries:
+                    raise
+                with self.lock:
+                    self.retried += 1
+                batch = failed_documents(batch, e, duplicates_written)
+                time.sleep(0.1 * 2 ** attempt)
+        with self.lock:
+            self.inserted += size
+            self.batches += 1
+
+    def batch_done(self, seq, size):
+        """Count the documents of all batches up to the first one that
+        is still being inserted as committed"""
+        with self.lock:
+            self.done[seq] = size
+            count = self.done_count
+            while self.done_seq in self.done:
+                count += self.done.pop(self.done_seq)
+                self.done_seq += 1
+            if count > self.done_count:
+                self.done_count = count
+                self.committed(count)
+
+    def writer(self, batches, errors):
+        while True:
+            item = batches.get()
+            if item is None:
+                break
+            if errors:
+                # Drain the queue, the load has failed already
+                continue
+            seq, batch = item
+            try:
+                self.insert_batch(batch)
+                if self.committed is not None:
+                    self.batch_done(seq, len(batch))
+            except Exception as e:
+                errors.append(e)
+
+    def load(self, docs, committed=None):
+        """Insert the documents, calling committed with the number of
+        documents inserted so far, in order"""
+        start = time.time()
+        self.committed = committed
+        self.done = {}
+        self.done_seq = 0
+        self.done_count = 0
+        batches = Queue.Queue(2 * self.writers)
+        errors = []
+        threads = [threading.Thread(target=self.writer, 
+                                    args=(batches, errors))
+                   for i in range(self.writers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for seq, batch in enumerate(self.iter_batches(docs)):
+                if errors:
+                    break
+                batches.put((seq, batch))
+        finally:
+            for thread in threads:
+                batches.put(None)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        for key in self.indexes:
+            self.collection.create_index(key)
+        self.elapsed = time.time() - start
+        return self.inserted
+
+    def report(self):
+        rate = self.inserted / self.elapsed if self.elapsed else 0
+        print ("Inserted {} documents in {} batches in {:.2f} s "
+               "({:.0f} docs/s, {} batches retried)").format(
+            self.inserted, self.batches, self.elapsed, rate, self.retried)
+
+def is_duplicate_error(e):
+    """Whether all the write errors of a bulk insert are duplicate keys"""
+    write_errors = (getattr(e, "details", None) or {}).get("writeErrors")
+    return bool(write_errors) and all(error.get("code") == 11000 
+                                      for error in write_errors)
+
+def failed_documents(batch, e, skip_duplicates):
+    """The documents of the batch to insert again after the error e: the
+    ones listed in its write errors, or all of them if it has none"""
+    write_errors = (getattr(e, "details", None) or {}).get("writeErrors")
+    if not write_errors:
+        return batch
+    return [batch[error["index"]] for error in write_errors
+            if not (skip_duplicates and error.get("code") == 11000)]
+
+class MemoryCollection(object):
+    """Collection stand-in keeping the documents in a list. Each
+    insert_many call can be made to take latency seconds, like a round
+    trip to a server."""
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.docs = []
+        self.indexes = []
+        self.lock = threading.Lock()
+
+    def insert_many(self, docs, ordered=True):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            for doc in docs:
+                doc.setdefault('_id', len(self.docs))
+                self.docs.append(doc)
+
+    def create_index(self, key):
+        self.indexes.append(key)
+
+    def count(self):
+        return len(self.docs)
+
+    def find_one(self):
+        return self.docs[0] if self.docs else None
+
+def benchmark_loader(json_fname, latency=0.001, batch_sizes=(1, 100, 1000),
+                     writers=(1, 4)):
+    """Load the reshaped json file into a MemoryCollection with each
+    batch size and number of writers, and print the docs/sec"""
+    for batch_size in batch_sizes:
+        for nwriters in writers:
+            loader = BulkLoader(MemoryCollection(latency), batch_size, 
+                                writers=nwriters)
+            loader.load(iter_json_documents(json_fname))
+            print "batch size {:5d}, {} writers:".format(batch_size, nwriters),
+            loader.report()
+
+# Insert maps data into database
+def with_element_ids(docs):
+    """Give the documents an _id of their own, so that loading them again
+    finds the ones already loaded"""
+    for doc in docs:
+        doc["_id"] = "{0}:{1}".format(doc["osm_type"], doc["id"])
+        yield doc
+
+def insert_maps(map_data, db, batch_size=1000, writers=4, committed=None):
+    print "\nInserting data into MongoDB"
+    print "=========================================================="
+    loader = BulkLoader(db.maps, batch_size, writers=writers,
+                        ignore_duplicates=committed is not None)
+    loader.load(map_data, committed)
+    loader.report()
+    print "First document inserted into the maps database with {} documents:".format(db.maps.count())
+    pprint.pprint(db.maps.find_one())
+
+############################################################################
+# Report on the maps data
+############################################################################
+"""
+The report counts the contributing users, the nodes and ways, a few
+kinds of amenities, and the most common shops and highways. On MongoDB
+all of it is computed by one $facet aggregation, so the collection is
+scanned once rather than once per number. MapStats computes the same
+report locally from the stream of shaped documents, with no database;
+the Reshaper keeps one up to date during the pass.
+
+Ties in the top lists are broken by name, so both ways of computing the
+report give the same result.
+"""
+REPORT_AMENITIES = ["cafe", "restaurant", "shop", "hospital", "school",
+                    "college", "university"]
+REPORT_TOP = 10
+
+def top_counts_pipeline(elem_type, key):
+    return [
+        {"$match" : {"osm_type" : elem_type,
+                     key : {"$exists" : 1}}},
+        {"$group" : {"_id" : "$" + key,
+                     "count" : {"$sum" : 1}}},
+        {"$sort" : {"count" : -1, "_id" : 1}},
+        {"$limit" : REPORT_TOP}
+    ]
+
+REPORT_PIPELINE = [
+    {"$facet" : {
+        "users" : [
+            {"$match" : {"created.user" : {"$exists" : 1}}},
+            {"$group" : {"_id" : "$created.user"}},
+            {"$count" : "count"}
+        ],
+        "types" : [
+            {"$match" : {"osm_type" : {"$in" : ["node", "way"]}}},
+            {"$group" : {"_id" : "$osm_type", "count" : {"$sum" : 1}}}
+        ],
+        "amenities" : [
+            {"$match" : {"amenity" : {"$in" : REPORT_AMENITIES}}},
+            {"$group" : {"_id" : "$amenity", "count" : {"$sum" : 1}}}
+        ],
+        "shops" : top_counts_pipeline("node", "shop"),
+        "highways" : top_counts_pipeline("way", "highway"),
+    }}
+]
+
+def ensure_indexes(collection, keys=MAPS_INDEXES):
+    for key in keys:
+        collection.create_index(key)
+
+def make_report(users, types, amenities, shops, highways):
+    return {
+        "users": users,
+        "nodes": types.get("node", 0),
+        "ways": types.get("way", 0),
+        "amenities": dict((amenity, amenities.get(amenity, 0)) 
+                          for amenity in REPORT_AMENITIES),
+        "shops": shops,
+        "highways": highways,
+    }
+
+def query_report(collection):
+    """Compute the report with a single aggregation"""
+    facets = list(collection.aggregate(REPORT_PIPELINE))[0]
+    counts = lambda facet: dict((group["_id"], group["count"]) 
+                                for group in facets[facet])
+    top = lambda facet: [(group["_id"], group["count"]) 
+                         for group in facets[facet]]
+    users = facets["users"][0]["count"] if facets["users"] else 0
+    return make_report(users, counts("types"), counts("amenities"), 
+                       top("shops"), top("highways"))
+
+def top_counts(counts):
+    return sorted(counts.iteritems(), 
+                  key=lambda (name, count): (-count, name))[:REPORT_TOP]
+
+class MapStats(object):
+    """Compute the report from shaped documents, without a database.
+    Documents are counted for each user, so that removing the documents
+    of a user also removes the user."""
+    def __init__(self):
+        self.users = defaultdict(int)
+        self.types = defaultdict(int)
+        self.amenities = defaultdict(int)
+        self.shops = defaultdict(int)
+        self.highways = defaultdict(int)
+
+    def count(self, doc, delta):
+        counts = []
+        created = doc.get("created")
+        if created and "user" in created:
+            counts.append((self.users, created["user"]))
+        elem_type = doc.get("osm_type")
+        counts.append((self.types, elem_type))
+        if doc.get("amenity") in REPORT_AMENITIES:
+            counts.append((self.amenities, doc["amenity"]))
+        if elem_type == "node" and "shop" in doc:
+            counts.append((self.shops, doc["shop"]))
+        if elem_type == "way" and "highway" in doc:
+            counts.append((self.highways, doc["highway"]))
+        for counter, name in counts:
+            counter[name] += delta
+            if not counter[name]:
+                del counter[name]
+
+    def add(self, doc):
+        self.count(doc, 1)
+
+    def remove(self, doc):
+        self.count(doc, -1)
+
+    def merge(self, other):
+        for mine, others in ((self.users, other.users),
+                             (self.types, other.types), 
+                             (self.amenities, other.amenities),
+                             (self.shops, other.shops),
+                             (self.highways, other.highways)):
+            for name, count in others.iteritems():
+                mine[name] += count
+
+    def report(self):
+        return make_report(len(self.users), self.types, self.amenities, 
+                           top_counts(self.shops), top_counts(self.highways))
+
+def check_report(report, expected):
+    """Warn about the parts of the database report that differ from the
+    report computed from the shaped documents, as when the database
+    already held other data"""
+    differ = [key for key in sorted(expected) 
+              if report.get(key) != expected[key]]
+    for key in differ:
+        print >> sys.stderr, "Warning: the database reports {} {}, the shaped data {}".format(
+            key, report.get(key), expected[key])
+    return not differ
+
+def print_report(report):
+    print "There are {} of unique contrbuting users in Kolkata, India.".format(report["users"])
+    print "There are {} nodes and {} ways in Kolkata, India ".format(report["nodes"], report["ways"])
+    print "Amenities:"
+    for amenity in REPORT_AMENITIES:
+        print "    {}: {}".format(amenity, report["amenities"][amenity])
+    print "Top 10 businesses:"
+    pprint.pprint(report["shops"])
+    print "Number and types of highways"
+    pprint.pprint(report["highways"])
+
+# Perform some queries in the maps database
+def query_data(db):
+    print "\nPerform queries on MongoDB"
+    print "=========================================================="
+    ensure_indexes(db.maps)
+    report = query_report(db.maps)
+    print_report(report)
+    return report
+
+############################################################################
+# Storage backends
+############################################################################
+"""
+The reshaped data can be loaded into MongoDB or into an embedded SQLite
+database, which needs no server and suits local and test runs. Both
+backends load a stream of shaped documents, compute the query_data()
+report and drop the data again; get_storage() picks one by name.
+
+The SQLite schema is normalized: one row per element with its created
+attributes and position, and separate tables for the other tags, the
+address fields and the node refs of ways. Rows are inserted with
+executemany in batches, inside large transactions, with the journal in
+WAL mode. Indexes are created after the load.
+"""
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS elements (
+    id INTEGER NOT NULL, type TEXT NOT NULL, visible TEXT,
+    version TEXT, changeset TEXT, timestamp TEXT, user TEXT, uid TEXT,
+    lat REAL, lon REAL, PRIMARY KEY (type, id));
+CREATE TABLE IF NOT EXISTS tags (
+    id INTEGER NOT NULL, type TEXT NOT NULL, key TEXT NOT NULL, value TEXT);
+CREATE TABLE IF NOT EXISTS addresses (
+    id INTEGER NOT NULL, type TEXT NOT NULL, key TEXT NOT NULL, value TEXT);
+CREATE TABLE IF NOT EXISTS way_nodes (
+    way_id INTEGER NOT NULL, seq INTEGER NOT NULL, node_id INTEGER NOT NULL);
+"""
+SQLITE_INDEXES = """
+CREATE INDEX IF NOT EXISTS elements_user ON elements (user);
+CREATE INDEX IF NOT EXISTS tags_key_value ON tags (key, value, type);
+CREATE INDEX IF NOT EXISTS tags_id ON tags (type, id);
+CREATE INDEX IF NOT EXISTS addresses_id ON addresses (type, id);
+CREATE INDEX IF NOT EXISTS way_nodes_way ON way_nodes (way_id, seq);
+CREATE INDEX IF NOT EXISTS way_nodes_node ON way_nodes (node_id);
+"""
+# Top level fields of a shaped document that are not tags
+ELEMENT_FIELDS = frozenset(["id", "type", "osm_type", "visible", 
+                            "created", "pos", "address", "node_refs", 
+                            "bbox", "centroid", "length", "_id"])
+
+class MongoStorage(object):
+    def __init__(self, db):
+        self.db = db
+
+    def load(self, docs, committed=None):
+        if committed is not None:
+            docs = with_element_ids(docs)
+        insert_maps(docs, self.db, committed=committed)
+
+    def query(self):
+        return query_data(self.db)
+
+    def find_elements(self, keys):
+        """The stored documents of the (type, id) keys"""
+        ids = defaultdict(list)
+        for elem_type, elem_id in keys:
+            ids[elem_type].append(elem_id)
+        docs = []
+        for elem_type, elem_ids in ids.iteritems():
+            docs.extend(self.db.maps.find({"osm_type": elem_type, 
+                                           "id": {"$in": elem_ids}}))
+        return docs
+
+    def apply_changes(self, upserts, deletes):
+        """Replace or insert the upserted documents and delete the
+        (type, id) keys, in one bulk write"""
+        from pymongo import ReplaceOne, DeleteOne
+        self.db.maps.create_index([("osm_type", 1), ("id", 1)])
+        requests = [ReplaceOne({"osm_type": doc["osm_type"], 
+                                "id": doc["id"]}, doc, upsert=True) 
+                    for doc in upserts]
+        requests += [DeleteOne({"osm_type": elem_type, "id": elem_id}) 
+                     for elem_type, elem_id in deletes]
+        if requests:
+            self.db.maps.bulk_write(requests, ordered=False)
+
+    def drop(self):
+        self.db.maps.drop()
+
+class SQLiteStorage(object):
+    def __init__(self, db_fname, batch_size=10000, transaction_size=200000):
+        import sqlite3
+        self.db_fname = db_fname
+        self.batch_size = batch_size
+        self.transaction_size = transaction_size
+        self.conn = sqlite3.connect(db_fname)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+
+    def element_rows(self, doc, rows):
+        elem_id = int(doc["id"])
+        elem_type = doc["osm_type"]
+        created = doc.get("created", {})
+        pos = doc.get("pos") or (None, None)
+        rows["elements"].append((elem_id, elem_type, doc.get("visible"),
+                                 created.get("version"), 
+                                 created.get("changeset"),
+                                 created.get("timestamp"), 
+                                 created.get("user"), created.get("uid"),
+                                 pos[0], pos[1]))
+        for key, value in doc.iteritems():
+            if key not in ELEMENT_FIELDS:
+                rows["tags"].append((elem_id, elem_type, key, value))
+        if doc["type"] != elem_type:
+            # A "type" tag
+            rows["tags"].append((elem_id, elem_type, "type", doc["type"]))
+        for key, value in doc.get("address", {}).iteritems():
+            rows["addresses"].append((elem_id, elem_type, key, value))
+        for seq, ref in enumerate(doc.get("node_refs", ())):
+            rows["way_nodes"].append((elem_id, seq, int(ref)))
+
+    def insert_rows(self, rows):
+        for table, table_rows in rows.iteritems():
+            if table_rows:
+                marks = ",".join("?" * len(table_rows[0]))
+                self.conn.executemany(
+                    "INSERT INTO {} VALUES ({})".format(table, marks), 
+                    table_rows)
+                del table_rows[:]
+
+    def load(self, docs, committed=None):
+        """Insert the documents, calling committed with the number of
+        documents committed after each transaction"""
+        print "\nInserting data into SQLite"
+        print "=========================================================="
+        start = time.time()
+        rows = dict((table, []) for table in 
+                    ("elements", "tags", "addresses", "way_nodes"))
+        count = 0
+        for doc in docs:
+            self.element_rows(doc, rows)
+            count += 1
+            if count % self.batch_size == 0:
+                self.insert_rows(rows)
+            if count % self.transaction_size == 0:
+                # Rows still held in the batch are part of the transaction
+                self.insert_rows(rows)
+                self.conn.commit()
+                if committed is not None:
+                    committed(count)
+        self.insert_rows(rows)
+        self.conn.commit()
+        self.conn.executescript(SQLITE_INDEXES)
+        elapsed = time.time() - start
+        print "Inserted {} documents in {:.2f} s ({:.0f} docs/s)".format(
+            count, elapsed, count / elapsed if elapsed else 0)
+        return count
+
+    def query_report(self):
+        execute = self.conn.execute
+        users = execute("SELECT COUNT(DISTINCT user) FROM elements "
+                        "WHERE user IS NOT NULL").fetchone()[0]
+        types = dict(execute("SELECT type, COUNT(*) FROM elements "
+                             "WHERE type IN ('node', 'way') GROUP BY type"))
+        amenities = dict(execute(
+            "SELECT value, COUNT(*) FROM tags WHERE key = 'amenity' AND "
+            "value IN ({}) GROUP BY value".format(
+                ",".join("?" * len(REPORT_AMENITIES))), REPORT_AMENITIES))
+        top = ("SELECT value, COUNT(*) AS count FROM tags "
+               "WHERE key = ? AND type = ? GROUP BY value "
+               "ORDER BY count DESC, value LIMIT ?")
+        shops = execute(top, ("shop", "node", REPORT_TOP)).fetchall()
+        highways = execute(top, ("highway", "way", REPORT_TOP)).fetchall()
+        return make_report(users, types, amenities, shops, highways)
+
+    def find_elements(self, keys):
+        """The stored documents of the (type, id) keys, rebuilt from the
+        elements and their tags; addresses and node refs are left out"""
+        docs = []
+        for elem_type, elem_id in keys:
+            row = self.conn.execute(
+                "SELECT user FROM elements WHERE type = ? AND id = ?", 
+                (elem_type, int(elem_id))).fetchone()
+            if row is None:
+                continue
+            doc = {"type": elem_type, "osm_type": elem_type, "id": elem_id}
+            if row[0] is not None:
+                doc["created"] = {"user": row[0]}
+            doc.update(self.conn.execute(
+                "SELECT key, value FROM tags WHERE type = ? AND id = ?",
+                (elem_type, int(elem_id))))
+            docs.append(doc)
+        return docs
+
+    def apply_changes(self, upserts, deletes):
+        """Replace or insert the upserted documents and delete the
+        (type, id) keys, in one transaction"""
+        keys = [(doc["osm_type"], int(doc["id"])) for doc in upserts]
+        keys += [(elem_type, int(elem_id)) for elem_type, elem_id in deletes]
+        for table in ("elements", "tags", "addresses"):
+            self.conn.executemany(
+                "DELETE FROM {} WHERE type = ? AND id = ?".format(table), keys)
+        self.conn.executemany("DELETE FROM way_nodes WHERE way_id = ?", 
+                              [(elem_id,) for elem_type, elem_id in keys
+                               if elem_type == "way"])
+        rows = dict((table, []) for table in 
+                    ("elements", "tags", "addresses", "way_nodes"))
+        for doc in upserts:
+            self.element_rows(doc, rows)
+        self.insert_rows(rows)
+        self.conn.commit()
+
+    def query(self):
+        print "\nPerform queries on SQLite"
+        print "=========================================================="
+        report = self.query_report()
+        print_report(report)
+        return report
+
+    def drop(self):
+        self.conn.close()
+        for ext in ("", "-wal", "-shm"):
+            if os.path.exists(self.db_fname + ext):
+                os.remove(self.db_fname + ext)
+
+def get_storage(kind, db_name):
+    if kind == "mongodb":
+        return MongoStorage(get_mongodb(db_name))
+    elif kind == "sqlite":
+        return SQLiteStorage(db_name + ".sqlite")
+    raise ValueError("Unknown storage backend: {}".format(kind))
+
+############################################################################
+# Apply osm change files
+############################################################################
+"""
+A daily diff of the extract comes as an osmChange file (.osc, or
+.osc.gz): <create>, <modify> and <delete> blocks of nodes, ways and
+relations, created and modified elements in full, deleted ones only
+by their id. apply_changes() streams the file and applies it to the
+loaded data, instead of reshaping the whole new extract and loading it
+again.
+
+Created and modified elements go through the auditors of the loaded
+data, cleaning their addresses, and are shaped by shape_element(),
+like in a full run. The audits of the change set are merged into those
+auditors with merge(), so counts and sets grow with the created and
+modified elements. The old versions of modified and deleted elements
+are not taken out of them, since only the shaped documents are
+stored.
+
+The ChangeApplier collects the shaped documents in batches of
+CHANGE_BATCH_SIZE, keyed on their element type and id, so that the
+last change of an element within a batch wins, and hands each batch to
+the storage as upserts and deletes. The storage finds the documents by
+the same key, their osm_type and id, since a "type" tag overwrites the
+"type" of a document. An element that is no longer valid is deleted.
+Before a batch is written, the stored documents it replaces are looked
+up and removed from the MapStats of the loaded data, and the new
+documents are added, so the report counters follow the changes without
+a pass over the data.
+Ways get no geometry, since the node index is built from the extract.
+"""
+CHANGE_BATCH_SIZE = 1000
+CHANGE_ACTIONS = ("create", "modify", "delete")
+
+def iter_change_elements(osc_file):
+    """Yield the action and each element of an osmChange file, freeing
+    the elements like iter_elements() does"""
+    context = ET.iterparse(osc_file, events=('start', 'end'))
+    _, root = next(context)
+    depth = 1
+    block = None
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                block = elem
+            continue
+        depth -= 1
+        if depth == 2:
+            if block.tag in CHANGE_ACTIONS:
+                yield block.tag, elem
+            elem.clear()
+            del block[:]
+        elif depth == 1:
+            del root[:]
+
+class ChangeApplier(object):
+    def __init__(self, storage, stats=None, batch_size=CHANGE_BATCH_SIZE):
+        self.storage = storage
+        # MapStats of the loaded data, kept up to date
+        self.stats = stats
+        self.batch_size = batch_size
+        self.pending = OrderedDict()
+        self.counts = defaultdict(int)
+        self.batches = 0
+
+    def process(self, action, element):
+        if element.tag not in ("node", "way"):
+            return
+        doc = None
+        if action != "delete" and is_valid(element):
+            doc = shape_element(element)
+        self.pending[(element.tag, element.attrib['id'])] = doc
+        self.counts[(action, element.tag)] += 1
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.stats is not None:
+            for doc in self.storage.find_elements(self.pending.keys()):
+                self.stats.remove(doc)
+            for doc in self.pending.itervalues():
+                if doc is not None:
+                    self.stats.add(doc)
+        self.storage.apply_changes(
+            [doc for doc in self.pending.itervalues() if doc is not None],
+            [key for key, doc in self.pending.iteritems() if doc is None])
+        self.pending.clear()
+        self.batches += 1
+
+    def report(self):
+        print "\nApplied changes in {} batches".format(self.batches)
+        print "=========================================================="
+        for action in CHANGE_ACTIONS:
+            print "{}: {} nodes, {} ways".format(
+                action, self.counts[(action, "node")], 
+                self.counts[(action, "way")])
+
+def apply_changes(fname, db, stats=None, auditors=(), 
+                  batch_size=CHANGE_BATCH_SIZE):
+    """Apply the osmChange file to the documents loaded into db, and
+    to stats, the MapStats of those documents. The audits of the created
+    and modified elements are merged into auditors, the finished
+    auditors of the loaded data."""
+    # Fresh auditors of the same kind for the change set
+    change_auditors = [copy.copy(auditor) for auditor in auditors]
+    if not any(isinstance(auditor, AddressAuditor) and auditor.cleanup
+               for auditor in auditors):
+        change_auditors.insert(0, AddressAuditor(True))
+    for auditor in change_auditors:
+        auditor.start(fname)
+    applier = ChangeApplier(db, stats, batch_size)
+    with open_osm(fname) as osc_file:
+        for action, element in iter_change_elements(osc_file):
+            if action != "delete":
+                for auditor in change_auditors:
+                    auditor.process(element)
+            applier.process(action, element)
+    applier.flush()
+    for auditor in change_auditors:
+        auditor.finish()
+    for auditor, change_auditor in zip(auditors, 
+                                       change_auditors[-len(auditors):]):
+        auditor.merge(change_auditor)
+    applier.report()
+    return applier
+
+CHANGE_TEST_WAY = """  <way id="10" version="{}" user="u" uid="1">
+   <nd ref="1"/>
+   <nd ref="2"/>
+   <tag k="highway" v="primary"/>{}
+  </way>
+"""
+
+def test_apply_changes(data_dir):
+    """A way with a type tag is replaced when modified, and removed when
+    deleted, in the storage and in the MapStats"""
+    def write_change(fname, action, way):
+        with open(fname, 'wb') as osc_file:
+            osc_file.write('<osmChange version="0.6">\n <{0}>\n{1}'
+                           ' </{0}>\n</osmChange>\n'.format(action, way))
+    osm_fname = os.path.join(data_dir, "changetest.osm")
+    osc_fname = os.path.join(data_dir, "changetest.osc")
+    with open(osm_fname, 'wb') as osm_file:
+        osm_file.write('<osm>\n' + CHANGE_TEST_WAY.format(
+            1, '\n   <tag k="type" v="multipolygon"/>') + '</osm>\n')
+    with open_osm(osm_fname) as osm_file:
+        docs = [shape_element(elem) 
+                for elem in iter_file_elements(osm_fname, osm_file)
+                if elem.tag == "way"]
+    assert docs[0]["type"] == "multipolygon"
+    storage = SQLiteStorage(os.path.join(data_dir, "changetest.sqlite"))
+    stats = MapStats()
+    storage.load(docs)
+    for doc in docs:
+        stats.add(doc)
+    try:
+        write_change(osc_fname, "modify", CHANGE_TEST_WAY.format(2, ''))
+        apply_changes(osc_fname, storage, stats)
+        stored = storage.find_elements([("way", "10")])
+        assert len(stored) == 1 and stored[0]["type"] == "way"
+        assert stats.report() == storage.query_report()
+        write_change(osc_fname, "delete", CHANGE_TEST_WAY.format(3, ''))
+        apply_changes(osc_fname, storage, stats)
+        assert storage.find_elements([("way", "10")]) == []
+        assert stats.report() == storage.query_report()
+        assert stats.report()["ways"] == 0
+    finally:
+        storage.drop()
+        os.remove(osm_fname)
+        os.remove(osc_fname)
+
+def wrangle_maps(fname, processes=1, geometry=False, storage="mongodb",
+                 profile=None, output_format="json", compression=None,
+                 approximate=False, pipeline=False, cache_dir=None, 
+                 changes=(), shards=False, db_name='maps'):
+    # Time each stage of the run, and profile the auditor titled profile
+    monitor = RunMonitor(profile)
+    # Reuse the results of earlier runs over the same file and rules, and
+    # resume interrupted ones
+    cache = ResultCache(cache_dir) if cache_dir else None
+
+    # Ways can only be given a geometry once all nodes are indexed. A
+    # serial pass indexes the nodes before it comes to the ways, but the
+    # parts of a parallel or pipelined pass need a pass of their own
+    node_index = None
+    serial = (processes == 1 or is_compressed(fname)) and not pipeline
+    index_nodes = geometry and serial
+    if geometry and not serial:
+        node_index = build_node_index(fname, processes, monitor, cache)
+
+    # Audit some data elements, clean up addresses, and reshape and
+    # write data into a json or bson file, all in a single pass over the
+    # file
+    if shards:
+        # Shards by element type and tile, for parallel and regional loads
+        reshaper = ShardedReshaper(node_index, output_format, compression,
+                                   index_nodes=index_nodes)
+    else:
+        reshaper = Reshaper(False, node_index, output_format, compression,
+                            index_nodes=index_nodes)
+    if approximate:
+        # Bounded memory sketches for very large extracts
+        auditors = [TagAuditor(), SketchKeyAuditor(), SketchUserAuditor(),
+                    SketchAddressAuditor(False), SketchAddressAuditor(True)]
+    else:
+        auditors = [TagAuditor(), KeyAuditor(), UserAuditor(), 
+                    AddressAuditor(False), AddressAuditor(True)]
+    auditors += [reshaper, RuleCacheAuditor()]
+    db = get_storage(storage, db_name)
+    loaded = False
+    if cache is None:
+        missing = auditors
+    else:
+        auditors, missing = cache.lookup(fname, auditors)
+        reshaper = [auditor for auditor in auditors 
+                    if isinstance(auditor, Reshaper)][0]
+    if pipeline and reshaper in missing:
+        # Load the shaped documents into the database during the pass
+        run_pipeline(fname, missing, db, processes, monitor)
+        loaded = True
+    elif cache is not None and missing:
+        run_auditors_resumable(fname, missing, 
+                               cache.checkpoint_fname(fname, missing),
+                               processes, monitor)
+    elif missing:
+        run_auditors(fname, missing, processes, monitor)
+    if cache is not None:
+        cache.store(fname, missing)
+
+    # Stream the reshaped data from the output file into the database
+    if not loaded:
+        with monitor.stage("load into " + storage, reshaper.count):
+            if (shards and storage == "mongodb" and cache is None and 
+                processes > 1):
+                import_shards(reshaper.file_out, db_name, processes)
+            elif cache is None:
+                db.load(iter_output_documents(reshaper.file_out))
+            else:
+                load_resumable(db, reshaper.file_out, cache.checkpoint_fname(
+                    fname, [reshaper], "load"))
+
+    # Bring the loaded data up to date with the diffs of the extract
+    for change_fname in changes:
+        with monitor.stage("apply " + os.path.basename(change_fname)):
+            apply_changes(change_fname, db, reshaper.stats, 
+                          [auditor for auditor in auditors 
+                           if not isinstance(auditor, Reshaper)])
+    for auditor in auditors:
+        auditor.report()
+    pprint.pprint(reshaper.first)
+
+    # Perform some queries in the maps database, and check them against
+    # the report computed during the reshape
+    with monitor.stage("query " + storage):
+        report = db.query()
+    check_report(report, reshaper.stats.report())
+
+    # Clean up data
+    db.drop()
+
+    monitor.report()
+    monitor.save("{0}.run.json".format(osm_basename(fname)))
+    return monitor
+
+############################################################################
+# Wrangle many regions in a batch
+############################################################################
+"""
+A Region is an extract with cleaning rules of its own: street and city
+mappings, expected street types and the postcode pattern and length.
+run_regions() wrangles a list of regions on one pool of processes. Each
+region runs in a fresh worker process with its CleaningRules installed
+as the cleaning_rules of the process, and in a directory of its own,
+<out_dir>/<name>. Its output file or shards, node index, run.json and
+<basename>.report.txt, which gets the output of its audits and
+queries, are all written there, so that regions whose extracts have
+the same name do not overwrite each other. The regions also get a
+database of their own, maps_<name>, and their names must be unique.
+
+Regions are started largest file first. A region is only started while
+the memory estimates of the running regions and of itself fit within
+memory_cap, and smaller regions may overtake a large one that does not
+fit yet; a region larger than the cap runs once nothing else is
+running. The estimate of a region is the peak rss recorded in the
+run.json of its last run, or REGION_MEMORY_RATIO times its file size
+and at least REGION_MIN_MEMORY on a first run.
+
+A region runs serially within its worker, since pool workers can not
+have worker processes of their own, so the pipeline is not used. The
+parallelism is across regions. A failed region does not stop the
+batch: its traceback goes to its report, and run_regions() raises
+once the summary of the batch is written. The summary, printed and
+saved as regions.run.json, has the time, elements, bytes and peak rss
+of each region and the throughput of the whole batch.
+"""
+REGION_MEMORY_RATIO = 0.5
+REGION_MIN_MEMORY = 256 * MB
+# Share of the physical memory the regions of a batch may use
+REGION_MEMORY_SHARE = 0.75
+REGION_POLL_INTERVAL = 0.5
+REGIONS_SUMMARY = "regions.run.json"
+REGIONS_DIR = "regions"
+
+def physical_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+class Region(object):
+    """An extract to wrangle in a batch, with its own cleaning rules"""
+    def __init__(self, name, fname, street_mapping=street_mapping, 
+                 city_mapping=city_mapping, 
+                 street_types=expected_street_types,
+                 postcode_pattern=postcode_re.pattern, 
+                 postcode_length=POSTCODE_LENGTH):
+        self.name = name
+        self.fname = fname
+        self.street_mapping = street_mapping
+        self.city_mapping = city_mapping
+        self.street_types = street_types
+        self.postcode_pattern = postcode_pattern
+        self.postcode_length = postcode_length
+
+    def rules(self):
+        return CleaningRules(self.street_mapping, self.city_mapping, 
+                             street_types=self.street_types,
+                             postcode_pattern=self.postcode_pattern,
+                             postcode_length=self.postcode_length)
+
+    def size(self):
+        return os.path.getsize(self.fname)
+
+    def directory(self, out_dir=REGIONS_DIR):
+        """Directory the outputs and reports of the region go to"""
+        return os.path.join(out_dir, self.name)
+
+    def memory_estimate(self, out_dir=REGIONS_DIR):
+        """Bytes of memory the region is expected to use"""
+        run_fname = os.path.join(self.directory(out_dir), "{0}.run.json".format(
+            osm_basename(self.fname)))
+        if os.path.exists(run_fname):
+            with open(run_fname) as run_file:
+                return json.load(run_file)["peak_rss_kb"] * 1024
+        return max(REGION_MIN_MEMORY, int(REGION_MEMORY_RATIO * self.size()))
+
+def wrangle_region(task):
+    """Wrangle a region in a worker process of the batch"""
+    global cleaning_rules
+    region, file_bytes, out_dir, options = task
+    cleaning_rules = region.rules()
+    fname = os.path.abspath(region.fname)
+    # The worker process only runs this region, and everything it
+    # writes goes to the directory of the region
+    region_dir = region.directory(out_dir)
+    if not os.path.isdir(region_dir):
+        os.makedirs(region_dir)
+    os.chdir(region_dir)
+    report_fname = "{0}.report.txt".format(osm_basename(fname))
+    summary = {"region": region.name, "file": region.fname, 
+               "file_bytes": file_bytes, 
+               "report": os.path.join(region_dir, report_fname)}
+    start = time.time()
+    stdout = sys.stdout
+    with open(report_fname, "w") as report_file:
+        sys.stdout = report_file
+        try:
+            monitor = wrangle_maps(fname, 1, 
+                                   db_name="maps_" + region.name, **options)
+            for stage in monitor.stages:
+                if "pass over " in stage["stage"]:
+                    summary["elements"] = stage.get("elements", 0)
+                    summary["bytes"] = stage.get("bytes", summary["file_bytes"])
+        except Exception as e:
+            traceback.print_exc(file=report_file)
+            summary["error"] = "{0}: {1}".format(type(e).__name__, e)
+        finally:
+            sys.stdout = stdout
+    summary["seconds"] = time.time() - start
+    summary["peak_rss_kb"] = peak_rss()
+    return summary
+
+def report_regions(summaries, seconds):
+    """Print the regions of a batch and its throughput, and return the
+    totals"""
+    print "\nRegions"
+    print "=========================================================="
+    for summary in summaries:
+        if "error" in summary:
+            print "{0:20} failed: {1}".format(summary["region"][:20], 
+                                              summary["error"])
+            continue
+        print "{0:20} {1:9.2f}s {2:10.0f} elements/s {3:7.1f} MB/s {4:9} KB".format(
+            summary["region"][:20], summary["seconds"],
+            summary.get("elements", 0) / summary["seconds"],
+            float(summary.get("bytes", 0)) / MB / summary["seconds"],
+            summary["peak_rss_kb"])
+    done = [summary for summary in summaries if "error" not in summary]
+    totals = {"regions": len(summaries), "failed": len(summaries) - len(done),
+              "seconds": seconds,
+              "region_seconds": sum(summary["seconds"] for summary in done),
+              "elements": sum(summary.get("elements", 0) for summary in done),
+              "bytes": sum(summary.get("bytes", 0) for summary in done)}
+    if seconds:
+        totals["elements_per_sec"] = totals["elements"] / seconds
+        totals["mb_per_sec"] = float(totals["bytes"]) / MB / seconds
+        # How many regions were busy on average
+        totals["concurrency"] = totals["region_seconds"] / seconds
+    print "{0} regions ({1} failed) in {2:.2f}s: {3:.0f} elements/s, {4:.1f} MB/s, concurrency {5:.2f}".format(
+        totals["regions"], totals["failed"], seconds, 
+        totals.get("elements_per_sec", 0), totals.get("mb_per_sec", 0),
+        totals.get("concurrency", 0))
+    return totals
+
+def run_regions(regions, processes=None, memory_cap=None, storage="sqlite",
+                geometry=False, output_format="json", compression=None,
+                approximate=False, shards=False, cache_dir=None,
+                out_dir=REGIONS_DIR, summary_fname=REGIONS_SUMMARY):
+    """Wrangle the regions on a pool of processes, largest first, within
+    memory_cap bytes of estimated memory"""
+    names = [region.name for region in regions]
+    if len(set(names)) != len(names):
+        raise ValueError("Region names must be unique: {}".format(names))
+    # Workers run in the directories of their regions
+    out_dir = os.path.abspath(out_dir)
+    if cache_dir:
+        cache_dir = os.path.abspath(cache_dir)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if memory_cap is None:
+        memory_cap = int(REGION_MEMORY_SHARE * physical_memory())
+    options = {"storage": storage, "geometry": geometry, 
+               "output_format": output_format, "compression": compression,
+               "approximate": approximate, "shards": shards, 
+               "cache_dir": cache_dir}
+    start = time.time()
+    sizes = {}
+    estimates = {}
+    summaries = []
+    for region in regions:
+        try:
+            sizes[region.name] = region.size()
+            estimates[region.name] = region.memory_estimate(out_dir)
+        except (EnvironmentError, ValueError, KeyError) as e:
+            # A missing or unreadable extract only fails its own region
+            summaries.append({"region": region.name, "file": region.fname,
+                              "file_bytes": 0, "seconds": 0.0, 
+                              "peak_rss_kb": 0, 
+                              "error": "{0}: {1}".format(type(e).__name__, 
+                                                         e)})
+    pending = sorted([region for region in regions if region.name in sizes],
+                     key=lambda region: -sizes[region.name])
+    running = []
+    # A fresh process for each region, so that the memory and the
+    # cleaning rules of a region do not stay behind for the next one
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    try:
+        while pending or running:
+            used = sum(estimates[region.name] for region, result in running)
+            for region in list(pending):
+                if len(running) >= processes:
+                    break
+                if running and used + estimates[region.name] > memory_cap:
+                    continue
+                pending.remove(region)
+                used += estimates[region.name]
+                print "Starting {0} ({1} bytes, {2} MB estimated)".format(
+                    region.name, sizes[region.name], 
+                    estimates[region.name] // MB)
+                running.append((region, pool.apply_async(
+                    wrangle_region, ((region, sizes[region.name], out_dir,
+                                      options),))))
+            time.sleep(REGION_POLL_INTERVAL)
+            for entry in list(running):
+                region, result = entry
+                if result.ready():
+                    summaries.append(result.get())
+                    running.remove(entry)
+    finally:
+        pool.terminate()
+    summaries.sort(key=lambda summary: -summary["file_bytes"])
+    totals = report_regions(summaries, time.time() - start)
+    with open(summary_fname, "w") as summary_file:
+        json.dump({"time": time.strftime('%Y-%m-%dT%H:%M:%S', 
+                                         time.localtime(start)),
+                   "processes": processes, "memory_cap": memory_cap,
+                   "totals": totals, "regions": summaries}, 
+                  summary_file, indent=2)
+    failed = [summary["region"] for summary in summaries 
+              if "error" in summary]
+    if failed:
+        raise RuntimeError("Regions failed: {}".format(", ".join(failed)))
+    return summaries
 
 DATADIR = "../../../datasets/"
 EXAMPLE_OSMFILE =  "example.osm"
 CHICAGO_OSMFILE = "chicago.osm"
-#KOLKATA_OSMFILE =  "kolkata_india.osm.bz2"
-KOLKATA_OSMFILE =  "kolkata_india.osm"
+KOLKATA_OSMFILE =  "kolkata_india.osm.bz2"
+#KOLKATA_OSMFILE =  "kolkata_india.osm"
 SAMPLE_OSMFILE = "sample.osm"
 
 USE_SAMPLE_DATA = True
+# Wrangle all of REGIONS in a batch instead of a single file
+USE_REGIONS = False
+REGIONS = [
+    Region("kolkata", os.path.join(DATADIR, KOLKATA_OSMFILE)),
+    Region("chicago", os.path.join(DATADIR, CHICAGO_OSMFILE),
+           city_mapping={'chicago': 'Chicago'},
+           street_types=(expected_street_types - frozenset(["Sarani"])) | 
+           frozenset(["Highway", "Terrace", "Way"]),
+           postcode_length=5),
+]
+# Number of worker processes parsing chunks of the file in parallel
+PROCESSES = multiprocessing.cpu_count()
+# Where to load the data: "mongodb", or "sqlite" for a local file
+STORAGE = "mongodb"
+# Output of the reshaped data: "json" or "bson", compressed with None,
+# "gzip" or "zstd"
+OUTPUT_FORMAT = "json"
+OUTPUT_COMPRESSION = None
+# Audit users and addresses with sketches, in bounded memory
+APPROXIMATE_AUDITS = False
+# Parse, shape and load the data at the same time
+PIPELINE = False
+# Directory to cache the results of a pass in, and to keep the checkpoints
+# of interrupted runs, e.g. RESULT_CACHE_DIR; None to always run afresh
+RESULT_CACHE = None
+# osmChange files to apply after the load, e.g. ["kolkata_india.osc.gz"]
+CHANGE_FILES = []
+# Write the output as shards by element type and tile, with a manifest
+SHARDED_OUTPUT = False
+# Title of an auditor to profile, e.g. "Reshaping and saving data"
+PROFILE = None
 
 if __name__ == '__main__':
+    if USE_REGIONS:
+        run_regions(REGIONS, PROCESSES, storage=STORAGE, 
+                    output_format=OUTPUT_FORMAT, 
+                    compression=OUTPUT_COMPRESSION, 
+                    approximate=APPROXIMATE_AUDITS, shards=SHARDED_OUTPUT,
+                    cache_dir=RESULT_CACHE)
+        sys.exit()
     if USE_SAMPLE_DATA:
         fname = find_file("./", SAMPLE_OSMFILE)
     else:
@@ -699,5 +5981,9 @@ if __name__ == '__main__':
         # optionally produce sample file
         #sample_elements(fname, SAMPLE_OSMFILE)
 
-    wrangle_maps(fname)
+    wrangle_maps(fname, PROCESSES, storage=STORAGE, profile=PROFILE,
+                 output_format=OUTPUT_FORMAT, compression=OUTPUT_COMPRESSION,
+                 approximate=APPROXIMATE_AUDITS, pipeline=PIPELINE,
+                 cache_dir=RESULT_CACHE, changes=CHANGE_FILES, 
+                 shards=SHARDED_OUTPUT)
 